@@ -0,0 +1,69 @@
+import asyncio
+import os
+import uuid
+
+import asyncpg
+import pytest
+from piccolo.columns import Varchar
+from piccolo.table import Table
+
+from tinybot.db import engine as db_engine
+
+HOST = os.getenv("TEST_DB_HOST")
+CREDENTIALS = {"host": HOST, "user": os.getenv("TEST_DB_USER"), "password": os.getenv("TEST_DB_PASSWORD")}
+
+pytestmark = pytest.mark.skipif(
+    HOST is None, reason="TEST_DB_HOST, TEST_DB_USER and TEST_DB_PASSWORD point to a Postgres server to test against"
+)
+
+
+async def execute(database, *queries):
+    connection = await asyncpg.connect(database=database, **CREDENTIALS)
+    try:
+        for query in queries:
+            await connection.execute(query)
+    finally:
+        await connection.close()
+
+
+def test_tables_are_copied_from_the_previous_cog_database(monkeypatch, tmp_path):
+    cog = f"migrate{uuid.uuid4().hex[:8]}"
+    shared = f"{cog}_shared"
+    monkeypatch.setenv("DB_TYPE", "postgres")
+    monkeypatch.setenv("DB_HOST", CREDENTIALS["host"])
+    monkeypatch.setenv("DB_USER", CREDENTIALS["user"])
+    monkeypatch.setenv("DB_PASSWORD", CREDENTIALS["password"])
+    monkeypatch.setenv("DB_NAME", shared)
+    registry = db_engine.EngineRegistry()
+    monkeypatch.setattr(db_engine, "registry", registry)
+    engine = db_engine.DBEngine(str(tmp_path), cog)
+    # Piccolo connects when the engine is built.
+    asyncio.run(execute("postgres", f'CREATE DATABASE "{shared}"', f'CREATE DATABASE "{cog}"'))
+
+    class Note(Table, db=engine.connect(), tablename="note"):
+        text = Varchar()
+
+    async def main():
+        # The database a cog had before cogs shared one.
+        await execute(
+            cog,
+            'CREATE TABLE "note" (id SERIAL PRIMARY KEY, text VARCHAR(255) NOT NULL)',
+            "INSERT INTO \"note\" (text) SELECT 'note ' || n FROM generate_series(1, 2500) AS n",
+        )
+        try:
+            await engine.setup([Note])
+            assert Note._meta.tablename == f"{cog}_note"
+            assert await Note.count() == 2500
+            # The ids continue after the copied ones.
+            await Note.insert(Note(text="new"))
+            assert (await Note.select(Note.id).where(Note.text == "new").first())["id"] == 2501
+
+            # A restart finds the rows and copies nothing.
+            Note._meta.tablename = "note"
+            await engine.setup([Note])
+            assert await Note.count() == 2501
+        finally:
+            await registry.close()
+            await execute("postgres", f'DROP DATABASE IF EXISTS "{cog}"', f'DROP DATABASE IF EXISTS "{shared}"')
+
+    asyncio.run(main())
@@ -0,0 +1,173 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from tinybot.core.http import HTTPClient
+
+
+class Backend:
+    """A local server counting the requests of each route."""
+
+    def __init__(self):
+        self.hits = {}
+        self.fail = 0
+        app = web.Application()
+        app.router.add_get("/slow", self.slow)
+        app.router.add_get("/etag", self.etag)
+        app.router.add_get("/fresh", self.fresh)
+        app.router.add_get("/flaky", self.flaky)
+        app.router.add_get("/big/{n}", self.big)
+        self.server = TestServer(app)
+
+    def count(self, request):
+        self.hits[request.path] = self.hits.get(request.path, 0) + 1
+
+    async def slow(self, request):
+        self.count(request)
+        await asyncio.sleep(0.1)
+        return web.Response(text="slow", headers={"ETag": '"slow"'})
+
+    async def etag(self, request):
+        self.count(request)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304, headers={"ETag": '"v1"'})
+        return web.Response(text="body", headers={"ETag": '"v1"'})
+
+    async def fresh(self, request):
+        self.count(request)
+        return web.Response(text="fresh", headers={"Cache-Control": "max-age=60"})
+
+    async def flaky(self, request):
+        self.count(request)
+        if self.fail:
+            self.fail -= 1
+            return web.Response(status=500, headers={"Cache-Control": "max-age=60"})
+        return web.Response(text="ok", headers={"Cache-Control": "max-age=60"})
+
+    async def big(self, request):
+        self.count(request)
+        return web.Response(body=b"x" * 400, headers={"Cache-Control": "max-age=60"})
+
+
+def run(test):
+    async def main():
+        backend = Backend()
+        await backend.server.start_server()
+        client = HTTPClient(cache_size=1000)
+        try:
+            await test(backend, client, lambda path: backend.server.make_url(path))
+        finally:
+            await client.close()
+            await backend.server.close()
+
+    asyncio.run(main())
+
+
+def test_concurrent_gets_share_one_request():
+    async def test(backend, client, url):
+        responses = await asyncio.gather(*(client.get(url("/slow")) for _ in range(10)))
+        assert backend.hits["/slow"] == 1
+        assert {response.text() for response in responses} == {"slow"}
+        assert client.stats()["hosts"][url("/").host]["coalesced"] == 9
+        assert client.stats()["inflight"] == 0
+
+    run(test)
+
+
+def test_coalescing_keeps_cached_and_uncached_calls_apart():
+    async def test(backend, client, url):
+        await asyncio.gather(client.get(url("/slow"), cache=True), client.get(url("/slow")))
+        assert backend.hits["/slow"] == 2
+
+    run(test)
+
+
+def test_cancelled_caller_does_not_fail_the_others():
+    async def test(backend, client, url):
+        first = asyncio.create_task(client.get(url("/slow")))
+        second = asyncio.create_task(client.get(url("/slow")))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert (await second).text() == "slow"
+        assert backend.hits["/slow"] == 1
+
+    run(test)
+
+
+def test_fresh_response_is_served_from_the_cache():
+    async def test(backend, client, url):
+        for _ in range(3):
+            assert (await client.get(url("/fresh"), cache=True)).text() == "fresh"
+        assert backend.hits["/fresh"] == 1
+        host = client.stats()["hosts"][url("/").host]
+        assert (host["hits"], host["misses"]) == (2, 1)
+
+    run(test)
+
+
+def test_stale_response_is_revalidated_with_its_etag():
+    async def test(backend, client, url):
+        first = await client.get(url("/etag"), cache=True)
+        second = await client.get(url("/etag"), cache=True)
+        assert backend.hits["/etag"] == 2
+        assert second.status == 200 and second.text() == first.text() == "body"
+        assert client.stats()["hosts"][url("/").host]["revalidated"] == 1
+
+    run(test)
+
+
+def test_uncached_get_bypasses_the_cache():
+    async def test(backend, client, url):
+        await client.get(url("/fresh"), cache=True)
+        await client.get(url("/fresh"))
+        assert backend.hits["/fresh"] == 2
+
+    run(test)
+
+
+def test_failed_response_is_not_cached_and_is_retried():
+    async def test(backend, client, url):
+        backend.fail = 1
+        assert (await client.get(url("/flaky"), cache=True)).status == 500
+        assert (await client.get(url("/flaky"), cache=True)).text() == "ok"
+        assert (await client.get(url("/flaky"), cache=True)).text() == "ok"
+        assert backend.hits["/flaky"] == 2
+
+    run(test)
+
+
+def test_connection_error_is_retried_on_the_next_call():
+    async def test(backend, client, url):
+        fresh = url("/fresh")
+        await backend.server.close()
+        try:
+            await client.get(fresh)
+        except aiohttp.ClientError:
+            pass
+        else:
+            raise AssertionError("expected a connection error")
+        assert client.stats()["hosts"][fresh.host]["errors"] == 1
+        assert client.stats()["inflight"] == 0
+
+        backend.server = TestServer(backend.server.app, port=fresh.port)
+        await backend.server.start_server()
+        assert (await client.get(fresh)).text() == "fresh"
+
+    run(test)
+
+
+def test_cache_evicts_least_recently_used_by_size():
+    async def test(backend, client, url):
+        for n in (1, 2):
+            await client.get(url(f"/big/{n}"), cache=True)
+        # Touch 1 so 2 is the least recently used.
+        await client.get(url("/big/1"), cache=True)
+        await client.get(url("/big/3"), cache=True)
+        assert client.cache_bytes <= 1000
+        await client.get(url("/big/1"), cache=True)
+        await client.get(url("/big/2"), cache=True)
+        assert backend.hits == {"/big/1": 1, "/big/2": 2, "/big/3": 1}
+
+    run(test)
@@ -0,0 +1,40 @@
+import asyncio
+
+from tinybot.core.loader import CogInfo, load_cogs
+
+
+class FakeBot:
+    """Records the extensions loaded instead of importing them."""
+
+    def __init__(self):
+        self.extensions = {}
+
+    async def load_extension(self, name):
+        self.extensions[name] = object()
+
+
+def cogs(**requires):
+    return {name: CogInfo(name, requires=required) for name, required in requires.items()}
+
+
+def test_requirements_are_loaded_first():
+    bot = FakeBot()
+    known = cogs(a=["b"], b=["c"], c=[])
+    results = asyncio.run(load_cogs(bot, known, ["a"]))
+    assert {name: status for name, (status, _) in results.items()} == {"a": "loaded", "b": "loaded", "c": "loaded"}
+    assert list(bot.extensions) == ["tinybot.cogs.c", "tinybot.cogs.b", "tinybot.cogs.a"]
+
+
+def test_every_dependency_cycle_is_skipped():
+    bot = FakeBot()
+    known = cogs(a=["b"], b=["a"], c=["d"], d=["c"], e=["a"], f=[])
+    results = asyncio.run(load_cogs(bot, known, list(known)))
+    assert {name: status for name, (status, _) in results.items()} == {
+        "a": "dependency cycle",
+        "b": "dependency cycle",
+        "c": "dependency cycle",
+        "d": "dependency cycle",
+        "e": "requires a",
+        "f": "loaded",
+    }
+    assert list(bot.extensions) == ["tinybot.cogs.f"]
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import subprocess
+
+from tinybot.cogs.downloader.repo_manager import RepoManager
+
+GIT_ENV = {
+    **os.environ,
+    "GIT_AUTHOR_NAME": "test",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "test",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+}
+
+
+def git(*args, cwd=None):
+    subprocess.run(["git", *args], cwd=cwd, env=GIT_ENV, check=True, capture_output=True)
+
+
+def write_cog(work, name, body):
+    (work / name).mkdir(exist_ok=True)
+    (work / name / "__init__.py").write_text(body, encoding="utf-8")
+
+
+def push(work, message):
+    git("add", "-A", cwd=work)
+    git("commit", "-q", "-m", message, cwd=work)
+    git("push", "-q", "origin", "HEAD:main", cwd=work)
+
+
+def make_remote(tmp_path):
+    """A bare repo with the cogs ``alpha`` and ``beta``, and a working copy to push to it."""
+    remote = tmp_path / "remote.git"
+    work = tmp_path / "work"
+    git("init", "-q", "--bare", "-b", "main", str(remote))
+    git("clone", "-q", str(remote), str(work))
+    write_cog(work, "alpha", "VERSION = 1\n")
+    write_cog(work, "beta", "VERSION = 1\n")
+    push(work, "initial")
+    return f"file://{remote}", work
+
+
+class RecordingManager(RepoManager):
+    """Keeps the git commands run, to check which repos were touched."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = []
+
+    async def run(self, command, **kwargs):
+        self.commands.append(command)
+        return await super().run(command, **kwargs)
+
+
+def test_add_update_and_remove(tmp_path):
+    url, work = make_remote(tmp_path)
+    installed = tmp_path / "cogs"
+    installed.mkdir()
+
+    async def main():
+        manager = RecordingManager(tmp_path / "data", installed, max_workers=2)
+        repo = await manager.add_repo("cogs", url)
+        assert repo.branch == "main"
+        assert repo.available_cogs == ["alpha", "beta"]
+        # Shallow clone.
+        shallow = subprocess.run(
+            ["git", "-C", str(repo.path), "rev-parse", "--is-shallow-repository"], capture_output=True, text=True
+        )
+        assert shallow.stdout.strip() == "true"
+
+        manager.install_cog("cogs", "alpha")
+        manager.install_cog("cogs", "beta")
+        assert (installed / "alpha" / "__init__.py").read_text() == "VERSION = 1\n"
+        index = json.loads((tmp_path / "data" / "index.json").read_text())
+        assert index["cogs"]["cogs"] == {"alpha": repo.commit, "beta": repo.commit}
+
+        # Nothing moved: only the remote is asked, nothing is pulled.
+        manager.commands.clear()
+        assert await manager.update() == {}
+        assert all("ls-remote" in command for command in manager.commands)
+
+        write_cog(work, "alpha", "VERSION = 2\n")
+        push(work, "change alpha")
+        assert list(await manager.check_updates()) == ["cogs"]
+        assert await manager.update() == {"cogs": {"alpha"}}
+        assert (installed / "alpha" / "__init__.py").read_text() == "VERSION = 2\n"
+
+        # The index survives a restart.
+        reloaded = RepoManager(tmp_path / "data", installed)
+        assert reloaded.repos["cogs"].commit == manager.repos["cogs"].commit
+        assert reloaded.installed_cogs() == manager.installed_cogs()
+
+        await manager.remove_repo("cogs")
+        assert not (installed / "alpha").exists() and not (installed / "beta").exists()
+        assert not repo.path.exists()
+        assert json.loads((tmp_path / "data" / "index.json").read_text()) == {}
+
+    asyncio.run(main())
+
+
+def test_update_follows_rewritten_history(tmp_path):
+    url, work = make_remote(tmp_path)
+    installed = tmp_path / "cogs"
+    installed.mkdir()
+
+    async def main():
+        manager = RepoManager(tmp_path / "data", installed)
+        await manager.add_repo("cogs", url, "main")
+        manager.install_cog("cogs", "beta")
+
+        write_cog(work, "beta", "VERSION = 3\n")
+        git("add", "-A", cwd=work)
+        git("commit", "-q", "--amend", "-m", "rewritten", cwd=work)
+        git("push", "-q", "--force", "origin", "HEAD:main", cwd=work)
+
+        assert await manager.update() == {"cogs": {"beta"}}
+        assert (installed / "beta" / "__init__.py").read_text() == "VERSION = 3\n"
+
+    asyncio.run(main())
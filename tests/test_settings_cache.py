@@ -0,0 +1,58 @@
+import asyncio
+
+from piccolo.columns import BigInt, Varchar
+from piccolo.engine.sqlite import SQLiteEngine
+from piccolo.table import Table
+
+from tinybot.db.cache import SettingsCache
+
+
+class GuildSettings(Table, db=SQLiteEngine(path=":memory:")):
+    guild_id = BigInt(unique=True)
+    prefix = Varchar(default="!")
+
+
+class SlowCache(SettingsCache):
+    """Loads rows from ``rows`` once ``release`` is set, counting the loads."""
+
+    def __init__(self, rows):
+        super().__init__(None, GuildSettings, GuildSettings.guild_id)
+        self.rows = rows
+        self.loads = 0
+        self.loading = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def _load(self, key):
+        self.loads += 1
+        row = dict(self.rows[key])
+        self.loading.set()
+        await self.release.wait()
+        return row
+
+
+def test_concurrent_misses_share_one_load():
+    async def main():
+        cache = SlowCache({1: {"guild_id": 1, "prefix": "?"}})
+        cache.release.set()
+        rows = await asyncio.gather(*(cache.get(1) for _ in range(5)))
+        assert [row["prefix"] for row in rows] == ["?"] * 5
+        assert cache.loads == 1
+        assert (await cache.get(1))["prefix"] == "?" and cache.loads == 1
+
+    asyncio.run(main())
+
+
+def test_row_loaded_during_an_invalidation_is_not_cached():
+    async def main():
+        for key in (1, None):
+            cache = SlowCache({1: {"guild_id": 1, "prefix": "old"}})
+            load = asyncio.create_task(cache.get(1))
+            await cache.loading.wait()
+            cache.rows[1]["prefix"] = "new"
+            cache.invalidate(key)
+            cache.release.set()
+            assert (await load)["prefix"] == "old"
+            assert (await cache.get(1))["prefix"] == "new"
+            assert cache.loads == 2
+
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+from piccolo.columns import Varchar
+from piccolo.table import Table, create_db_tables
+
+from tinybot.db.sqlite import TunedSQLiteEngine
+
+
+def make_table(engine):
+    class Note(Table, db=engine, tablename="note"):
+        text = Varchar()
+
+    return Note
+
+
+def test_writes_are_batched_and_read_back(tmp_path):
+    engine = TunedSQLiteEngine(path=str(tmp_path / "notes.sqlite"), readers=2)
+    Note = make_table(engine)
+
+    async def main():
+        await create_db_tables(Note, if_not_exists=True)
+        await asyncio.gather(*(Note.insert(Note(text=f"note {n}")) for n in range(20)))
+        assert await Note.count() == 20
+        assert engine.writer.writes == 20 and engine.writer.batches < 20
+        await engine.close()
+
+    asyncio.run(main())
+
+
+def test_readers_in_use_are_closed_with_the_engine(tmp_path):
+    engine = TunedSQLiteEngine(path=str(tmp_path / "notes.sqlite"), readers=1)
+    Note = make_table(engine)
+
+    async def main():
+        await create_db_tables(Note, if_not_exists=True)
+        # The first read holds the only reader while close() runs, the second waits for it.
+        reads = [asyncio.create_task(Note.count().run()) for _ in range(2)]
+        while engine.stats()["readers"] == 0:
+            await asyncio.sleep(0)
+        await engine.close()
+        results = await asyncio.gather(*reads, return_exceptions=True)
+        assert results[0] == 0
+        assert isinstance(results[1], RuntimeError)
+        assert engine.stats()["readers"] == 0
+        with pytest.raises(RuntimeError):
+            await Note.count()
+        with pytest.raises(RuntimeError):
+            await Note.insert(Note(text="late"))
+
+    asyncio.run(main())
@@ -8,14 +8,15 @@ from dotenv import load_dotenv
 
 from .bot import TinyBot
 from .cli import parse_cli_flags
+from .core.cluster import EXIT_FATAL, ClusterLauncher, cluster_shard_ids
 from .logger import init_logging
 
-init_logging()
-log = logging.getLogger("tinybot.main")
-
 cli_flags, _ = parse_cli_flags()
 load_dotenv(cli_flags.dotenvfile_path)
 
+init_logging(cli_flags.cluster_id)
+log = logging.getLogger("tinybot.main")
+
 UVLOOP_INSTALLED: bool = False
 
 
@@ -32,49 +33,61 @@ def _update_event_loop_policy(_asyncio) -> None:
                 _asyncio.set_event_loop_policy(_uvloop.EventLoopPolicy())
 
 
-async def run_bot() -> None:
-    if sys.platform.startswith("win"):
-        loop = asyncio.ProactorEventLoop()
-    else:
-        loop = asyncio.new_event_loop()
-
-    asyncio.set_event_loop(loop)
-
-    if UVLOOP_INSTALLED:
-        _update_event_loop_policy(_asyncio=asyncio)
-    else:
-        pass
+async def run_bot() -> int:
+    """Runs the bot until it stops and returns the exit code of the process."""
+    shard_kwargs = {}
+    if cli_flags.cluster_id is not None:
+        shard_kwargs = {
+            "shard_ids": cluster_shard_ids(cli_flags.cluster_id, cli_flags.shards_per_cluster),
+            "shard_count": cli_flags.clusters * cli_flags.shards_per_cluster,
+        }
 
+    exit_code = 0
     async with TinyBot(
         prefix=cli_flags.prefix,
         owner_ids=cli_flags.owner,
+        cache_profile=cli_flags.cache_profile,
+        cluster_id=cli_flags.cluster_id,
+        ipc_port=cli_flags.ipc_port,
+        executor_threads=cli_flags.threads,
+        executor_processes=cli_flags.processes,
+        # Clusters report their metrics to the launcher, which serves them.
+        metrics_port=cli_flags.metrics_port if cli_flags.cluster_id is None else None,
+        **shard_kwargs,
     ) as bot:
         try:
             log.info("Starting Tiny-DicordBot!")
             await bot.start(os.environ['DISCORD_TOKEN'])
         except discord.LoginFailure:
             log.exception("Failed to login to Discord:", exc_info=True)
+            exit_code = EXIT_FATAL
         except discord.PrivilegedIntentsRequired:
             log.error(
                 "You are missing one of the privileged intents. Please review on the developer Portal."
             )
+            exit_code = EXIT_FATAL
         except KeyboardInterrupt:
             print("CTRL + C received, exiting gracefully...")
+        except Exception:
+            log.exception("Fatal error, shutting down")
+            exit_code = 1
         finally:
             log.info("Shutting down")
 
             await bot.close()
 
-            loop.run_until_complete(loop.shutdown_asyncgens())
-            loop.run_until_complete(asyncio.sleep(2))
-
-            asyncio.set_event_loop(None)
-
-            loop.stop()
-            loop.close()
-
-            sys.exit()
+    # asyncio.run shuts the async generators down and closes the loop once this returns.
+    return exit_code
 
 
 if __name__ == "__main__":
-    asyncio.run(run_bot())
+    if cli_flags.clusters and cli_flags.cluster_id is None:
+        log.info(
+            "Starting %s clusters of %s shards", cli_flags.clusters, cli_flags.shards_per_cluster
+        )
+        asyncio.run(
+            ClusterLauncher(cli_flags.clusters, sys.argv[1:], metrics_port=cli_flags.metrics_port).run()
+        )
+    else:
+        # The launcher restarts a cluster unless it exits with 0 or EXIT_FATAL.
+        sys.exit(asyncio.run(run_bot()))
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import json
+import logging
+import pathlib
+import sys
+
+from tinybot.bench.suite import Options, compare, run_suite
+
+
+def parse_args() -> argparse.Namespace:
+    defaults = Options()
+    parser = argparse.ArgumentParser(
+        prog="python -m tinybot.bench",
+        description="Benchmarks TinyBot against a local fake Discord gateway and API.",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs to take the median of.")
+    parser.add_argument("--guilds", type=int, default=defaults.guilds, help="Guilds sent at startup.")
+    parser.add_argument("--members", type=int, default=defaults.members, help="Members per startup guild.")
+    parser.add_argument("--messages", type=int, default=defaults.messages, help="Messages of the flood.")
+    parser.add_argument(
+        "--command-every",
+        type=int,
+        default=defaults.command_every,
+        help="One message out of this many in the flood is a command, 0 for none.",
+    )
+    parser.add_argument(
+        "--memory-members", type=int, default=defaults.memory_members, help="Members of the measured guild."
+    )
+    parser.add_argument(
+        "--memory-messages", type=int, default=defaults.memory_messages, help="Messages measured."
+    )
+    parser.add_argument(
+        "--cache-profile", choices=["minimal", "standard", "full"], default=defaults.cache_profile
+    )
+    parser.add_argument(
+        "--message-cache", choices=["full", "compact", "off"], default=defaults.message_cache
+    )
+    parser.add_argument(
+        "--guild-ready-timeout",
+        type=float,
+        default=defaults.guild_ready_timeout,
+        help="Seconds discord.py waits for more guilds before on_ready, part of the startup time.",
+    )
+    parser.add_argument("--no-compress", action="store_true", help="Send uncompressed gateway frames.")
+    parser.add_argument(
+        "--replay", type=str, default=None, help="JSON lines of recorded dispatches to send after the flood."
+    )
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", type=str, default=None, help="Results of an earlier run to compare with.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative change of a median that counts as a regression with --compare.",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING, format="%(levelname)s %(name)s: %(message)s"
+    )
+    options = Options(
+        guilds=args.guilds,
+        members=args.members,
+        messages=args.messages,
+        command_every=args.command_every,
+        memory_members=args.memory_members,
+        memory_messages=args.memory_messages,
+        cache_profile=args.cache_profile,
+        message_cache=args.message_cache,
+        guild_ready_timeout=args.guild_ready_timeout,
+        compress=not args.no_compress,
+        replay=args.replay,
+    )
+    suite = asyncio.run(run_suite(options, repeat=args.repeat))
+
+    width = max(len(name) for name in suite["results"])
+    for name, result in suite["results"].items():
+        print(f"{name:<{width}}  {result['median']:>14,.4f}")
+    if args.output:
+        pathlib.Path(args.output).write_text(json.dumps(suite, indent=2), encoding="utf-8")
+
+    if not args.compare:
+        return 0
+    baseline = json.loads(pathlib.Path(args.compare).read_text(encoding="utf-8"))
+    if baseline["options"] != suite["options"]:
+        print("Warning: the baseline was run with other options, the results may not be comparable.")
+    rows = compare(baseline, suite, args.tolerance)
+    print()
+    for row in rows:
+        flag = "REGRESSED" if row["regressed"] else ""
+        print(
+            f"{row['name']:<{width}}  {row['baseline']:>14,.4f} -> {row['current']:>14,.4f}  "
+            f"{row['change']:+7.1%}  {flag}"
+        )
+    return 1 if any(row["regressed"] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
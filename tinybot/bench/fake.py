@@ -0,0 +1,373 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Self, Tuple
+
+import discord
+import yarl
+from aiohttp import WSMsgType, web
+from discord.gateway import DiscordWebSocket
+
+from tinybot.bench import payloads
+
+log = logging.getLogger("tinybot.bench")
+
+# Opcodes of the gateway, see discord.gateway.DiscordWebSocket.
+DISPATCH, HEARTBEAT, IDENTIFY, RESUME, RECONNECT, REQUEST_MEMBERS, INVALID_SESSION, HELLO, HEARTBEAT_ACK = (
+    0, 1, 2, 6, 7, 8, 9, 10, 11
+)
+
+_SNOWFLAKE_RE = re.compile(r"/\d{15,20}")
+
+
+def json_response(data: Any, status: int = 200, headers: Optional[Dict[str, str]] = None) -> web.Response:
+    # discord.py only decodes bodies whose content type is exactly application/json, without a charset.
+    return web.Response(
+        body=json.dumps(data).encode(), status=status, headers={**(headers or {}), "Content-Type": "application/json"}
+    )
+
+
+class Session:
+    """A gateway session of one shard, survives reconnects like Discord's do."""
+
+    __slots__ = ("session_id", "shard_id", "seq", "ws", "compress", "connected", "identifies", "resumes")
+
+    def __init__(self: Self, shard_id: int) -> None:
+        self.session_id: str = uuid.uuid4().hex
+        self.shard_id = shard_id
+        self.seq: int = 0
+        self.ws: Optional[web.WebSocketResponse] = None
+        self.compress: Optional[Any] = None
+        self.connected: asyncio.Event = asyncio.Event()
+        self.identifies: int = 0
+        self.resumes: int = 0
+
+    async def send(self: Self, frame: str) -> None:
+        if self.compress is not None:
+            await self.ws.send_bytes(self.compress.compress(frame.encode()) + self.compress.flush(zlib.Z_SYNC_FLUSH))
+        else:
+            await self.ws.send_str(frame)
+
+    async def dispatch(self: Self, event: str, data: str) -> None:
+        """Sends a dispatch whose ``data`` is already JSON encoded."""
+        self.seq += 1
+        await self.send(f'{{"op":{DISPATCH},"t":"{event}","s":{self.seq},"d":{data}}}')
+
+
+class FakeDiscord:
+    """
+    A local stand-in for the Discord REST API and gateway.
+
+    It answers the few REST routes discord.py needs to log in and the bot needs
+    to reply, and runs a gateway that says HELLO, answers IDENTIFY with READY and
+    one ``GUILD_CREATE`` per guild of the shard, RESUME with RESUMED (or with
+    INVALID_SESSION for an unknown session), member requests with one chunk and
+    acknowledges heartbeats. Everything else is pushed by the caller with
+    :meth:`dispatch` and :meth:`reconnect`.
+
+    The server runs in a thread with its own event loop, so encoding and sending
+    the payloads does not run on the bot's loop. Its coroutines are called from
+    the bot's loop through :meth:`call`.
+
+    Parameters
+    ----------
+    guilds: List[Dict[str, Any]]
+        ``GUILD_CREATE`` payloads, sent to the shard owning them.
+    shards: int
+        Shard count returned by ``/gateway/bot``.
+    compress: bool
+        Send zlib-stream compressed frames like Discord does, the bot pays for inflating them.
+    rate_limit: Optional[Tuple[int, float]]
+        Messages per seconds a channel accepts, with Discord's rate limit headers and 429s
+        past them. Not limited by default.
+    """
+
+    def __init__(
+        self: Self,
+        guilds: List[Dict[str, Any]],
+        shards: int = 1,
+        compress: bool = True,
+        rate_limit: Optional[Tuple[int, float]] = None,
+    ) -> None:
+        self.guilds = guilds
+        self.shards = shards
+        self.compress = compress
+        self.rate_limit = rate_limit
+        # Channel id -> (requests left, loop time of the reset) of its rate limit window.
+        self._windows: Dict[int, Tuple[int, float]] = {}
+        self.rate_limited: int = 0
+        self.sessions: Dict[int, Session] = {}
+        # "METHOD /route" -> count, snowflakes replaced by {id}.
+        self.requests: collections.Counter = collections.Counter()
+        self.sent_messages: int = 0
+        self.port: int = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+        self._app = web.Application()
+        self._app.router.add_get("/gateway", self._gateway)
+        self._app.router.add_get("/api/v10/users/@me", self._json(payloads.bot_user))
+        self._app.router.add_get("/api/v10/oauth2/applications/@me", self._json(payloads.application))
+        self._app.router.add_get("/api/v10/gateway/bot", self._gateway_bot)
+        self._app.router.add_get("/api/v10/gateway", self._gateway_bot)
+        self._app.router.add_post("/api/v10/channels/{channel_id}/messages", self._create_message)
+        self._app.router.add_route("*", "/api/v10/{tail:.*}", self._fallback)
+        self._app.middlewares.append(self._count)
+
+    @property
+    def url(self: Self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    # REST
+
+    @web.middleware
+    async def _count(self: Self, request: web.Request, handler: Any) -> web.StreamResponse:
+        self.requests[f"{request.method} {_SNOWFLAKE_RE.sub('/{id}', request.path)}"] += 1
+        return await handler(request)
+
+    @staticmethod
+    def _json(build: Any) -> Any:
+        async def handler(_request: web.Request) -> web.Response:
+            return json_response(build())
+
+        return handler
+
+    async def _gateway_bot(self: Self, _request: web.Request) -> web.Response:
+        return json_response(
+            {
+                "url": f"ws://127.0.0.1:{self.port}/gateway",
+                "shards": self.shards,
+                "session_start_limit": {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 16},
+            }
+        )
+
+    def _take(self: Self, channel_id: int) -> Tuple[bool, Dict[str, str]]:
+        """Counts a request against the channel's rate limit, returns whether it is allowed and the headers."""
+        if self.rate_limit is None:
+            return True, {}
+        limit, per = self.rate_limit
+        now = self.loop.time()
+        remaining, reset = self._windows.get(channel_id, (limit, 0.0))
+        if now >= reset:
+            remaining, reset = limit, now + per
+        allowed = remaining > 0
+        if allowed:
+            remaining -= 1
+            self._windows[channel_id] = (remaining, reset)
+        return allowed, {
+            "X-RateLimit-Limit": str(limit),
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset-After": f"{reset - now:.3f}",
+            "X-RateLimit-Reset": f"{time.time() + reset - now:.3f}",
+            "X-RateLimit-Bucket": "messages",
+            # discord.py takes a 429 without it for a Cloudflare ban.
+            "Via": "1.1 google",
+        }
+
+    async def _create_message(self: Self, request: web.Request) -> web.Response:
+        body = await request.json()
+        channel_id = int(request.match_info["channel_id"])
+        allowed, headers = self._take(channel_id)
+        if not allowed:
+            self.rate_limited += 1
+            return json_response(
+                {
+                    "message": "You are being rate limited.",
+                    "retry_after": float(headers["X-RateLimit-Reset-After"]),
+                    "global": False,
+                },
+                status=429,
+                headers=headers,
+            )
+        self.sent_messages += 1
+        data = payloads.message(channel_id, 0, payloads.BOT_ID, body.get("content") or "")
+        del data["guild_id"], data["member"]
+        return json_response(data, headers=headers)
+
+    async def _fallback(self: Self, request: web.Request) -> web.Response:
+        if request.method == "GET":
+            return json_response({"message": "Unknown route", "code": 0}, status=404)
+        return web.Response(status=204)
+
+    # Gateway
+
+    def _guilds_of(self: Self, shard_id: int) -> List[Dict[str, Any]]:
+        return [g for g in self.guilds if (int(g["id"]) >> 22) % self.shards == shard_id]
+
+    async def _gateway(self: Self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        compress = zlib.compressobj() if self.compress and request.query.get("compress") else None
+
+        async def send(frame: Dict[str, Any]) -> None:
+            text = json.dumps(frame)
+            if compress is not None:
+                await ws.send_bytes(compress.compress(text.encode()) + compress.flush(zlib.Z_SYNC_FLUSH))
+            else:
+                await ws.send_str(text)
+
+        await send({"op": HELLO, "d": {"heartbeat_interval": 41250}})
+        session: Optional[Session] = None
+        async for msg in ws:
+            if msg.type is not WSMsgType.TEXT:
+                break
+            frame = json.loads(msg.data)
+            op, data = frame["op"], frame["d"]
+            if op == HEARTBEAT:
+                await send({"op": HEARTBEAT_ACK})
+            elif op == IDENTIFY:
+                shard_id = data.get("shard", [0, 1])[0]
+                session = self.sessions[shard_id] = Session(shard_id)
+                session.ws, session.compress = ws, compress
+                session.identifies += 1
+                await self._ready(session)
+            elif op == RESUME:
+                session = next((s for s in self.sessions.values() if s.session_id == data["session_id"]), None)
+                if session is None:
+                    await send({"op": INVALID_SESSION, "d": False})
+                    continue
+                session.ws, session.compress = ws, compress
+                session.resumes += 1
+                await session.dispatch("RESUMED", "{}")
+                session.connected.set()
+            elif op == REQUEST_MEMBERS and session is not None:
+                await self._chunk(session, data)
+        if session is not None and session.ws is ws:
+            session.connected.clear()
+        return ws
+
+    async def _ready(self: Self, session: Session) -> None:
+        guilds = self._guilds_of(session.shard_id)
+        await session.dispatch(
+            "READY",
+            json.dumps(
+                {
+                    "v": 10,
+                    "user": payloads.bot_user(),
+                    "guilds": [{"id": g["id"], "unavailable": True} for g in guilds],
+                    "session_id": session.session_id,
+                    "resume_gateway_url": f"ws://127.0.0.1:{self.port}/gateway",
+                    "shard": [session.shard_id, self.shards],
+                    "application": {"id": str(payloads.APPLICATION_ID), "flags": 0},
+                }
+            ),
+        )
+        for guild in guilds:
+            await session.dispatch("GUILD_CREATE", json.dumps(guild))
+        session.connected.set()
+
+    async def _chunk(self: Self, session: Session, data: Dict[str, Any]) -> None:
+        guild = next((g for g in self.guilds if g["id"] == str(data["guild_id"])), None)
+        chunk = {
+            "guild_id": str(data["guild_id"]),
+            "members": guild["members"] if guild else [],
+            "chunk_index": 0,
+            "chunk_count": 1,
+        }
+        if data.get("nonce"):
+            chunk["nonce"] = data["nonce"]
+        await session.dispatch("GUILD_MEMBERS_CHUNK", json.dumps(chunk))
+
+    # Control, these run on the server's loop, see call().
+
+    async def dispatch(self: Self, events: Iterable[Tuple[str, Dict[str, Any]]], shard_id: int = 0) -> int:
+        """
+        Sends dispatches to a shard. The payloads are encoded before the first one is sent.
+
+        Returns
+        -------
+            int
+                The number of dispatches sent.
+        """
+        session = self.sessions[shard_id]
+        encoded = [(event, json.dumps(data)) for event, data in events]
+        await session.connected.wait()
+        for event, data in encoded:
+            await session.dispatch(event, data)
+        return len(encoded)
+
+    async def reconnect(self: Self, shard_id: int = 0) -> None:
+        """Asks a shard to reconnect, it resumes its session on a new connection."""
+        session = self.sessions[shard_id]
+        session.connected.clear()
+        await session.send(json.dumps({"op": RECONNECT, "d": None}))
+
+    async def wait_connected(self: Self, shard_id: int = 0) -> None:
+        while shard_id not in self.sessions:
+            await asyncio.sleep(0.01)
+        await self.sessions[shard_id].connected.wait()
+
+    async def call(self: Self, coro: Any) -> Any:
+        """Runs a coroutine of this server on its loop and waits for it from the caller's."""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    # Lifecycle
+
+    def start(self: Self) -> None:
+        """
+        Starts the server in its thread and points discord.py's REST client and
+        default gateway, used after an invalidated session, at it.
+        """
+        started = threading.Event()
+        errors: List[BaseException] = []
+
+        def run() -> None:
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.loop.run_until_complete(self._serve())
+            except BaseException as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self._runner.cleanup())
+            self.loop.close()
+
+        self._thread = threading.Thread(target=run, name="tinybot-fake-discord", daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        discord.http.Route.BASE = f"{self.url}/api/v10"
+        DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(f"ws://127.0.0.1:{self.port}/gateway")
+        log.debug("Fake Discord listening on %s", self.url)
+
+    async def _serve(self: Self) -> None:
+        self._runner = web.AppRunner(self._app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def stop(self: Self) -> None:
+        discord.http.Route.BASE = "https://discord.com/api/v10"
+        DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL("wss://gateway.discord.gg/")
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    async def wait_for_messages(self: Self, count: int, timeout: float) -> float:
+        """
+        Waits until the bot sent ``count`` messages in total.
+
+        Returns
+        -------
+            float
+                The ``time.perf_counter()`` at which the last one arrived.
+        """
+        deadline = time.perf_counter() + timeout
+        while self.sent_messages < count:
+            if time.perf_counter() > deadline:
+                raise asyncio.TimeoutError(f"The bot sent {self.sent_messages} of {count} messages")
+            await asyncio.sleep(0.001)
+        return time.perf_counter()
@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import itertools
+import json
+import pathlib
+from typing import Any, Dict, Iterator, List, Tuple
+
+BOT_ID = 100_000_000_000_000_001
+OWNER_ID = 100_000_000_000_000_002
+APPLICATION_ID = BOT_ID
+TIMESTAMP = "2023-01-01T00:00:00.000000+00:00"
+
+_ids = itertools.count(200_000_000_000_000_000)
+
+
+def snowflake() -> int:
+    return next(_ids)
+
+
+def user(user_id: int, name: str, bot: bool = False) -> Dict[str, Any]:
+    return {
+        "id": str(user_id),
+        "username": name,
+        "discriminator": "0001",
+        "global_name": None,
+        "avatar": None,
+        "bot": bot,
+        "public_flags": 0,
+    }
+
+
+def bot_user() -> Dict[str, Any]:
+    return {**user(BOT_ID, "TinyBench", bot=True), "verified": True, "mfa_enabled": False, "flags": 0}
+
+
+def application() -> Dict[str, Any]:
+    return {
+        "id": str(APPLICATION_ID),
+        "name": "TinyBench",
+        "icon": None,
+        "description": "",
+        "rpc_origins": [],
+        "bot_public": True,
+        "bot_require_code_grant": False,
+        "owner": user(OWNER_ID, "owner"),
+        "team": None,
+        "verify_key": "0" * 64,
+        "flags": 0,
+        "summary": "",
+    }
+
+
+def member(user_id: int) -> Dict[str, Any]:
+    return {
+        "user": user(user_id, f"user{user_id % 100_000}"),
+        "nick": None,
+        "roles": [],
+        "joined_at": TIMESTAMP,
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+
+def guild(guild_id: int, members: int, channels: int = 5) -> Tuple[Dict[str, Any], List[int]]:
+    """
+    A ``GUILD_CREATE`` payload with ``members`` members besides the bot and the owner.
+
+    Returns
+    -------
+        Tuple[Dict[str, Any], List[int]]
+            The payload and the ids of its text channels.
+    """
+    channel_ids = [snowflake() for _ in range(channels)]
+    member_list = [member(BOT_ID), member(OWNER_ID)] + [member(snowflake()) for _ in range(members)]
+    payload = {
+        "id": str(guild_id),
+        "name": f"guild{guild_id % 100_000}",
+        "icon": None,
+        "owner_id": str(OWNER_ID),
+        "afk_timeout": 300,
+        "verification_level": 0,
+        "default_message_notifications": 0,
+        "explicit_content_filter": 0,
+        "mfa_level": 0,
+        "nsfw_level": 0,
+        "premium_tier": 0,
+        "system_channel_flags": 0,
+        "preferred_locale": "en-US",
+        "features": [],
+        "emojis": [],
+        "stickers": [],
+        "roles": [
+            {
+                "id": str(guild_id),
+                "name": "@everyone",
+                "permissions": "1071698660929",
+                "position": 0,
+                "color": 0,
+                "hoist": False,
+                "managed": False,
+                "mentionable": False,
+            }
+        ],
+        "channels": [
+            {
+                "id": str(channel_id),
+                "type": 0,
+                "name": f"channel{i}",
+                "position": i,
+                "permission_overwrites": [],
+                "nsfw": False,
+                "parent_id": None,
+            }
+            for i, channel_id in enumerate(channel_ids)
+        ],
+        "threads": [],
+        "stage_instances": [],
+        "guild_scheduled_events": [],
+        "voice_states": [],
+        "presences": [],
+        "members": member_list,
+        "member_count": len(member_list),
+        "large": len(member_list) > 250,
+        "unavailable": False,
+        "joined_at": TIMESTAMP,
+    }
+    return payload, channel_ids
+
+
+def message(channel_id: int, guild_id: int, author_id: int, content: str) -> Dict[str, Any]:
+    return {
+        "id": str(snowflake()),
+        "channel_id": str(channel_id),
+        "guild_id": str(guild_id),
+        "author": user(author_id, f"user{author_id % 100_000}"),
+        "member": {k: v for k, v in member(author_id).items() if k != "user"},
+        "content": content,
+        "timestamp": TIMESTAMP,
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+        "flags": 0,
+    }
+
+
+def message_flood(
+    channel_ids: List[int], guild_id: int, count: int, command_every: int = 10, prefix: str = "!"
+) -> Iterator[Dict[str, Any]]:
+    """
+    ``MESSAGE_CREATE`` payloads, one out of ``command_every`` being an owner command.
+    The others are regular chat messages.
+    """
+    for i in range(count):
+        if command_every and i % command_every == 0:
+            yield message(channel_ids[i % len(channel_ids)], guild_id, OWNER_ID, f"{prefix}test")
+        else:
+            yield message(channel_ids[i % len(channel_ids)], guild_id, snowflake(), f"just chatting {i}")
+
+
+def load_recording(path: pathlib.Path) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Reads recorded dispatches, one ``{"t": event, "d": data}`` JSON object per line,
+    like the ``socket_raw_receive`` payloads of a real gateway.
+    """
+    events = []
+    for line in path.read_text(encoding="utf-8").splitlines():
+        if line.strip():
+            payload = json.loads(line)
+            if payload.get("t"):
+                events.append((payload["t"], payload["d"]))
+    return events
@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import asyncio
+import gc
+import logging
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, Self
+
+import discord
+
+from tinybot.bench import payloads
+from tinybot.bench.fake import FakeDiscord
+from tinybot.bot import TinyBot
+from tinybot.core.loader import load_cogs
+
+log = logging.getLogger("tinybot.bench")
+
+TIMEOUT = 60.0
+
+
+class Options:
+    """
+    What a benchmark run sends to the bot. Runs are only comparable with the same options,
+    they are stored with the results.
+    """
+
+    __slots__ = (
+        "guilds", "members", "messages", "command_every", "memory_members", "memory_messages",
+        "cache_profile", "message_cache", "guild_ready_timeout", "compress", "replay",
+    )
+
+    def __init__(
+        self: Self,
+        guilds: int = 10,
+        members: int = 1000,
+        messages: int = 5000,
+        command_every: int = 10,
+        memory_members: int = 10000,
+        memory_messages: int = 1000,
+        cache_profile: str = "standard",
+        message_cache: str = "full",
+        guild_ready_timeout: float = 0.1,
+        compress: bool = True,
+        replay: Optional[str] = None,
+    ) -> None:
+        self.guilds = guilds
+        self.members = members
+        self.messages = messages
+        self.command_every = command_every
+        self.memory_members = memory_members
+        self.memory_messages = memory_messages
+        self.cache_profile = cache_profile
+        self.message_cache = message_cache
+        self.guild_ready_timeout = guild_ready_timeout
+        self.compress = compress
+        self.replay = replay
+
+    def to_dict(self: Self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Run:
+    """One bot connected to a fake Discord, the benchmarks run one after the other against it."""
+
+    def __init__(self: Self, options: Options) -> None:
+        self.options = options
+        self.results: Dict[str, float] = {}
+        guilds = [payloads.guild(payloads.snowflake(), options.members) for _ in range(options.guilds)]
+        self.guild_id = int(guilds[0][0]["id"])
+        self.channel_ids = guilds[0][1]
+        self.fake = FakeDiscord([guild for guild, _ in guilds], compress=options.compress)
+        self.bot: Optional[TinyBot] = None
+        self._connect: Optional[asyncio.Task] = None
+
+    async def _until(self: Self, predicate: Any, what: str) -> None:
+        deadline = time.perf_counter() + TIMEOUT
+        while not predicate():
+            if time.perf_counter() > deadline:
+                raise asyncio.TimeoutError(f"Timed out waiting for {what}")
+            await asyncio.sleep(0.001)
+
+    def _events(self: Self, name: str) -> int:
+        return self.bot.metrics.events[name]
+
+    async def startup(self: Self) -> None:
+        """Logging in, which includes ``setup_hook`` and loading the cogs, then connecting until ``on_ready``."""
+        started = time.perf_counter()
+        self.bot = TinyBot(
+            prefix="!",
+            owner_ids={payloads.OWNER_ID},
+            cache_profile=self.options.cache_profile,
+            message_cache=self.options.message_cache,
+            guild_ready_timeout=self.options.guild_ready_timeout,
+        )
+        await self.bot.login("bench")
+        logged_in = time.perf_counter()
+        self._connect = asyncio.create_task(self.bot.connect(reconnect=True))
+        await asyncio.wait_for(self.bot.wait_until_ready(), TIMEOUT)
+        ready = time.perf_counter()
+        self.results["startup.login_seconds"] = logged_in - started
+        self.results["startup.ready_seconds"] = ready - logged_in
+        self.results["startup.total_seconds"] = ready - started
+
+    async def throughput(self: Self) -> None:
+        """``MESSAGE_CREATE`` flood, every ``command_every``-th message runs a command that replies."""
+        options = self.options
+        flood = list(
+            payloads.message_flood(self.channel_ids, self.guild_id, options.messages, options.command_every)
+        )
+        commands = sum(1 for data in flood if data["content"].startswith("!"))
+        messages = self._events("message") + len(flood)
+        replies = self.fake.sent_messages + commands
+
+        started = time.perf_counter()
+        await self.fake.call(self.fake.dispatch(("MESSAGE_CREATE", data) for data in flood))
+        await self._until(lambda: self._events("message") >= messages, "the messages")
+        await self.fake.wait_for_messages(replies, TIMEOUT)
+        elapsed = time.perf_counter() - started
+        self.results["messages.per_second"] = len(flood) / elapsed
+        if commands:
+            self.results["messages.commands_per_second"] = commands / elapsed
+
+    async def resume(self: Self) -> None:
+        """A gateway ``RECONNECT``, until the shard resumed its session."""
+        resumed = self._events("shard_resumed") + 1
+        started = time.perf_counter()
+        await self.fake.call(self.fake.reconnect())
+        await self._until(lambda: self._events("shard_resumed") >= resumed, "the resume")
+        self.results["gateway.resume_seconds"] = time.perf_counter() - started
+
+    async def replay(self: Self) -> None:
+        """Recorded dispatches, until the bot received every one of them."""
+        events = payloads.load_recording(pathlib.Path(self.options.replay))
+        received = self._events("socket_event_type") + len(events)
+        started = time.perf_counter()
+        await self.fake.call(self.fake.dispatch(events))
+        await self._until(lambda: self._events("socket_event_type") >= received, "the recorded events")
+        self.results["replay.events_per_second"] = len(events) / (time.perf_counter() - started)
+
+    async def memory(self: Self) -> None:
+        """
+        Bytes the caches keep per member of a new guild and per cached message. Runs
+        before the flood, while the message cache is empty.
+        """
+        options = self.options
+        # Built before tracing, freeing them must not count.
+        guild, channel_ids = payloads.guild(payloads.snowflake(), options.memory_members)
+        guild_id = int(guild["id"])
+        guild_create = [("GUILD_CREATE", guild)]
+        flood = [
+            ("MESSAGE_CREATE", data)
+            for data in payloads.message_flood(channel_ids, guild_id, options.memory_messages, command_every=0)
+        ]
+        tracemalloc.start()
+        try:
+            gc.collect()
+            before = tracemalloc.get_traced_memory()[0]
+            await self.fake.call(self.fake.dispatch(guild_create))
+            await self._until(lambda: self.bot.get_guild(guild_id) is not None, "the guild")
+            gc.collect()
+            after = tracemalloc.get_traced_memory()[0]
+            self.results["memory.bytes_per_member"] = (after - before) / options.memory_members
+
+            messages = self._events("message") + len(flood)
+            cached = len(self.bot.cached_messages)
+            gc.collect()
+            before = tracemalloc.get_traced_memory()[0]
+            await self.fake.call(self.fake.dispatch(flood))
+            await self._until(lambda: self._events("message") >= messages, "the messages")
+            # Let the on_message tasks finish.
+            await asyncio.sleep(0.05)
+            gc.collect()
+            after = tracemalloc.get_traced_memory()[0]
+            # Only what the message cache kept counts, it evicts past its size.
+            cached = len(self.bot.cached_messages) - cached
+            if cached > 0:
+                self.results["memory.bytes_per_message"] = (after - before) / cached
+        finally:
+            tracemalloc.stop()
+
+    async def cog_load(self: Self) -> None:
+        """Unloads every cog and loads them again, as ``setup_hook`` does."""
+        bot = self.bot
+        names = [name for name in bot.cog_infos if f"tinybot.cogs.{name}" in bot.extensions]
+        for name in names:
+            await bot.unload_extension(f"tinybot.cogs.{name}")
+        started = time.perf_counter()
+        results = await load_cogs(bot, bot.cog_infos, names)
+        self.results["cogs.load_seconds"] = time.perf_counter() - started
+        for name, (_status, elapsed) in results.items():
+            self.results[f"cogs.{name}.load_seconds"] = elapsed
+
+    async def run(self: Self) -> Dict[str, float]:
+        self.fake.start()
+        try:
+            await self.startup()
+            await self.fake.call(self.fake.wait_connected())
+            await self.memory()
+            await self.throughput()
+            if self.options.replay:
+                await self.replay()
+            await self.resume()
+            await self.cog_load()
+        finally:
+            if self.bot is not None:
+                await self.bot.close()
+            if self._connect is not None:
+                await asyncio.gather(self._connect, return_exceptions=True)
+            self.fake.stop()
+        return self.results
+
+
+# Whether a higher value of a result is better, by the suffix of its name.
+HIGHER_IS_BETTER = ("per_second",)
+
+
+def higher_is_better(name: str) -> bool:
+    return name.endswith(HIGHER_IS_BETTER)
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=pathlib.Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "discord.py": discord.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+    }
+
+
+async def run_suite(options: Options, repeat: int = 3) -> Dict[str, Any]:
+    """
+    Runs the benchmarks ``repeat`` times, each on a fresh bot and fake Discord.
+
+    Returns
+    -------
+        Dict[str, Any]
+            The options, the environment and, per result, its median and every value.
+    """
+    runs: List[Dict[str, float]] = []
+    for i in range(repeat):
+        runs.append(await Run(options).run())
+        log.info("Run %s/%s done", i + 1, repeat)
+    names = sorted({name for run in runs for name in run})
+    return {
+        "options": options.to_dict(),
+        "environment": environment(),
+        "results": {
+            name: {
+                "median": statistics.median(run[name] for run in runs if name in run),
+                "values": [run[name] for run in runs if name in run],
+            }
+            for name in names
+        },
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> List[Dict[str, Any]]:
+    """
+    Compares the medians of two suite results.
+
+    Returns
+    -------
+        List[Dict[str, Any]]
+            One entry per result present in both, with the relative change, positive
+            when it got better, and whether it regressed by more than ``tolerance``.
+    """
+    rows = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        old, new = baseline["results"][name]["median"], result["median"]
+        if not old:
+            continue
+        change = (new - old) / old
+        if not higher_is_better(name):
+            change = -change
+        rows.append(
+            {"name": name, "baseline": old, "current": new, "change": change, "regressed": change < -tolerance}
+        )
+    return rows
@@ -1,13 +1,17 @@
 from __future__ import annotations
 
+import asyncio
 import collections
 import datetime
 import logging
 import os
+import pathlib
 import platform
-import traceback
+import time
 from typing import (
     Any,
+    Dict,
+    List,
     Optional,
     Sequence,
     Set,
@@ -18,8 +22,37 @@ from typing import (
 
 import aiohttp
 import discord
+import yarl
 from discord import app_commands
 from discord.ext import commands
+from discord.gateway import DiscordWebSocket
+from discord.shard import Shard
+
+from tinybot.core.cluster import IPC_TOKEN_ENV, Handler, IPCClient
+from tinybot.core.command_sync import CommandSyncer
+from tinybot.core.cooldowns import MemoryCooldowns, create_backend, use_backend
+from tinybot.core.errors import ErrorReporter
+from tinybot.core.executors import Executors, executors
+from tinybot.core.http import HTTPClient
+from tinybot.core.loader import (
+    CogInfo,
+    activate_libs,
+    discover_cogs,
+    downloader_path,
+    load_cogs,
+    log_load_times,
+)
+from tinybot.core.messages import MessageCache, MessageCacheState
+from tinybot.core.metrics import Metrics, MetricsServer
+from tinybot.core.outbox import SendQueue
+from tinybot.core.prefixes import PrefixCache
+from tinybot.core.profiler import LoopWatchdog
+from tinybot.core.profiles import CacheProfile, get_profile
+from tinybot.core.reloader import Reloader, watch_interval
+from tinybot.core.scheduler import CommandScheduler, CommandShed, command_priority, scheduler_key
+from tinybot.core.warm import WarmRestart
+from tinybot.db.engine import EngineRegistry, registry
+from tinybot.utils import get_rss
 
 log: logging.Logger = logging.getLogger("tinybot.bot")
 
@@ -60,6 +93,13 @@ class TinyBot(commands.AutoShardedBot):
         *args,
         prefix: str,
         owner_ids: Optional[Set[int]] = None,
+        cache_profile: str = "standard",
+        cluster_id: Optional[int] = None,
+        ipc_port: Optional[int] = None,
+        metrics_port: Optional[int] = None,
+        executor_threads: Optional[int] = None,
+        executor_processes: Optional[int] = None,
+        message_cache: Optional[str] = None,
         **kwargs: Any,
     ):
         if owner_ids is None:
@@ -71,63 +111,364 @@ class TinyBot(commands.AutoShardedBot):
 
         self.startup_time: Optional[datetime.timedelta] = None
 
-        intents: discord.Intents = discord.Intents.all()
+        self.cog_infos: Dict[str, CogInfo] = discover_cogs()
+
+        self.cache_profile: CacheProfile = get_profile(cache_profile).with_cogs(self.cog_infos.values())
+
+        # Per-guild prefixes, filled by the core cog.
+        self.prefixes: PrefixCache = PrefixCache([prefix])
+
+        # Backs cached_messages, bounded per channel and guild so busy channels only evict their own history.
+        self.message_cache: MessageCache = MessageCache(
+            mode=message_cache or os.getenv("MESSAGE_CACHE", "full"),  # type: ignore
+            size=int(os.getenv("MESSAGE_CACHE_SIZE", 1000)),
+            channel_size=int(os.getenv("MESSAGE_CACHE_CHANNEL_SIZE", 0)),
+            guild_size=int(os.getenv("MESSAGE_CACHE_GUILD_SIZE", 0)),
+        )
+
+        # Holds the state of every command cooldown, set before the help command is added.
+        # Shared between processes through the database with COOLDOWN_BACKEND=shared.
+        self.cooldowns: MemoryCooldowns = create_backend(os.getenv("COOLDOWN_BACKEND", "memory"))
 
         super().__init__(
             *args,
-            command_prefix=commands.when_mentioned_or(prefix),
-            member_cache_flags=discord.MemberCacheFlags.from_intents(intents),
+            message_cache=self.message_cache,
+            command_prefix=self.prefixes.command_prefix,
+            member_cache_flags=self.cache_profile.member_cache_flags,
             allowed_mentions=discord.AllowedMentions(
                 everyone=False, roles=False, users=True, replied_user=True
             ),
-            chunk_guilds_at_startup=True,
+            chunk_guilds_at_startup=self.cache_profile.chunk_guilds_at_startup,
             enable_debug_events=True,
-            intents=intents,
+            intents=self.cache_profile.intents,
             owner_ids=owner_ids,
             **kwargs,
         )
 
-        self.session: aiohttp.ClientSession = aiohttp.ClientSession(
+        # Shared by every cog calling an external API, ``self.session`` is its aiohttp session.
+        self.web: HTTPClient = HTTPClient(
+            limit=int(os.getenv("HTTP_LIMIT", 100)),
+            limit_per_host=int(os.getenv("HTTP_LIMIT_PER_HOST", 10)),
+            dns_ttl=int(os.getenv("HTTP_DNS_TTL", 300)),
+            keepalive=float(os.getenv("HTTP_KEEPALIVE", 30)),
+            cache_size=int(os.getenv("HTTP_CACHE_SIZE", 16 * 1024 * 1024)),
+            timeout=float(os.getenv("HTTP_TIMEOUT", 30)),
             headers={
                 "User-Agent": f"TinyBot (Python/{platform.python_version()} aiohttp/{aiohttp.__version__})"
-            }
+            },
         )
+        self.session: aiohttp.ClientSession = self.web.session
 
         self.color: discord.Color = discord.Color.dark_blue()
 
+        self.command_syncer: CommandSyncer = CommandSyncer(
+            self.tree, pathlib.Path(os.getenv("COMMAND_SYNC_PATH", "command_sync.json"))
+        )
+
+        self.db: EngineRegistry = registry
+
+        # Shared pools for blocking and CPU-bound cog work, see tinybot.core.executors.offload.
+        executors.configure(threads=executor_threads, processes=executor_processes)
+        self.executors: Executors = executors
+
+        # Command name -> lazy cog that provides it, until that cog is loaded.
+        self.lazy_commands: Dict[str, str] = {}
+        self._lazy_lock: asyncio.Lock = asyncio.Lock()
+
+        self._chunk_tasks: Dict[int, asyncio.Task] = {}
+
+        # Bounds the commands running at once, in total and per guild.
+        self.scheduler: CommandScheduler = CommandScheduler(
+            limit=int(os.getenv("COMMAND_CONCURRENCY", 100)),
+            guild_limit=int(os.getenv("COMMAND_GUILD_CONCURRENCY", 5)),
+            queue_size=int(os.getenv("COMMAND_QUEUE_SIZE", 1000)),
+            guild_queue_size=int(os.getenv("COMMAND_GUILD_QUEUE_SIZE", 20)),
+            max_wait=float(os.getenv("COMMAND_MAX_WAIT", 30)),
+        )
+
+        # Merges bursts of replies per channel and paces them by its rate limit, opt-in, see send_message().
+        self.send_queue: Optional[SendQueue] = None
+        if os.getenv("SEND_QUEUE", "").lower() in ("1", "true", "yes"):
+            self.send_queue = SendQueue(window=float(os.getenv("SEND_QUEUE_WINDOW", 0.05)))
+
+        self.reloader: Reloader = Reloader(self)
+
+        self.errors: ErrorReporter = ErrorReporter(
+            self,
+            interval=float(os.getenv("ERROR_REPORT_INTERVAL", 60)),
+            max_reports=int(os.getenv("ERROR_REPORT_MAX", 5)),
+        )
+
+        self.cluster_id: Optional[int] = cluster_id
+        # Commands cogs expose to the other clusters, see broadcast().
+        self.ipc_handlers: Dict[str, Handler] = {}
+        self.ipc: Optional[IPCClient] = None
+        if cluster_id is not None and ipc_port is not None:
+            self.ipc = IPCClient(cluster_id, ipc_port, os.environ[IPC_TOKEN_ENV], self.ipc_handlers)
+
+        # Resumes the gateway sessions of the previous run instead of identifying, opt-in.
+        self.warm: Optional[WarmRestart] = None
+        if os.getenv("WARM_RESTART", "").lower() in ("1", "true", "yes"):
+            name = "bot" if cluster_id is None else f"cluster{cluster_id}"
+            self.warm = WarmRestart(
+                pathlib.Path(os.getenv("WARM_RESTART_PATH", "warm_restart")) / f"{name}.json.gz",
+                max_age=float(os.getenv("WARM_RESTART_MAX_AGE", 120)),
+            )
+
+        self.metrics: Metrics = Metrics(self)
+        # Logs the loop steps blocking longer than this many seconds, 0 to disable.
+        self.watchdog: LoopWatchdog = LoopWatchdog(threshold=float(os.getenv("WATCHDOG_THRESHOLD", 0.5)))
+        self.ipc_handlers["metrics"] = self._collect_metrics
+        self.metrics_server: Optional[MetricsServer] = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(
+                self._collect_metrics, metrics_port, os.getenv("METRICS_HOST", "127.0.0.1")
+            )
+
+    def _get_state(self, **options: Any) -> MessageCacheState:
+        return MessageCacheState(
+            dispatch=self.dispatch, handlers=self._handlers, hooks=self._hooks, http=self.http, **options
+        )
+
+    async def _collect_metrics(self) -> List[Dict[str, Any]]:
+        return self.metrics.collect()
+
+    def dispatch(self, event_name: str, /, *args: Any, **kwargs: Any) -> None:
+        self.metrics.on_dispatch(event_name, args)
+        if self.warm is not None and event_name in ("shard_resumed", "shard_connect"):
+            self.warm.on_shard_event(self, event_name, args[0])
+        super().dispatch(event_name, *args, **kwargs)
+
+    async def launch_shard(self, gateway: yarl.URL, shard_id: int, *, initial: bool = False) -> None:
+        session = await self.warm.session(self, shard_id) if self.warm is not None else None
+        if session is None:
+            await super().launch_shard(gateway, shard_id, initial=initial)
+            return
+        try:
+            ws = await asyncio.wait_for(
+                DiscordWebSocket.from_client(
+                    self,
+                    initial=initial,
+                    gateway=yarl.URL(session["resume_url"]),
+                    shard_id=shard_id,
+                    session=session["session_id"],
+                    sequence=session["sequence"],
+                    resume=True,
+                ),
+                timeout=60.0,
+            )
+        except Exception:
+            log.warning("Shard %s could not connect to resume its session, identifying", shard_id, exc_info=True)
+            self.warm.discard(shard_id)
+            await super().launch_shard(gateway, shard_id, initial=initial)
+            return
+        # What AutoShardedClient.launch_shard does with an identified connection.
+        shard = self._AutoShardedClient__shards[shard_id] = Shard(ws, self, self._AutoShardedClient__queue.put_nowait)
+        shard.launch()
+
+    async def process_commands(self, message: discord.Message, /) -> None:
+        if message.author.bot:
+            return
+        # Most messages are not commands, skip building a context for them.
+        if self.prefixes.match(message) is None:
+            return
+        ctx = await self.get_context(message)
+        await self.invoke(ctx)
+
     async def get_context(
         self, message: Union[discord.Message, InteractionT], /, *, cls: Optional[commands.Context] = None
     ) -> commands.Context:
-        return await super(self.__class__, self).get_context(message, cls=cls if cls else commands.Context) # noqa
+        ctx = await super(self.__class__, self).get_context(message, cls=cls if cls else commands.Context) # noqa
+        if (
+            ctx.command is None
+            and ctx.prefix is not None
+            and ctx.invoked_with in self.lazy_commands
+            and isinstance(message, discord.Message)
+        ):
+            await self.load_lazy_cog(self.lazy_commands[ctx.invoked_with])
+            ctx = await super(self.__class__, self).get_context(message, cls=cls if cls else commands.Context) # noqa
+        return ctx
 
     @property
     def all_cogs(self) -> collections.ChainMap[Any, Any]:
         return collections.ChainMap(self.cogs)
 
+    async def broadcast(self, command: str, **data: Any) -> List[Dict[str, Any]]:
+        """
+        Runs the IPC handler ``command`` on every cluster, or only on this process
+        when the bot is not running as a cluster.
+
+        Returns
+        -------
+            List[Dict[str, Any]]
+                One ``{"cluster_id", "data", "error"}`` dict per cluster.
+        """
+        if self.ipc is not None and self.ipc.connected:
+            return await self.ipc.broadcast(command, **data)
+
+        response: Dict[str, Any] = {"cluster_id": self.cluster_id or 0, "data": None, "error": None}
+        try:
+            response["data"] = await self.ipc_handlers[command](**data)
+        except Exception as e:
+            log.exception("Command %s failed", command)
+            response["error"] = f"{type(e).__name__}: {e}"
+        return [response]
+
     async def setup_hook(self) -> None:
-        cogs = [
-            f"tinybot.cogs.{cog if not cog.endswith('.py') else cog[:-3]}"
-            for cog in os.listdir('tinybot/cogs')
-            if not cog.startswith("_")
-        ]
-        for cog in cogs:
+        self.prefixes.set_user(self.user)
+
+        self.metrics.start()
+        if self.watchdog.threshold > 0:
+            self.watchdog.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+
+        if self.ipc is not None:
+            await self.ipc.connect()
+
+        await self.cooldowns.start()
+
+        # Requirements of the cogs installed by the downloader.
+        activate_libs(downloader_path())
+
+        for info in self.cog_infos.values():
+            if info.lazy:
+                self.lazy_commands.update({command: info.name for command in info.commands})
+
+        started = time.perf_counter()
+        results = await load_cogs(
+            self, self.cog_infos, [name for name, info in self.cog_infos.items() if not info.lazy]
+        )
+        log_load_times(results, time.perf_counter() - started)
+
+        # Application commands are global, a single cluster syncs them.
+        if os.getenv("SYNC_COMMANDS_ON_START", "").lower() in ("1", "true", "yes") and self.cluster_id in (None, 0):
             try:
-                await self.load_extension(cog)
-                log.info(f"Loaded cog: {cog}")
-            except Exception:
-                log.exception(f"Failed to load cog: {cog}", exc_info=True)
+                await self.sync_commands(None)
+            except discord.HTTPException:
+                log.exception("Could not sync application commands")
+
+        interval = watch_interval()
+        if interval is not None:
+            self.reloader.start_watching(interval)
+
+    def add_command(self, command: commands.Command, /) -> None:
+        use_backend(command, self.cooldowns)
+        super().add_command(command)
+
+    async def load_extension(self, name: str, *, package: Optional[str] = None) -> None:
+        await super().load_extension(name, package=package)
+        # Also called by reload_extension, so the snapshot follows reloads.
+        self.reloader.snapshot(self._resolve_name(name, package))
+
+    async def unload_extension(self, name: str, *, package: Optional[str] = None) -> None:
+        await super().unload_extension(name, package=package)
+        self.reloader.forget(self._resolve_name(name, package))
+
+    async def load_lazy_cog(self, name: str) -> None:
+        async with self._lazy_lock:
+            if f"tinybot.cogs.{name}" in self.extensions:
+                return
+            started = time.perf_counter()
+            results = await load_cogs(self, self.cog_infos, [name])
+            log_load_times(results, time.perf_counter() - started)
+            self.lazy_commands = {
+                command: cog for command, cog in self.lazy_commands.items() if cog not in results
+            }
 
-    async def sync_commands(self, guild: discord.Guild | None) -> None:
+    async def ensure_chunked(self, guild: discord.Guild) -> None:
+        """
+        Chunks ``guild`` if it has not been yet, sharing one request between concurrent callers.
+
+        Cogs call this before relying on ``guild.members``. Commands of cogs that set
+        ``chunk_guilds`` in their ``info.json`` do it automatically.
+        """
+        if guild.chunked or not self.cache_profile.intents.members:
+            return
+        task = self._chunk_tasks.get(guild.id)
+        if task is None:
+            task = asyncio.create_task(guild.chunk(cache=True))
+            self._chunk_tasks[guild.id] = task
+            task.add_done_callback(lambda _: self._chunk_tasks.pop(guild.id, None))
+        await asyncio.shield(task)
+
+    def cog_info_for(self, command: commands.Command) -> Optional[CogInfo]:
+        module = command.module.split(".")
+        if len(module) > 2 and module[:2] == ["tinybot", "cogs"]:
+            return self.cog_infos.get(module[2])
+        return None
+
+    async def invoke(self, ctx: commands.Context) -> None:
+        if ctx.command is None:
+            await super().invoke(ctx)
+            return
+        try:
+            async with self.scheduler.slot(scheduler_key(ctx), command_priority(ctx)):
+                if ctx.guild is not None:
+                    info = self.cog_info_for(ctx.command)
+                    if info is not None and info.chunk_guilds:
+                        await self.ensure_chunked(ctx.guild)
+                started = time.perf_counter()
+                try:
+                    await super().invoke(ctx)
+                finally:
+                    self.metrics.on_command(ctx.command.qualified_name, time.perf_counter() - started)
+        except CommandShed as error:
+            self.dispatch("command_error", ctx, error)
+
+    async def send_message(
+        self,
+        destination: Union[commands.Context, discord.abc.Messageable],
+        content: Optional[str] = None,
+        **kwargs: Any,
+    ) -> discord.Message:
+        """
+        Sends a message through the send queue when it is enabled, otherwise right away.
+
+        Replies to interactions are never queued, they have to be sent within three
+        seconds and can be ephemeral. Queued messages may be merged with others sent
+        to the same channel, their callers then get the same message.
+
+        Returns
+        -------
+            discord.Message
+        """
+        if self.send_queue is None or (isinstance(destination, commands.Context) and destination.interaction):
+            return await destination.send(content, **kwargs)
+        kwargs.pop("ephemeral", None)
+        return await self.send_queue.send(destination, content, **kwargs)
+
+    async def sync_commands(self, guild: discord.abc.Snowflake | None, force: bool = False) -> bool:
+        """
+        Syncs the application commands of ``guild``, or the global ones, when they
+        changed since the last sync. Global commands are copied to ``guild`` first.
+
+        Returns
+        -------
+            bool
+                Whether a sync request was sent.
+        """
+        guild = discord.Object(id=guild.id) if guild else None
+        if guild:
+            self.tree.copy_global_to(guild=guild)
+        return await self.command_syncer.sync(guild, force=force)
+
+    def command_diff(self, guild: discord.abc.Snowflake | None) -> Dict[str, List[str]]:
+        """The commands :meth:`sync_commands` would add, change or remove, without syncing."""
+        guild = discord.Object(id=guild.id) if guild else None
         if guild:
-            self.tree.copy_global_to(guild=discord.Object(id=guild.id))
-        await self.tree.sync(guild=discord.Object(id=guild.id) if guild else None)
+            self.tree.copy_global_to(guild=guild)
+        return self.command_syncer.diff(guild)
 
     async def on_command_error(self, ctx: commands.Context, error: commands.CommandError) -> None:
+        self.metrics.on_command_error(
+            ctx.command.qualified_name if ctx.command else None, getattr(error, "original", error)
+        )
         if isinstance(error, commands.MissingRequiredArgument):
             await ctx.send_help(ctx.command)
         elif isinstance(error, commands.BadArgument):
             if error.args:
-                await ctx.send(error.args[0], ephemeral=True)
+                await self.send_message(ctx, error.args[0], ephemeral=True)
             else:
                 await ctx.send_help(ctx.command)
         elif isinstance(error, commands.CommandOnCooldown):
@@ -146,20 +487,15 @@ class TinyBot(commands.AutoShardedBot):
                 commands.BucketType.category: "for this channel category",
                 commands.BucketType.role: "for your role",
             }
-            await ctx.send(
-                f"This command is on cooldown {cooldowns[error.type]}!\nTry again in {error.retry_after} seconds.",
+            await self.send_message(
+                ctx,
+                f"This command is on cooldown {cooldowns[error.type]}!\nTry again in {error.retry_after:.1f} seconds.",
                 ephemeral=True,
             )
         elif isinstance(error, commands.CommandInvokeError):
-            log.exception(
-                "Exception in command '%s'", ctx.command.qualified_name, exc_info=error.original
-            )
-            exception_log = "Exception in command '{}'\n" "".format(ctx.command.qualified_name)
-            exception_log += "".join(
-                traceback.format_exception(type(error), error, error.__traceback__)
-            )
-
-            await ctx.send(
+            self.errors.record(error.original, ctx.command.qualified_name)
+            await self.send_message(
+                ctx,
                 "Oops, something went wrong! This error has been forwarded to the bot owner.",
                 ephemeral=True,
             )
@@ -167,21 +503,18 @@ class TinyBot(commands.AutoShardedBot):
             if isinstance(
                 error.original, (commands.CommandInvokeError, app_commands.CommandInvokeError)
             ):
-                log.exception(
-                    "Exception in command '%s'", ctx.command.qualified_name, exc_info=error
-                )
-                exception_log = "Exception in command '{}'\n" "".format(ctx.command.qualified_name)
-                exception_log += "".join(
-                    traceback.format_exception(type(error), error, error.__traceback__)
+                self.errors.record(
+                    getattr(error.original, "original", error.original), ctx.command.qualified_name
                 )
-
-                await ctx.send(
+                await self.send_message(
+                    ctx,
                     "Oops, something went wrong! This error has been forwarded to the bot owner.",
                     ephemeral=True,
                 )
             else:
-                await ctx.send(error.original.args[0], ephemeral=True)
-        elif isinstance(error, commands.CommandNotFound):
+                await self.send_message(ctx, error.original.args[0], ephemeral=True)
+        elif isinstance(error, (commands.CommandNotFound, CommandShed)):
+            # Replying to shed commands would only add to the load.
             pass
         else:
             log.error(type(error).__name__, exc_info=error)
@@ -207,12 +540,34 @@ class TinyBot(commands.AutoShardedBot):
             log.info("|   ╚═╝   ╚═╝╚═╝  ╚═══╝   ╚═╝        ╚═════╝ ╚═╝╚══════╝ ╚═════╝ ╚═════╝ ╚═╝  ╚═╝╚═════╝ ╚═════╝  ╚═════╝    ╚═╝   |")
             log.info('--------------------------------------------------------------------------------------------------------------------')
             log.info(f"Discord.py: {discord.__version__} | Servers: {len(self.guilds)} | Users: {(sum(len(i.members) for i in self.guilds)):,}")
+            rss = get_rss()
+            log.info(f"Cache profile: {self.cache_profile.name} | Memory: {f'{rss / 1_048_576:,.1f} MiB' if rss else 'unknown'}")
             log.info('--------------------------------------------------------------------------------------------------------------------')
             log.info(f'Startup Time: {self.startup_time.total_seconds():.2f} seconds')
             log.info('--------------------------------------------------------------------------------------------------------------------')
             log.info(f'Owners: {", ".join(str(i) for i in self.owner_ids)}')
             log.info('--------------------------------------------------------------------------------------------------------------------')
+            if self.ipc is not None:
+                await self.ipc.send_ready()
 
     async def close(self) -> None:
-        await self.session.close()
+        if self.warm is not None and self.is_ready and not self.is_closed():
+            try:
+                await self.warm.save(self)
+            except Exception:
+                log.exception("Could not save the state for a warm restart")
+        if self.ipc is not None:
+            await self.ipc.close()
+        await self.reloader.stop_watching()
+        await self.errors.close()
+        await self.metrics.close()
+        self.watchdog.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.send_queue is not None:
+            await self.send_queue.close()
+        await self.web.close()
+        await self.executors.close()
+        await self.cooldowns.close()
+        await self.db.close()
         await super().close()
@@ -18,4 +18,44 @@ def parse_cli_flags() -> tuple[argparse.Namespace, list[str]]:
         type=int,
         help="A list of user IDs that have owner access to the bot."
     )
+    parser.add_argument(
+        "--cache-profile",
+        choices=["minimal", "standard", "full"],
+        default="standard",
+        help="Which intents and caches to use. 'minimal' caches no members, 'standard' chunks "
+        "guilds on demand and 'full' enables every intent and chunks every guild at startup.",
+    )
+    parser.add_argument(
+        "--clusters",
+        type=int,
+        default=None,
+        help="Run the bot as this many processes, each owning a contiguous range of shards.",
+    )
+    parser.add_argument(
+        "--shards-per-cluster",
+        type=int,
+        default=1,
+        help="How many shards each cluster runs when using --clusters.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics, from the launcher when using --clusters.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Workers of the thread pool cogs offload blocking work to, min(32, CPUs + 4) by default.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Workers of the process pool cogs offload CPU-bound work to, one per CPU by default.",
+    )
+    # Set by the cluster launcher on the processes it spawns.
+    parser.add_argument("--cluster-id", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--ipc-port", type=int, default=None, help=argparse.SUPPRESS)
     return parser.parse_known_args()
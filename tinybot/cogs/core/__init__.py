@@ -1,7 +1,22 @@
+import logging
+
 from tinybot.bot import TinyBot
 
 from .main import Owner
 
+log = logging.getLogger("tinybot.cogs.core")
+
 
 async def setup(bot: TinyBot):
     await bot.add_cog(Owner(bot))
+    if bot.db.db_type is None:
+        log.warning("DB_TYPE is not set, per-guild prefixes are disabled.")
+        return
+    # Owner commands, reload included, stay available when the database is unreachable.
+    # Importing the tables already connects to Postgres.
+    try:
+        from .prefixes import Prefixes
+
+        await bot.add_cog(Prefixes(bot))
+    except Exception:
+        log.exception("Could not load per-guild prefixes, reload the core cog to try again.")
@@ -1,84 +1,360 @@
+import asyncio
+import io
 import logging
+import time
+from typing import Any, Dict, List, Literal, Optional
 
+import discord
 from discord.ext import commands
 
 from tinybot.bot import TinyBot
+from tinybot.core.profiler import SamplingProfiler
 
 log = logging.getLogger("tinybot.cogs.owner")
 
 
+def format_responses(responses: List[Dict[str, Any]]) -> str:
+    """Formats the responses of a broadcast, prefixing them with their cluster when there are several."""
+    if len(responses) == 1:
+        response = responses[0]
+        return response["data"] if response["error"] is None else f"Failed: {response['error']}"
+    return "\n".join(
+        f"Cluster {r['cluster_id']}: {r['data'] if r['error'] is None else 'Failed: ' + r['error']}"
+        for r in responses
+        if r["data"] is not None or r["error"] is not None
+    )
+
+
 class Owner(commands.Cog):
     def __init__(self, bot: TinyBot):
         self.bot: TinyBot = bot
+        self.profiler: SamplingProfiler = SamplingProfiler()
 
-    @commands.command(name="test")
-    @commands.is_owner()
-    async def test_command(self, ctx: commands.Context):
-        await ctx.send("Beep Boop")
+    async def cog_load(self) -> None:
+        self.bot.ipc_handlers.update(
+            shutdown=self._shutdown,
+            reload=self._reload,
+            unload=self._unload,
+            load=self._load,
+            sync=self._sync,
+            stats=self._stats,
+        )
 
-    @commands.command()
-    @commands.is_owner()
-    async def shutdown(self, ctx: commands.Context):
+    async def cog_unload(self) -> None:
+        for command in ("shutdown", "reload", "unload", "load", "sync", "stats"):
+            self.bot.ipc_handlers.pop(command, None)
+
+    async def _shutdown(self) -> str:
         log.info("Shutting down...")
-        await ctx.send("Shutting down...")
-        await self.bot.close()
+        # Give the response time to reach the other clusters before closing.
+        asyncio.get_running_loop().call_later(1, lambda: asyncio.ensure_future(self.bot.close()))
+        return "Shutting down..."
 
-    @commands.command()
-    @commands.is_owner()
-    async def reload(self, ctx: commands.Context, cog_name: str):
+    async def _reload(self, cog_name: str) -> str:
+        if cog_name == "changed":
+            return self._format_reloaded(await self.bot.reloader.reload_changed())
         try:
             await self.bot.reload_extension(f"tinybot.cogs.{cog_name}")
         except commands.ExtensionNotLoaded:
-            await ctx.send(f"Cog `{cog_name}` was not loaded.")
+            return f"Cog `{cog_name}` was not loaded."
         except commands.ExtensionNotFound:
-            await ctx.send(f"Cannot find cog with name `{cog_name}`.")
+            return f"Cannot find cog with name `{cog_name}`."
         except commands.NoEntryPointError:
-            await ctx.send(f"Cog `{cog_name}` does not includes a `setup()` function.")
+            return f"Cog `{cog_name}` does not includes a `setup()` function."
         except commands.ExtensionFailed as e:
-            await ctx.send(
-                f"Cog with name `{cog_name}` could not be reloaded. See logs for more details."
-            )
             log.error(
                 "Cog package with name `%s` could not be reloaded.",
                 cog_name,
                 exc_info=e.original,
             )
+            return f"Cog with name `{cog_name}` could not be reloaded. See logs for more details."
         else:
-            await ctx.send(f"Reloaded `{cog_name}`.")
+            return f"Reloaded `{cog_name}`."
 
-    @commands.is_owner()
-    @commands.command()
-    async def unload(self, ctx: commands.Context, cog_name: str) -> None:
+    @staticmethod
+    def _format_reloaded(results: Dict[str, str]) -> str:
+        if not results:
+            return "Nothing changed."
+        lines = []
+        reloaded = [name.rsplit(".", 1)[-1] for name, status in results.items() if status == "reloaded"]
+        failed = [name.rsplit(".", 1)[-1] for name, status in results.items() if status == "failed"]
+        if reloaded:
+            lines.append(f"Reloaded {', '.join(f'`{name}`' for name in reloaded)}.")
+        if failed:
+            lines.append(
+                f"Could not reload {', '.join(f'`{name}`' for name in failed)}, "
+                "kept the previous version. See logs for more details."
+            )
+        return " ".join(lines)
+
+    async def _unload(self, cog_name: str) -> str:
         try:
             await self.bot.unload_extension(f"tinybot.cogs.{cog_name}")
         except commands.ExtensionNotLoaded:
-            await ctx.send(f"Cog `{cog_name}` was not loaded.")
+            return f"Cog `{cog_name}` was not loaded."
         else:
-            await ctx.send(f"Unloaded `{cog_name}`.")
+            return f"Unloaded `{cog_name}`."
 
-    @commands.is_owner()
-    @commands.command()
-    async def load(self, ctx: commands.Context, cog_name: str) -> None:
+    async def _load(self, cog_name: str) -> str:
         try:
             await self.bot.load_extension(f"tinybot.cogs.{cog_name}")
         except commands.ExtensionAlreadyLoaded:
-            await ctx.send(f"Cog `{cog_name}` is already loaded.")
+            return f"Cog `{cog_name}` is already loaded."
         except commands.ExtensionNotFound:
-            await ctx.send(f"Cannot find cog with name `{cog_name}.")
+            return f"Cannot find cog with name `{cog_name}."
         except commands.NoEntryPointError:
-            await ctx.send(f"Cog `{cog_name}` does not have a `setup()` function.")
+            return f"Cog `{cog_name}` does not have a `setup()` function."
         except commands.ExtensionFailed as e:
-            await ctx.send(f"Cog `{cog_name}` could not be loaded. See logs for more details.")
             log.error(
                 "Cog `%s` could not be loaded.",
                 cog_name,
                 exc_info=e.original,
             )
+            return f"Cog `{cog_name}` could not be loaded. See logs for more details."
         else:
-            await ctx.send(f"Loaded `{cog_name}`.")
+            return f"Loaded `{cog_name}`."
+
+    async def _sync(self, guild_id: Optional[int] = None, force: bool = False, dry_run: bool = False) -> Optional[str]:
+        # Application commands are global, a single cluster syncs them.
+        if self.bot.cluster_id not in (None, 0):
+            return None
+        guild = discord.Object(id=guild_id) if guild_id else None
+        if dry_run:
+            diff = self.bot.command_diff(guild)
+            lines = [
+                f"{sign} {name}"
+                for sign, key in (("+", "added"), ("~", "changed"), ("-", "removed"))
+                for name in diff[key]
+            ]
+            return "```diff\n" + "\n".join(lines) + "\n```" if lines else "No changes to sync."
+        if await self.bot.sync_commands(guild, force=force):
+            return "Done."
+        return "No changes to sync, use `sync force` to sync anyway."
+
+    async def _stats(self) -> Dict[str, Any]:
+        return {
+            "guilds": len(self.bot.guilds),
+            "users": sum(guild.member_count or 0 for guild in self.bot.guilds),
+            "shards": len(self.bot.shards),
+            "latency": self.bot.latency,
+        }
+
+    @commands.command(name="test")
+    @commands.is_owner()
+    async def test_command(self, ctx: commands.Context):
+        await ctx.send("Beep Boop")
+
+    @commands.command()
+    @commands.is_owner()
+    async def shutdown(self, ctx: commands.Context):
+        await ctx.send("Shutting down...")
+        await self.bot.broadcast("shutdown")
+
+    @commands.command()
+    @commands.is_owner()
+    async def reload(self, ctx: commands.Context, cog_name: str):
+        """Reloads a cog, or every cog whose files changed with `reload changed`."""
+        await ctx.send(format_responses(await self.bot.broadcast("reload", cog_name=cog_name)))
+
+    @commands.is_owner()
+    @commands.command()
+    async def unload(self, ctx: commands.Context, cog_name: str) -> None:
+        await ctx.send(format_responses(await self.bot.broadcast("unload", cog_name=cog_name)))
+
+    @commands.is_owner()
+    @commands.command()
+    async def load(self, ctx: commands.Context, cog_name: str) -> None:
+        await ctx.send(format_responses(await self.bot.broadcast("load", cog_name=cog_name)))
+
+    @commands.is_owner()
+    @commands.command()
+    async def sync(
+        self, ctx: commands.Context, option: Optional[Literal["diff", "force"]] = None, guild_id: Optional[int] = None
+    ):
+        """Syncs application commands if they changed. `diff` only shows what would change."""
+        await ctx.send(
+            format_responses(
+                await self.bot.broadcast(
+                    "sync", guild_id=guild_id, force=option == "force", dry_run=option == "diff"
+                )
+            )
+        )
+
+    @commands.is_owner()
+    @commands.command()
+    async def stats(self, ctx: commands.Context):
+        responses = await self.bot.broadcast("stats")
+        lines = []
+        for response in responses:
+            if response["error"] is not None:
+                lines.append(f"Cluster {response['cluster_id']}: Failed: {response['error']}")
+                continue
+            data = response["data"]
+            lines.append(
+                f"Cluster {response['cluster_id']}: {data['guilds']:,} servers, {data['users']:,} users, "
+                f"{data['shards']} shards, {data['latency'] * 1000:.0f}ms"
+            )
+        stats = [r["data"] for r in responses if r["error"] is None]
+        lines.append(
+            f"Total: {sum(s['guilds'] for s in stats):,} servers, {sum(s['users'] for s in stats):,} users, "
+            f"{sum(s['shards'] for s in stats)} shards"
+        )
+        await ctx.send("\n".join(lines))
+
+    @commands.is_owner()
+    @commands.command()
+    async def profile(self, ctx: commands.Context, seconds: float = 10.0):
+        """Samples the event loop of this cluster and sends the collapsed stacks, for flamegraph tools."""
+        if self.profiler.running:
+            await ctx.send("The profiler is already running.")
+            return
+        seconds = max(1.0, min(seconds, 120.0))
+        await ctx.send(f"Profiling for {seconds:.0f}s...")
+        samples = await self.profiler.profile(seconds)
+        if not samples:
+            await ctx.send("No samples were taken.")
+            return
+        top = "\n".join(f"{share:6.1%} {name}" for name, share in self.profiler.top(10))
+        cluster = "" if self.bot.cluster_id is None else f"-cluster{self.bot.cluster_id}"
+        await ctx.send(
+            f"{sum(samples.values())} samples, most often running:\n```\n{top}\n```",
+            file=discord.File(
+                io.BytesIO(self.profiler.collapsed().encode()), filename=f"profile{cluster}-{int(time.time())}.txt"
+            ),
+        )
+
+    @commands.is_owner()
+    @commands.command()
+    async def watchdog(self, ctx: commands.Context, option: Optional[str] = None):
+        """Lists the last slow event loop steps. `on`, `off` or a threshold in seconds control the watchdog."""
+        watchdog = self.bot.watchdog
+        if option == "off":
+            watchdog.stop()
+            await ctx.send("Watchdog stopped.")
+            return
+        if option is not None:
+            if option != "on":
+                try:
+                    threshold = float(option)
+                except ValueError:
+                    await ctx.send_help(ctx.command)
+                    return
+                watchdog.stop()
+                watchdog.threshold = max(0.01, threshold)
+            watchdog.start()
+            await ctx.send(f"Watchdog reports loop steps longer than {watchdog.threshold}s.")
+            return
+
+        state = f"running, threshold {watchdog.threshold}s" if watchdog.running else "stopped"
+        if not watchdog.slow_steps:
+            await ctx.send(f"Watchdog {state}, no slow steps.")
+            return
+        lines = [
+            f"<t:{int(step.when)}:R> {step.duration:.3f}s by {step.owner} in {step.task}"
+            for step in reversed(watchdog.slow_steps)
+        ]
+        last = watchdog.slow_steps[-1].stack[-1500:]
+        await ctx.send(f"Watchdog {state}.\n" + "\n".join(lines[:10]) + f"\nLast stack:\n```py\n{last}```")
+
+    @commands.is_owner()
+    @commands.command()
+    async def httpstats(self, ctx: commands.Context):
+        stats = self.bot.web.stats()
+        lines = [
+            f"cache: {stats['cache_entries']} entries, {stats['cache_bytes'] / 1024:.0f} KiB, "
+            f"{stats['inflight']} in flight"
+        ]
+        for host, host_stats in sorted(stats["hosts"].items(), key=lambda item: -item[1]["requests"]):
+            lines.append(
+                f"{host}: {host_stats['requests']} requests, {host_stats['errors']} errors, "
+                f"avg {host_stats['latency_avg'] * 1000:.0f}ms, max {host_stats['latency_max'] * 1000:.0f}ms, "
+                f"hit rate {host_stats['hit_rate']:.0%}, {host_stats['coalesced']} coalesced"
+            )
+        await ctx.send("```\n" + "\n".join(lines[:20]) + "\n```")
+
+    @commands.is_owner()
+    @commands.command()
+    async def scheduler(self, ctx: commands.Context):
+        stats = self.bot.scheduler.stats()
+        lines = [
+            f"running: {stats['running']}/{stats['limit'] or 'unlimited'}, "
+            f"{stats['guild_limit'] or 'unlimited'} per guild",
+            f"queued: {stats['queued']} ("
+            + ", ".join(f"{name.lower()} {count}" for name, count in stats["queued_by_priority"].items())
+            + ")",
+            f"wait: avg {stats['wait_avg'] * 1000:.0f}ms, max {stats['wait_max'] * 1000:.0f}ms",
+            "shed: " + (", ".join(f"{reason} {count}" for reason, count in stats["shed"].items()) or "none"),
+        ]
+        lines.extend(f"guild {key}: {depth} queued" for key, depth in stats["busiest"])
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @commands.is_owner()
+    @commands.command()
+    async def executors(self, ctx: commands.Context):
+        stats = self.bot.executors.stats()
+        lines = [
+            f"{kind}: {pool['workers']} workers, {pool['utilization']:.0%} busy, {pool['inflight']} in flight "
+            f"({pool['queued']} queued), {pool['completed']} done, {pool['failed']} failed, "
+            f"{pool['timeouts']} timed out, {pool['cancelled']} cancelled"
+            for kind, pool in stats.items()
+        ]
+        await ctx.send("```\n" + ("\n".join(lines) or "No pool was used yet.") + "\n```")
+
+    @commands.is_owner()
+    @commands.command()
+    async def messagecache(self, ctx: commands.Context):
+        stats = self.bot.message_cache.stats()
+        lines = [
+            f"mode: {stats['mode']}, {stats['messages']}/{stats['size']} messages in {stats['channels']} channels "
+            f"of {stats['guilds']} guilds",
+            f"limits: {stats['channel_size'] or 'none'} per channel, {stats['guild_size'] or 'none'} per guild",
+            f"memory: ~{stats['bytes'] / 1024:.0f} KiB, ~{stats['bytes_per_message']:.0f} bytes per message",
+            "evicted: " + (", ".join(f"{reason} {count}" for reason, count in stats["evicted"].items()) or "none"),
+        ]
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @commands.is_owner()
+    @commands.command()
+    async def sendqueue(self, ctx: commands.Context):
+        if self.bot.send_queue is None:
+            await ctx.send("The send queue is disabled, set SEND_QUEUE=1 to enable it.")
+            return
+        stats = self.bot.send_queue.stats()
+        lines = [
+            f"{stats['messages']} messages in {stats['requests']} requests ({stats['merged']} merged), "
+            f"{stats['pending']} pending in {stats['channels']} channels",
+            f"wait: avg {stats['wait_avg'] * 1000:.0f}ms",
+        ]
+        lines.extend(
+            f"channel {channel_id}: {queue['pending']} pending, {queue['messages']} messages in "
+            f"{queue['requests']} requests, wait avg {queue['wait_avg'] * 1000:.0f}ms "
+            f"max {queue['wait_max'] * 1000:.0f}ms, {queue['remaining']}/{queue['limit']} left"
+            for channel_id, queue in stats["busiest"].items()
+        )
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @commands.is_owner()
+    @commands.command()
+    async def cooldowns(self, ctx: commands.Context):
+        stats = self.bot.cooldowns.stats()
+        lines = [
+            f"backend: {stats['backend']}, {stats['windows']} open windows in {stats['expiry_buckets']} expiry buckets",
+            f"{stats['uses']} uses, {stats['limited']} on cooldown, {stats['expired']} windows expired",
+        ]
+        if stats["backend"] == "shared":
+            lines.append(
+                f"sync: {'running' if stats['syncing'] else 'stopped'}, {stats['syncs']} syncs, "
+                f"{stats['pushed']} rows written, {stats['pulled']} read, {stats['errors']} errors, "
+                f"last {stats['sync_seconds'] * 1000:.0f}ms"
+            )
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
 
     @commands.is_owner()
     @commands.command()
-    async def sync(self, ctx: commands.Context):
-        await self.bot.sync_commands()
-        await ctx.send("Done.")
+    async def dbstats(self, ctx: commands.Context):
+        stats = self.bot.db.stats()
+        lines = [
+            f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}"
+            for key, value in stats.items()
+        ]
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
@@ -0,0 +1,92 @@
+import json
+import logging
+from typing import List, Optional
+
+from discord.ext import commands
+
+from tinybot.bot import TinyBot
+from tinybot.db.cache import SettingsCache
+
+from .tables import GuildPrefixes, db
+
+log = logging.getLogger("tinybot.cogs.prefixes")
+
+MAX_PREFIXES = 10
+MAX_PREFIX_LENGTH = 20
+
+
+class Prefixes(commands.Cog):
+    """
+    Per-guild prefixes.
+
+    Every stored prefix is loaded into ``bot.prefixes`` once, messages are then matched
+    in memory. Changes are written behind by a ``SettingsCache`` and sent to every
+    cluster.
+    """
+
+    def __init__(self, bot: TinyBot):
+        self.bot: TinyBot = bot
+        self.settings: Optional[SettingsCache] = None
+
+    async def cog_load(self) -> None:
+        await db.setup([GuildPrefixes])
+        self.settings = SettingsCache(db, GuildPrefixes, GuildPrefixes.guild_id)
+        try:
+            await self._load_prefixes()
+        except Exception:
+            await self.settings.close()
+            raise
+        self.bot.ipc_handlers["prefixes"] = self._set_prefixes
+
+    async def cog_unload(self) -> None:
+        self.bot.ipc_handlers.pop("prefixes", None)
+        if self.settings is not None:
+            await self.settings.close()
+
+    async def _load_prefixes(self) -> None:
+        rows = await GuildPrefixes.select(GuildPrefixes.guild_id, GuildPrefixes.prefixes).where(
+            GuildPrefixes.prefixes != "[]"
+        )
+        self.bot.prefixes.invalidate()
+        for row in rows:
+            self.bot.prefixes.set(row["guild_id"], json.loads(row["prefixes"]))
+        log.info("Loaded the prefixes of %s guilds", len(self.bot.prefixes))
+
+    async def _set_prefixes(self, guild_id: int, prefixes: List[str]) -> None:
+        # Run on every cluster, the cached row may be an old copy of what another cluster wrote.
+        self.bot.prefixes.set(guild_id, prefixes)
+        self.settings.invalidate(guild_id)
+
+    async def _store(self, guild_id: int, prefixes: List[str]) -> None:
+        await self.settings.set(guild_id, prefixes=json.dumps(prefixes))
+        await self.bot.broadcast("prefixes", guild_id=guild_id, prefixes=prefixes)
+
+    @commands.guild_only()
+    @commands.group(invoke_without_command=True)
+    async def prefix(self, ctx: commands.Context):
+        """Shows the prefixes of this server."""
+        prefixes = self.bot.prefixes.prefixes(ctx.guild.id)
+        await ctx.send(f"Prefixes: {', '.join(f'`{prefix}`' for prefix in prefixes)} or mentioning me.")
+
+    @commands.has_guild_permissions(manage_guild=True)
+    @prefix.command(name="set")
+    async def prefix_set(self, ctx: commands.Context, *prefixes: str):
+        """Replaces the prefixes of this server."""
+        prefixes = list(dict.fromkeys(prefix.strip() for prefix in prefixes if prefix.strip()))
+        if not prefixes:
+            await ctx.send_help(ctx.command)
+            return
+        if len(prefixes) > MAX_PREFIXES or any(len(prefix) > MAX_PREFIX_LENGTH for prefix in prefixes):
+            await ctx.send(
+                f"A server can have up to {MAX_PREFIXES} prefixes of at most {MAX_PREFIX_LENGTH} characters."
+            )
+            return
+        await self._store(ctx.guild.id, prefixes)
+        await ctx.send(f"Prefixes set to {', '.join(f'`{prefix}`' for prefix in prefixes)}.")
+
+    @commands.has_guild_permissions(manage_guild=True)
+    @prefix.command(name="reset")
+    async def prefix_reset(self, ctx: commands.Context):
+        """Restores the default prefixes."""
+        await self._store(ctx.guild.id, [])
+        await ctx.send(f"Prefixes reset to {', '.join(f'`{p}`' for p in self.bot.prefixes.default.prefixes)}.")
@@ -0,0 +1,14 @@
+import os
+
+from piccolo.columns import BigInt, Text
+from piccolo.table import Table
+
+from tinybot.db.engine import DBEngine
+
+db = DBEngine(path=os.getcwd(), cog_name="Core")
+
+
+class GuildPrefixes(Table, db=db.connect()):
+    guild_id = BigInt(unique=True)
+    # JSON list, an empty list means the default prefixes.
+    prefixes = Text(default="[]")
@@ -3,13 +3,30 @@ class Git:
     clone_no_branch = (
         "git -c credential.helper= -c core.askpass= clone --recurse-submodules {url} {folder}"
     )
+    clone_shallow = (
+        "git clone -c credential.helper= -c core.askpass= --depth 1 --recurse-submodules "
+        "--shallow-submodules -b {branch} {url} {folder}"
+    )
+    clone_shallow_no_branch = (
+        "git -c credential.helper= -c core.askpass= clone --depth 1 --recurse-submodules "
+        "--shallow-submodules {url} {folder}"
+    )
     current_branch = "git -C {path} symbolic-ref --short HEAD"
     current_commit = "git -C {path} rev-parse HEAD"
     latest_commit = "git -C {path} rev-parse {branch}"
+    remote_commit = "git -c credential.helper= -c core.askpass= ls-remote {url} refs/heads/{branch}"
     hard_reset = "git -C {path} reset --hard origin/{branch} -q"
+    fetch = "git -c credential.helper= -c core.askpass= -C {path} fetch -q origin {branch}"
     pull = "git -c credential.helper= -c core.askpass= -C {path} pull --recurse-submodules -q --ff-only"
-    diff_file_status = "git -C {path} diff-tree --no-commit-id --name-status -r -z --line-prefix='\t' {old_rev} {new_rev}"
+    diff_file_status = "git -C {path} diff-tree --no-commit-id --name-status -r -z {old_rev} {new_rev}"
     log = "git -C {path} log --relative-date --reverse {old_rev}.. {relative_file_path}"
     remote_url = "git -C {path} config --get remote.origin.url"
     checkout = "git -C {path} checkout {rev}"
     pip_install = "{python} -m pip install -U -t {target_dir} {reqs}"
+    pip_install_requirements = (
+        "{python} -m pip install --no-input --disable-pip-version-check -U -t {target_dir} -r {requirements}"
+    )
+    pip_install_requirements_offline = (
+        "{python} -m pip install --no-input --disable-pip-version-check -U -t {target_dir} "
+        "--no-index --find-links {find_links} -r {requirements}"
+    )
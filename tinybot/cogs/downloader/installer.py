@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import hashlib
+import importlib.metadata
+import json
+import logging
+import os
+import pathlib
+import re
+import shutil
+import sys
+from typing import Awaitable, Callable, Iterable, List, Optional, Self
+
+from tinybot.core.loader import activate_libs, libs_path
+
+from .const import Git
+
+log = logging.getLogger("tinybot.cogs.downloader")
+
+_NAME_RE = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)")
+
+
+def normalize_requirement(requirement: str) -> str:
+    """Lowercases the project name and normalizes separators as in PEP 503, keeping the rest as is."""
+    requirement = requirement.split("#", 1)[0].strip()
+    match = _NAME_RE.match(requirement)
+    if not match:
+        return requirement
+    name = re.sub(r"[-_.]+", "-", match.group(1)).lower()
+    return name + requirement[match.end():].replace(" ", "")
+
+
+def cog_requirements(cog_path: pathlib.Path) -> List[str]:
+    """Reads the requirements of a cog from its ``info.json`` and ``requirements.txt``."""
+    requirements = []
+    info_file = cog_path / "info.json"
+    if info_file.exists():
+        requirements.extend(json.loads(info_file.read_text(encoding="utf-8")).get("requirements", []))
+    requirements_file = cog_path / "requirements.txt"
+    if requirements_file.exists():
+        requirements.extend(
+            line for line in requirements_file.read_text(encoding="utf-8").splitlines()
+            if line.strip() and not line.strip().startswith(("#", "-"))
+        )
+    return requirements
+
+
+class DependencyInstaller:
+    """
+    Installs the requirements of every installed cog at once.
+
+    Requirements are merged, deduplicated and resolved by a single pip run into a
+    directory named after the hash of the requirement set and Python version. When
+    the set did not change, that directory already exists and pip is not run at all.
+    Setting ``find_links`` installs offline from that wheel directory.
+
+    Parameters
+    ----------
+    data_path: pathlib.Path
+        Downloader data directory, libraries go to its ``libs`` folder.
+    run: Callable[..., Awaitable[str]]
+        Runs a command template, ``RepoManager.run``.
+    find_links: Optional[str]
+        Local wheel directory to install from without network access.
+    """
+
+    def __init__(
+        self: Self,
+        data_path: pathlib.Path,
+        run: Callable[..., Awaitable[str]],
+        find_links: Optional[str] = None,
+    ) -> None:
+        self.path = libs_path(data_path)
+        self.data_path = data_path
+        self.run = run
+        self.find_links = find_links
+
+    @staticmethod
+    def merge(requirements: Iterable[str]) -> List[str]:
+        """Deduplicates requirements. Different specifiers of one project are all kept, pip intersects them."""
+        return sorted({normalize_requirement(r) for r in requirements if normalize_requirement(r)})
+
+    @staticmethod
+    def key(requirements: List[str]) -> str:
+        payload = "\n".join([f"python{sys.version_info.major}.{sys.version_info.minor}", *requirements])
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+    @property
+    def current(self: Self) -> Optional[str]:
+        current_file = self.path / "current"
+        return current_file.read_text(encoding="utf-8").strip() if current_file.exists() else None
+
+    async def sync(self: Self, cog_paths: Iterable[pathlib.Path]) -> bool:
+        """
+        Makes sure the requirements of ``cog_paths`` are installed and active.
+
+        Parameters
+        ----------
+        cog_paths: Iterable[pathlib.Path]
+            Directories of the installed cogs.
+
+        Returns
+        -------
+            bool
+                Whether pip had to run.
+        """
+        requirements = self.merge(r for path in cog_paths for r in cog_requirements(path))
+        shadowed = [r for r in requirements if self._provided(r)]
+        if shadowed:
+            log.warning(
+                "Cog requirements already installed with the bot, its versions are used: %s", ", ".join(shadowed)
+            )
+        key = self.key(requirements)
+        target = self.path / key
+        ran_pip = False
+
+        if requirements and not (target / ".complete").exists():
+            self.path.mkdir(parents=True, exist_ok=True)
+            staging = self.path / f"{key}.tmp"
+            shutil.rmtree(staging, ignore_errors=True)
+            staging.mkdir()
+            requirements_file = staging / "requirements.txt"
+            requirements_file.write_text("\n".join(requirements), encoding="utf-8")
+            log.info("Installing %s requirements into %s", len(requirements), key)
+            try:
+                if self.find_links:
+                    await self.run(
+                        Git.pip_install_requirements_offline,
+                        python=sys.executable,
+                        target_dir=staging,
+                        find_links=self.find_links,
+                        requirements=requirements_file,
+                    )
+                else:
+                    await self.run(
+                        Git.pip_install_requirements,
+                        python=sys.executable,
+                        target_dir=staging,
+                        requirements=requirements_file,
+                    )
+            except Exception:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+            (staging / ".complete").touch()
+            shutil.rmtree(target, ignore_errors=True)
+            os.replace(staging, target)
+            ran_pip = True
+
+        if self.current != key:
+            previous = self.current
+            self.path.mkdir(parents=True, exist_ok=True)
+            target.mkdir(exist_ok=True)
+            (self.path / "current").write_text(key, encoding="utf-8")
+            activate_libs(self.data_path)
+            self._prune(keep={key, previous})
+        return ran_pip
+
+    def _provided(self: Self, requirement: str) -> bool:
+        """Whether the project of ``requirement`` is installed with the bot, e.g. discord.py."""
+        match = _NAME_RE.match(requirement)
+        if not match:
+            return False
+        try:
+            distribution = importlib.metadata.distribution(match.group(1))
+        except importlib.metadata.PackageNotFoundError:
+            return False
+        return not str(pathlib.Path(distribution.locate_file("")).resolve()).startswith(str(self.path.resolve()))
+
+    def _prune(self: Self, keep: set) -> None:
+        """Removes library directories other than the current and previous ones."""
+        for entry in self.path.iterdir():
+            if entry.is_dir() and entry.name not in keep:
+                shutil.rmtree(entry, ignore_errors=True)
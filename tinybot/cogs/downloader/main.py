@@ -1,8 +1,13 @@
 import logging
+import os
 
 from discord.ext import commands
 
 from tinybot.bot import TinyBot
+from tinybot.core.loader import COGS_PATH, discover_cogs, downloader_path
+
+from .installer import DependencyInstaller
+from .repo_manager import GitError, RepoManager
 
 log = logging.getLogger("tinybot.cogs.owner")
 
@@ -10,3 +15,140 @@ log = logging.getLogger("tinybot.cogs.owner")
 class Downloader(commands.Cog):
     def __init__(self, bot: TinyBot):
         self.bot: TinyBot = bot
+        self.manager: RepoManager = RepoManager(
+            data_path=downloader_path(),
+            install_path=COGS_PATH,
+            max_workers=int(os.getenv("DOWNLOADER_WORKERS", 4)),
+        )
+        self.installer: DependencyInstaller = DependencyInstaller(
+            data_path=downloader_path(),
+            run=self.manager.run,
+            find_links=os.getenv("DOWNLOADER_WHEELS"),
+        )
+
+    async def install_requirements(self) -> str:
+        """Installs the merged requirements of every installed cog, returns an error message on failure."""
+        try:
+            await self.installer.sync(COGS_PATH / cog for cog, _, _ in self.manager.installed_cogs())
+        except GitError as e:
+            log.error("Could not install cog requirements: %s", e)
+            return "Could not install the requirements, see logs for more details."
+        return ""
+
+    @commands.is_owner()
+    @commands.group()
+    async def repo(self, ctx: commands.Context):
+        if ctx.invoked_subcommand is None:
+            await ctx.send_help(ctx.command)
+
+    @repo.command(name="add")
+    async def repo_add(self, ctx: commands.Context, name: str, url: str, branch: str = None):
+        async with ctx.typing():
+            try:
+                repo = await self.manager.add_repo(name, url, branch)
+            except (GitError, ValueError) as e:
+                await ctx.send(f"Could not add `{name}`: {e}")
+                return
+        await ctx.send(
+            f"Added `{name}` at `{repo.commit[:7]}`. Cogs: {', '.join(repo.available_cogs) or 'none'}"
+        )
+
+    @repo.command(name="remove")
+    async def repo_remove(self, ctx: commands.Context, name: str):
+        if name not in self.manager.repos:
+            await ctx.send(f"There is no repo named `{name}`.")
+            return
+        for cog in self.manager.repos[name].cogs:
+            if f"tinybot.cogs.{cog}" in self.bot.extensions:
+                await self.bot.broadcast("unload", cog_name=cog)
+        await self.manager.remove_repo(name)
+        # Deactivates the requirements only the removed cogs needed.
+        error = await self.install_requirements()
+        await ctx.send(f"Removed `{name}`." + (f"\n{error}" if error else ""))
+
+    @repo.command(name="list")
+    async def repo_list(self, ctx: commands.Context):
+        if not self.manager.repos:
+            await ctx.send("No repos added.")
+            return
+        await ctx.send(
+            "\n".join(
+                f"`{repo.name}` ({repo.branch} @ {repo.commit[:7]}): {', '.join(repo.cogs) or 'no cogs installed'}"
+                for repo in self.manager.repos.values()
+            )
+        )
+
+    @repo.command(name="update")
+    async def repo_update(self, ctx: commands.Context, *names: str):
+        unknown = [name for name in names if name not in self.manager.repos]
+        if unknown:
+            await ctx.send(f"Unknown repos: {', '.join(unknown)}")
+            return
+        async with ctx.typing():
+            updated = await self.manager.update(names or None)
+        if not updated:
+            await ctx.send("Everything is up to date.")
+            return
+
+        lines = []
+        error = await self.install_requirements()
+        if error:
+            lines.append(error)
+        self.bot.cog_infos.update(discover_cogs())
+        for repo, cogs in updated.items():
+            lines.append(f"`{repo}` updated, changed cogs: {', '.join(sorted(cogs)) or 'none'}")
+            for cog in sorted(cogs):
+                if f"tinybot.cogs.{cog}" in self.bot.extensions:
+                    await self.bot.broadcast("reload", cog_name=cog)
+                    lines.append(f"Reloaded `{cog}`.")
+        await ctx.send("\n".join(lines))
+
+    @commands.is_owner()
+    @commands.group()
+    async def cog(self, ctx: commands.Context):
+        if ctx.invoked_subcommand is None:
+            await ctx.send_help(ctx.command)
+
+    @cog.command(name="install")
+    async def install_cog(self, ctx: commands.Context, repo: str, cog_name: str):
+        if repo not in self.manager.repos:
+            await ctx.send(f"There is no repo named `{repo}`.")
+            return
+        if (COGS_PATH / cog_name).exists() and cog_name not in self.manager.repos[repo].cogs:
+            await ctx.send(f"A cog named `{cog_name}` already exists.")
+            return
+        try:
+            self.manager.install_cog(repo, cog_name)
+        except ValueError as e:
+            await ctx.send(str(e))
+            return
+        async with ctx.typing():
+            error = await self.install_requirements()
+        if error:
+            await ctx.send(error)
+            return
+        self.bot.cog_infos.update(discover_cogs())
+        await ctx.send(f"Installed `{cog_name}`. Use `load {cog_name}` to load it.")
+
+    @cog.command(name="uninstall")
+    async def uninstall_cog(self, ctx: commands.Context, cog_name: str):
+        if f"tinybot.cogs.{cog_name}" in self.bot.extensions:
+            await self.bot.broadcast("unload", cog_name=cog_name)
+        try:
+            self.manager.uninstall_cog(cog_name)
+        except ValueError as e:
+            await ctx.send(str(e))
+            return
+        self.bot.cog_infos.pop(cog_name, None)
+        error = await self.install_requirements()
+        await ctx.send(f"Uninstalled `{cog_name}`." + (f"\n{error}" if error else ""))
+
+    @cog.command(name="list")
+    async def list_cogs(self, ctx: commands.Context):
+        installed = self.manager.installed_cogs()
+        if not installed:
+            await ctx.send("No cogs installed.")
+            return
+        await ctx.send(
+            "\n".join(f"`{cog}` from `{repo}` @ {commit[:7]}" for cog, repo, commit in installed)
+        )
@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import shlex
+import shutil
+from typing import Any, Dict, Iterable, List, Optional, Self, Set, Tuple
+
+from .const import Git
+
+log = logging.getLogger("tinybot.cogs.downloader")
+
+
+class GitError(Exception):
+    """A git command exited with a non-zero status."""
+
+
+class Repo:
+    """
+    A cloned repository and the cogs installed from it.
+
+    ``cogs`` maps each installed cog to the commit it was installed at.
+    """
+
+    __slots__ = ("name", "url", "branch", "commit", "cogs", "path")
+
+    def __init__(
+        self: Self,
+        name: str,
+        url: str,
+        branch: str,
+        path: pathlib.Path,
+        commit: str = "",
+        cogs: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.name = name
+        self.url = url
+        self.branch = branch
+        self.path = path
+        self.commit = commit
+        self.cogs = cogs or {}
+
+    @property
+    def available_cogs(self: Self) -> List[str]:
+        """Top level packages of the repo that have an ``__init__.py``."""
+        return sorted(
+            entry.name
+            for entry in self.path.iterdir()
+            if entry.is_dir() and not entry.name.startswith((".", "_")) and (entry / "__init__.py").exists()
+        )
+
+    def to_dict(self: Self) -> Dict[str, Any]:
+        return {"url": self.url, "branch": self.branch, "commit": self.commit, "cogs": self.cogs}
+
+
+class RepoManager:
+    """
+    Clones and updates cog repositories with asyncio subprocesses.
+
+    At most ``max_workers`` git processes run at once, whatever the number of repos.
+    Repos are cloned shallowly, and ``index.json`` keeps the known commit of every repo
+    and the cogs installed from it, so checking for updates only asks the remotes for
+    their latest commit and repos that did not move are never pulled or diffed.
+
+    Parameters
+    ----------
+    data_path: pathlib.Path
+        Where the repos and the index are stored.
+    install_path: pathlib.Path
+        Where installed cogs are copied to.
+    max_workers: int
+        Maximum number of concurrent git processes.
+    """
+
+    def __init__(self: Self, data_path: pathlib.Path, install_path: pathlib.Path, max_workers: int = 4) -> None:
+        self.data_path = data_path
+        self.repos_path = data_path / "repos"
+        self.index_path = data_path / "index.json"
+        self.install_path = install_path
+        self.repos: Dict[str, Repo] = {}
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._load_index()
+
+    def _load_index(self: Self) -> None:
+        if not self.index_path.exists():
+            return
+        data = json.loads(self.index_path.read_text(encoding="utf-8"))
+        for name, repo in data.items():
+            self.repos[name] = Repo(name=name, path=self.repos_path / name, **repo)
+
+    def save_index(self: Self) -> None:
+        self.data_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        tmp_path.write_text(
+            json.dumps({name: repo.to_dict() for name, repo in self.repos.items()}, indent=4),
+            encoding="utf-8",
+        )
+        os.replace(tmp_path, self.index_path)
+
+    async def run(self: Self, command: str, **kwargs: Any) -> str:
+        """
+        Runs a ``Git`` command template and returns its stdout.
+
+        Raises
+        ------
+            GitError
+        """
+        args = shlex.split(command.format(**{key: shlex.quote(str(value)) for key, value in kwargs.items()}))
+        async with self._semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+            )
+            stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise GitError(f"{' '.join(args[:4])}... failed: {stderr.decode(errors='replace').strip()}")
+        return stdout.decode(errors="replace")
+
+    async def add_repo(self: Self, name: str, url: str, branch: Optional[str] = None) -> Repo:
+        if name in self.repos:
+            raise ValueError(f"A repo named {name} already exists.")
+        path = self.repos_path / name
+        self.repos_path.mkdir(parents=True, exist_ok=True)
+        if branch:
+            await self.run(Git.clone_shallow, branch=branch, url=url, folder=path)
+        else:
+            await self.run(Git.clone_shallow_no_branch, url=url, folder=path)
+            branch = (await self.run(Git.current_branch, path=path)).strip()
+        commit = (await self.run(Git.current_commit, path=path)).strip()
+        repo = self.repos[name] = Repo(name=name, url=url, branch=branch, path=path, commit=commit)
+        self.save_index()
+        return repo
+
+    async def remove_repo(self: Self, name: str) -> None:
+        repo = self.repos.pop(name)
+        for cog in list(repo.cogs):
+            shutil.rmtree(self.install_path / cog, ignore_errors=True)
+        await asyncio.to_thread(shutil.rmtree, repo.path, True)
+        self.save_index()
+
+    def install_cog(self: Self, repo_name: str, cog: str) -> None:
+        """Copies ``cog`` from its repo into the install path."""
+        repo = self.repos[repo_name]
+        if cog not in repo.available_cogs:
+            raise ValueError(f"Repo {repo_name} has no cog named {cog}.")
+        for other in self.repos.values():
+            if other is not repo and cog in other.cogs:
+                raise ValueError(f"Cog {cog} is already installed from {other.name}.")
+        self._copy_cog(repo, cog)
+        repo.cogs[cog] = repo.commit
+        self.save_index()
+
+    def uninstall_cog(self: Self, cog: str) -> None:
+        for repo in self.repos.values():
+            if repo.cogs.pop(cog, None) is not None:
+                shutil.rmtree(self.install_path / cog, ignore_errors=True)
+                self.save_index()
+                return
+        raise ValueError(f"Cog {cog} is not installed.")
+
+    def _copy_cog(self: Self, repo: Repo, cog: str) -> None:
+        target = self.install_path / cog
+        if target.exists():
+            shutil.rmtree(target)
+        shutil.copytree(repo.path / cog, target, ignore=shutil.ignore_patterns("__pycache__", "*.pyc"))
+
+    async def remote_commit(self: Self, repo: Repo) -> Optional[str]:
+        output = await self.run(Git.remote_commit, url=repo.url, branch=repo.branch)
+        return output.split()[0] if output.strip() else None
+
+    async def check_updates(self: Self, names: Optional[Iterable[str]] = None) -> Dict[str, str]:
+        """
+        Asks the remotes of the repos for their latest commit, all at once.
+
+        Returns
+        -------
+            Dict[str, str]
+                The repos whose remote moved, mapped to their new commit.
+        """
+        repos = [self.repos[name] for name in names] if names is not None else list(self.repos.values())
+        results = await asyncio.gather(*(self.remote_commit(repo) for repo in repos), return_exceptions=True)
+        outdated = {}
+        for repo, result in zip(repos, results):
+            if isinstance(result, BaseException):
+                log.error("Could not check %s for updates: %s", repo.name, result)
+            elif result is not None and result != repo.commit:
+                outdated[repo.name] = result
+        return outdated
+
+    async def changed_files(self: Self, repo: Repo, old_rev: str, new_rev: str) -> Set[str]:
+        output = await self.run(Git.diff_file_status, path=repo.path, old_rev=old_rev, new_rev=new_rev)
+        # -z output alternates status and path, renames and copies have two paths.
+        fields = [field.strip() for field in output.split("\0")]
+        changed, i = set(), 0
+        while i < len(fields) and fields[i]:
+            status = fields[i]
+            count = 2 if status[0] in "RC" else 1
+            changed.update(fields[i + 1 : i + 1 + count])
+            i += 1 + count
+        return changed
+
+    async def _update_repo(self: Self, repo: Repo) -> Set[str]:
+        old_commit = repo.commit
+        try:
+            await self.run(Git.pull, path=repo.path)
+        except GitError:
+            # History was rewritten upstream, follow it.
+            await self.run(Git.fetch, path=repo.path, branch=repo.branch)
+            await self.run(Git.hard_reset, path=repo.path, branch=repo.branch)
+        repo.commit = (await self.run(Git.current_commit, path=repo.path)).strip()
+        if repo.commit == old_commit:
+            return set()
+
+        files = await self.changed_files(repo, old_commit, repo.commit)
+        changed_cogs = {path.split("/", 1)[0] for path in files} & set(repo.cogs)
+        for cog in list(changed_cogs):
+            if (repo.path / cog).is_dir():
+                self._copy_cog(repo, cog)
+            else:
+                log.warning("Cog %s was removed from %s, keeping the installed copy", cog, repo.name)
+                changed_cogs.discard(cog)
+        for cog in repo.cogs:
+            repo.cogs[cog] = repo.commit
+        return changed_cogs
+
+    async def update(self: Self, names: Optional[Iterable[str]] = None) -> Dict[str, Set[str]]:
+        """
+        Pulls the repos whose remote moved and reinstalls the cogs that changed.
+
+        Returns
+        -------
+            Dict[str, Set[str]]
+                The updated repos mapped to their installed cogs whose files changed.
+        """
+        outdated = await self.check_updates(names)
+        repos = [self.repos[name] for name in outdated]
+        results = await asyncio.gather(*(self._update_repo(repo) for repo in repos), return_exceptions=True)
+        updated = {}
+        for repo, result in zip(repos, results):
+            if isinstance(result, BaseException):
+                log.error("Could not update %s: %s", repo.name, result)
+            else:
+                updated[repo.name] = result
+        self.save_index()
+        return updated
+
+    def installed_cogs(self: Self) -> List[Tuple[str, str, str]]:
+        """Returns ``(cog, repo, commit)`` for every installed cog."""
+        return sorted(
+            (cog, repo.name, commit) for repo in self.repos.values() for cog, commit in repo.cogs.items()
+        )
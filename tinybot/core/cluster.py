@@ -0,0 +1,465 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import secrets
+import sys
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Self, Set
+
+from tinybot.core.metrics import Family, MetricsServer, family
+
+log = logging.getLogger("tinybot.cluster")
+
+IPC_TOKEN_ENV = "TINYBOT_IPC_TOKEN"
+
+# Exit code of a cluster that cannot start (e.g. a bad token), which is not restarted.
+EXIT_FATAL = 2
+# Seconds a cluster has to run for its restart backoff to start over.
+STABLE_AFTER = 300.0
+
+# Longest IPC line accepted, the metrics of a cluster are sent as one line.
+LINE_LIMIT = 16 * 1024 * 1024
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+def cluster_shard_ids(cluster_id: int, shards_per_cluster: int) -> List[int]:
+    """Returns the contiguous shard range owned by ``cluster_id``."""
+    return list(range(cluster_id * shards_per_cluster, (cluster_id + 1) * shards_per_cluster))
+
+
+async def _send(writer: asyncio.StreamWriter, payload: Dict[str, Any]) -> None:
+    writer.write(json.dumps(payload).encode() + b"\n")
+    await writer.drain()
+
+
+async def _readline(reader: asyncio.StreamReader) -> Optional[bytes]:
+    """
+    Returns the next line, or None at the end of the stream.
+
+    Lines longer than ``LINE_LIMIT`` are skipped rather than failing the connection,
+    the message they carried is lost and its sender times out.
+    """
+    while True:
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError as e:
+            log.error("Skipped an IPC message longer than %s bytes", LINE_LIMIT)
+            await reader.readexactly(e.consumed)
+            while True:
+                try:
+                    await reader.readuntil(b"\n")
+                    break
+                except asyncio.LimitOverrunError as e:
+                    await reader.readexactly(e.consumed)
+
+
+class IPCHub:
+    """
+    Local IPC server run by the launcher.
+
+    Clusters connect over localhost with a JSON-lines protocol. A cluster sends a
+    ``broadcast`` with a command, the hub forwards it to every connected cluster,
+    collects their ``response`` and returns them all to the sender in one ``responses``.
+    The launcher itself can send commands with :meth:`broadcast`.
+    """
+
+    def __init__(self: Self, token: str, timeout: float = 10.0) -> None:
+        self.token = token
+        self.timeout = timeout
+        self.port: Optional[int] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: Dict[int, asyncio.StreamWriter] = {}
+        self.ready: Dict[int, asyncio.Event] = {}
+        self._pending: Dict[str, Dict[str, Any]] = {}
+
+    async def start(self: Self) -> None:
+        self.server = await asyncio.start_server(self._handle, host="127.0.0.1", port=0, limit=LINE_LIMIT)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self: Self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def ready_event(self: Self, cluster_id: int) -> asyncio.Event:
+        return self.ready.setdefault(cluster_id, asyncio.Event())
+
+    async def _handle(self: Self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        cluster_id: Optional[int] = None
+        try:
+            hello = json.loads(await _readline(reader) or b"{}")
+            if hello.get("op") != "hello" or not secrets.compare_digest(
+                str(hello.get("token", "")), self.token
+            ):
+                log.warning("Rejected IPC connection with a bad handshake")
+                return
+            cluster_id = int(hello["cluster_id"])
+            self.clients[cluster_id] = writer
+            log.info("Cluster %s connected to IPC", cluster_id)
+
+            while (line := await _readline(reader)) is not None:
+                message = json.loads(line)
+                op = message.get("op")
+                if op == "ready":
+                    self.ready_event(cluster_id).set()
+                elif op == "broadcast":
+                    await self._broadcast(cluster_id, message)
+                elif op == "response":
+                    await self._collect(message)
+        except (ConnectionError, asyncio.IncompleteReadError, json.JSONDecodeError, KeyError, ValueError):
+            log.exception("IPC connection of cluster %s failed", cluster_id)
+        finally:
+            if cluster_id is not None and self.clients.get(cluster_id) is writer:
+                del self.clients[cluster_id]
+                self.ready_event(cluster_id).clear()
+                log.info("Cluster %s disconnected from IPC", cluster_id)
+                for nonce in list(self._pending):
+                    pending = self._pending[nonce]
+                    if cluster_id in pending["waiting"]:
+                        pending["waiting"].discard(cluster_id)
+                        pending["responses"].append(
+                            {"cluster_id": cluster_id, "data": None, "error": "disconnected"}
+                        )
+                        await self._maybe_finish(nonce)
+            writer.close()
+
+    async def broadcast(self: Self, command: str, **data: Any) -> List[Dict[str, Any]]:
+        """
+        Runs ``command`` on every connected cluster from the launcher.
+
+        Returns
+        -------
+            List[Dict[str, Any]]
+                One ``{"cluster_id", "data", "error"}`` dict per cluster.
+        """
+        nonce = secrets.token_hex(8)
+        future = asyncio.get_running_loop().create_future()
+        await self._broadcast(None, {"nonce": nonce, "command": command, "data": data}, future)
+        return await future
+
+    async def _broadcast(
+        self: Self, origin: Optional[int], message: Dict[str, Any], future: Optional[asyncio.Future] = None
+    ) -> None:
+        nonce = message["nonce"]
+        targets = dict(self.clients)
+        self._pending[nonce] = {
+            "origin": origin,
+            "future": future,
+            "waiting": set(targets),
+            "responses": [],
+            "timer": asyncio.get_running_loop().call_later(
+                self.timeout, lambda: asyncio.ensure_future(self._finish(nonce))
+            ),
+        }
+        command = {"op": "command", "nonce": nonce, "command": message["command"], "data": message["data"]}
+        for cluster_id, writer in targets.items():
+            try:
+                await _send(writer, command)
+            except ConnectionError:
+                self._pending[nonce]["waiting"].discard(cluster_id)
+        await self._maybe_finish(nonce)
+
+    async def _collect(self: Self, message: Dict[str, Any]) -> None:
+        pending = self._pending.get(message["nonce"])
+        if pending is None:
+            return
+        pending["waiting"].discard(message["cluster_id"])
+        pending["responses"].append(
+            {"cluster_id": message["cluster_id"], "data": message.get("data"), "error": message.get("error")}
+        )
+        await self._maybe_finish(message["nonce"])
+
+    async def _maybe_finish(self: Self, nonce: str) -> None:
+        if nonce in self._pending and not self._pending[nonce]["waiting"]:
+            await self._finish(nonce)
+
+    async def _finish(self: Self, nonce: str) -> None:
+        pending = self._pending.pop(nonce, None)
+        if pending is None:
+            return
+        pending["timer"].cancel()
+        for cluster_id in pending["waiting"]:
+            pending["responses"].append({"cluster_id": cluster_id, "data": None, "error": "timed out"})
+        responses = sorted(pending["responses"], key=lambda r: r["cluster_id"])
+        if pending["future"] is not None:
+            if not pending["future"].done():
+                pending["future"].set_result(responses)
+            return
+        writer = self.clients.get(pending["origin"])
+        if writer is not None:
+            try:
+                await _send(writer, {"op": "responses", "nonce": nonce, "responses": responses})
+            except ConnectionError:
+                pass
+
+
+class IPCClient:
+    """
+    Connection of a cluster to the launcher's IPCHub.
+
+    Incoming commands are dispatched to ``handlers``, which map a command name
+    to a coroutine taking the command's data as keyword arguments. A lost
+    connection is retried until :meth:`close`, with a growing delay.
+    """
+
+    def __init__(
+        self: Self, cluster_id: int, port: int, token: str, handlers: Dict[str, Handler], timeout: float = 30.0
+    ) -> None:
+        self.cluster_id = cluster_id
+        self.port = port
+        self.token = token
+        self.handlers = handlers
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._nonces = itertools.count()
+        self._waiters: Dict[str, asyncio.Future] = {}
+        # Commands running, referenced so they are not garbage collected.
+        self._commands: Set[asyncio.Task] = set()
+        # Sent again after a reconnect, the hub forgets it with the connection.
+        self._ready: bool = False
+
+    @property
+    def connected(self: Self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self: Self) -> None:
+        await self._open()
+        self._task = asyncio.create_task(self._run())
+
+    async def _open(self: Self) -> None:
+        self._reader, self._writer = await asyncio.open_connection("127.0.0.1", self.port, limit=LINE_LIMIT)
+        await _send(self._writer, {"op": "hello", "cluster_id": self.cluster_id, "token": self.token})
+        if self._ready:
+            await _send(self._writer, {"op": "ready"})
+
+    async def close(self: Self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._commands:
+            task.cancel()
+        await asyncio.gather(*self._commands, return_exceptions=True)
+        if self._writer is not None:
+            self._writer.close()
+
+    async def send_ready(self: Self) -> None:
+        self._ready = True
+        await _send(self._writer, {"op": "ready"})
+
+    async def broadcast(self: Self, command: str, **data: Any) -> List[Dict[str, Any]]:
+        """
+        Runs ``command`` on every cluster, this one included.
+
+        Returns
+        -------
+            List[Dict[str, Any]]
+                One ``{"cluster_id", "data", "error"}`` dict per cluster.
+        """
+        if not self.connected:
+            raise ConnectionError("Not connected to the IPC hub.")
+        nonce = f"{self.cluster_id}:{next(self._nonces)}"
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[nonce] = future
+        try:
+            await _send(self._writer, {"op": "broadcast", "nonce": nonce, "command": command, "data": data})
+            # The hub answers within its own timeout, unless the answer was too long to be read.
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError("The IPC hub did not answer.") from None
+        finally:
+            self._waiters.pop(nonce, None)
+
+    async def _run(self: Self) -> None:
+        delay = 1.0
+        while True:
+            await self._read_loop()
+            self._writer.close()
+            while True:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+                try:
+                    await self._open()
+                except OSError:
+                    log.warning("Could not reconnect to the IPC hub, retrying in %ss", delay)
+                else:
+                    log.info("Reconnected to the IPC hub")
+                    delay = 1.0
+                    break
+
+    async def _read_loop(self: Self) -> None:
+        try:
+            while (line := await _readline(self._reader)) is not None:
+                message = json.loads(line)
+                if message["op"] == "command":
+                    task = asyncio.create_task(self._run_command(message))
+                    self._commands.add(task)
+                    task.add_done_callback(self._commands.discard)
+                elif message["op"] == "responses":
+                    future = self._waiters.get(message["nonce"])
+                    if future is not None and not future.done():
+                        future.set_result(message["responses"])
+            log.warning("The IPC hub closed the connection")
+        except (ConnectionError, asyncio.IncompleteReadError, json.JSONDecodeError):
+            log.exception("Lost the IPC connection")
+        finally:
+            for future in self._waiters.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the IPC connection."))
+
+    async def _run_command(self: Self, message: Dict[str, Any]) -> None:
+        response = {"op": "response", "nonce": message["nonce"], "cluster_id": self.cluster_id}
+        handler = self.handlers.get(message["command"])
+        if handler is None:
+            response["error"] = f"Unknown command {message['command']}"
+        else:
+            try:
+                response["data"] = await handler(**message["data"])
+            except Exception as e:
+                log.exception("IPC command %s failed", message["command"])
+                response["error"] = f"{type(e).__name__}: {e}"
+        try:
+            await _send(self._writer, response)
+        except ConnectionError:
+            log.warning("Could not answer IPC command %s", message["command"])
+
+
+class ClusterLauncher:
+    """
+    Spawns one process per cluster, each running ``python -m tinybot`` on a
+    contiguous range of shards, and restarts the ones that crash.
+
+    Clusters are started one at a time, each waiting for the previous one to be
+    ready, so their shards do not compete for the identify rate limit. A cluster
+    exiting with code 0 (e.g. after ``shutdown``) is not restarted.
+    """
+
+    def __init__(
+        self: Self,
+        clusters: int,
+        argv: List[str],
+        ready_timeout: float = 300.0,
+        metrics_port: Optional[int] = None,
+    ) -> None:
+        self.clusters = clusters
+        self.argv = argv
+        self.ready_timeout = ready_timeout
+        self.hub = IPCHub(token=secrets.token_hex(16))
+        self.processes: Dict[int, asyncio.subprocess.Process] = {}
+        self.restarts: Dict[int, int] = {}
+        self.metrics_server: Optional[MetricsServer] = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(
+                self.collect_metrics, metrics_port, os.getenv("METRICS_HOST", "127.0.0.1")
+            )
+
+    async def collect_metrics(self: Self) -> List[Family]:
+        """Collects the metrics of every cluster, along with their state."""
+        responses = await self.hub.broadcast("metrics")
+        families = [item for response in responses if response["data"] for item in response["data"]]
+        families.append(
+            family(
+                "tinybot_cluster_up",
+                "gauge",
+                "Whether the cluster process is running and connected to the launcher.",
+                [
+                    [
+                        "",
+                        {"cluster": str(cluster_id)},
+                        int(process.returncode is None and cluster_id in self.hub.clients),
+                    ]
+                    for cluster_id, process in sorted(self.processes.items())
+                ],
+            )
+        )
+        families.append(
+            family(
+                "tinybot_cluster_restarts_total",
+                "counter",
+                "Restarts of a cluster after it crashed.",
+                [["", {"cluster": str(cluster_id)}, count] for cluster_id, count in self.restarts.items()],
+            )
+        )
+        return families
+
+    async def spawn(self: Self, cluster_id: int) -> asyncio.subprocess.Process:
+        env = {**os.environ, IPC_TOKEN_ENV: self.hub.token}
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "tinybot",
+            *self.argv,
+            "--cluster-id",
+            str(cluster_id),
+            "--ipc-port",
+            str(self.hub.port),
+            env=env,
+        )
+        self.processes[cluster_id] = process
+        log.info("Started cluster %s (pid %s)", cluster_id, process.pid)
+        return process
+
+    async def wait_ready(self: Self, cluster_id: int, process: asyncio.subprocess.Process) -> None:
+        ready = asyncio.create_task(self.hub.ready_event(cluster_id).wait())
+        exited = asyncio.create_task(process.wait())
+        await asyncio.wait({ready, exited}, timeout=self.ready_timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not ready.done() and not exited.done():
+            log.warning("Cluster %s was not ready after %ss, starting the next one", cluster_id, self.ready_timeout)
+        ready.cancel()
+        exited.cancel()
+
+    async def supervise(self: Self, cluster_id: int, started: asyncio.Event) -> None:
+        loop = asyncio.get_running_loop()
+        restarts = 0
+        process = await self.spawn(cluster_id)
+        spawned = loop.time()
+        await self.wait_ready(cluster_id, process)
+        started.set()
+        while True:
+            code = await process.wait()
+            if loop.time() - spawned >= STABLE_AFTER:
+                # Only back off for clusters crashing again and again.
+                restarts = 0
+            if code == 0:
+                log.info("Cluster %s exited", cluster_id)
+                return
+            if code == EXIT_FATAL:
+                log.error("Cluster %s could not start, not restarting it", cluster_id)
+                return
+            delay = min(2 ** restarts, 60)
+            restarts += 1
+            self.restarts[cluster_id] = self.restarts.get(cluster_id, 0) + 1
+            log.error("Cluster %s exited with code %s, restarting in %ss", cluster_id, code, delay)
+            await asyncio.sleep(delay)
+            process = await self.spawn(cluster_id)
+            spawned = loop.time()
+
+    async def run(self: Self) -> None:
+        await self.hub.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        tasks = []
+        try:
+            for cluster_id in range(self.clusters):
+                started = asyncio.Event()
+                tasks.append(asyncio.create_task(self.supervise(cluster_id, started)))
+                await started.wait()
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for process in self.processes.values():
+                if process.returncode is None:
+                    process.terminate()
+            for process in self.processes.values():
+                await process.wait()
+            if self.metrics_server is not None:
+                await self.metrics_server.close()
+            await self.hub.close()
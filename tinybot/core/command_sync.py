@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+from typing import Any, Dict, List, Optional, Self
+
+import discord
+from discord import app_commands
+
+log = logging.getLogger("tinybot.command_sync")
+
+
+def _hash(payload: Any) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class CommandSyncer:
+    """
+    Syncs application commands only when they changed since the last sync.
+
+    The commands of a scope, global or one guild, are serialized the way they are
+    sent to Discord and hashed. The hashes of the last sync are kept in a JSON file
+    per application, so restarts and deploys that did not touch the commands do not
+    spend any of the heavily rate limited sync requests.
+
+    Parameters
+    ----------
+    tree: app_commands.CommandTree
+        The command tree to sync.
+    path: pathlib.Path
+        File the fingerprints of the last syncs are stored in.
+    """
+
+    def __init__(self: Self, tree: app_commands.CommandTree, path: pathlib.Path) -> None:
+        self.tree = tree
+        self.path = path
+        self._state: Optional[Dict[str, Any]] = None
+
+    def _load(self: Self) -> Dict[str, Any]:
+        if self._state is None:
+            try:
+                self._state = json.loads(self.path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                self._state = {}
+            except ValueError:
+                log.warning("Ignoring unreadable command fingerprints in %s", self.path)
+                self._state = {}
+        return self._state
+
+    def _save(self: Self) -> None:
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self._load(), indent=4), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+
+    def _scope(self: Self, guild: Optional[discord.abc.Snowflake]) -> str:
+        return f"{self.tree.client.application_id}:{guild.id if guild else 'global'}"
+
+    def commands(self: Self, guild: Optional[discord.abc.Snowflake]) -> Dict[str, str]:
+        """
+        Returns the hash of every command that would be synced to ``guild``.
+
+        Returns
+        -------
+            Dict[str, str]
+                ``type:name`` mapped to the hash of the command's payload.
+        """
+        payloads = [command.to_dict() for command in self.tree.get_commands(guild=guild)]
+        return {
+            f"{discord.AppCommandType(payload['type']).name}:{payload['name']}": _hash(payload)
+            for payload in payloads
+        }
+
+    def diff(self: Self, guild: Optional[discord.abc.Snowflake]) -> Dict[str, List[str]]:
+        """
+        Compares the commands of ``guild`` with the ones of its last sync.
+
+        Returns
+        -------
+            Dict[str, List[str]]
+                The ``added``, ``changed`` and ``removed`` commands.
+        """
+        old = self._load().get(self._scope(guild), {}).get("commands", {})
+        new = self.commands(guild)
+        return {
+            "added": sorted(new.keys() - old.keys()),
+            "changed": sorted(name for name in new.keys() & old.keys() if new[name] != old[name]),
+            "removed": sorted(old.keys() - new.keys()),
+        }
+
+    async def sync(self: Self, guild: Optional[discord.abc.Snowflake], force: bool = False) -> bool:
+        """
+        Syncs the commands of ``guild``, or the global ones, if they changed.
+
+        Parameters
+        ----------
+        guild: Optional[discord.abc.Snowflake]
+            The guild to sync, ``None`` for global commands.
+        force: bool
+            Sync even if the fingerprint did not change.
+
+        Returns
+        -------
+            bool
+                Whether a sync request was sent.
+        """
+        commands = self.commands(guild)
+        fingerprint = _hash(commands)
+        scope = self._scope(guild)
+        state = self._load()
+        if not force and state.get(scope, {}).get("fingerprint") == fingerprint:
+            log.info("Commands of %s did not change, skipping sync", scope)
+            return False
+
+        await self.tree.sync(guild=guild)
+        state[scope] = {"fingerprint": fingerprint, "commands": commands}
+        self._save()
+        log.info("Synced %s commands to %s", len(commands), scope)
+        return True
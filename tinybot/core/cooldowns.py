@@ -0,0 +1,418 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Self, Tuple
+
+from discord.ext import commands
+from piccolo.columns import DoublePrecision, Integer, Text, Varchar
+from piccolo.table import Table
+
+from tinybot.core.metrics import Family, family
+from tinybot.db.engine import DBEngine, registry
+
+log = logging.getLogger("tinybot.cooldowns")
+
+
+# (start, used, expires) of a window.
+Span = Tuple[float, int, float]
+
+
+class _Window:
+    __slots__ = ("start", "used", "per", "dirty", "remote")
+
+    def __init__(self: Self, start: float, per: float) -> None:
+        self.start = start
+        self.used: int = 0
+        self.per = per
+        # Changed since the shared backend last wrote it.
+        self.dirty: bool = False
+        # Owner -> (start, used, expires) of the other processes' windows, shared backend only.
+        self.remote: Optional[Dict[str, Span]] = None
+
+    @property
+    def expires(self: Self) -> float:
+        return self.start + self.per
+
+
+class MemoryCooldowns:
+    """
+    Cooldown state of every command, in memory.
+
+    Follows the semantics of ``discord.ext.commands.Cooldown``: the first use opens a
+    window of ``per`` seconds in which ``rate`` uses are allowed. Windows are filed
+    under the second they expire in, and every call first drops the windows of the
+    seconds that passed, so the state only holds windows that are still open and
+    expiring them never walks the whole state, unlike ``CooldownMapping``.
+
+    Parameters
+    ----------
+    resolution: float
+        Width in seconds of the expiry buckets.
+    """
+
+    def __init__(self: Self, resolution: float = 1.0) -> None:
+        self.resolution = resolution
+        self._windows: Dict[str, _Window] = {}
+        # Expiry bucket -> keys, and a heap of the buckets.
+        self._expiry: Dict[int, List[str]] = {}
+        self._buckets: List[int] = []
+        self.uses: int = 0
+        self.limited: int = 0
+        self.expired: int = 0
+
+    def _file(self: Self, key: str, expires: float) -> None:
+        bucket = int(expires // self.resolution) + 1
+        keys = self._expiry.get(bucket)
+        if keys is None:
+            keys = self._expiry[bucket] = []
+            heapq.heappush(self._buckets, bucket)
+        keys.append(key)
+
+    def _expire(self: Self, now: float) -> None:
+        current = int(now // self.resolution)
+        while self._buckets and self._buckets[0] <= current:
+            for key in self._expiry.pop(heapq.heappop(self._buckets)):
+                window = self._windows.get(key)
+                # A key is filed again every time its window is renewed.
+                if window is not None and not self._spans(window, now):
+                    del self._windows[key]
+                    self.expired += 1
+
+    def _spans(self: Self, window: _Window, now: float) -> List[Span]:
+        """The windows of a key still counting uses."""
+        if window.used and now <= window.expires:
+            return [(window.start, window.used, window.expires)]
+        return []
+
+    def _retry_after(self: Self, spans: List[Span], rate: int, now: float) -> float:
+        """Seconds until enough windows close for the uses left in the others to fall under ``rate``."""
+        used = sum(span[1] for span in spans)
+        for _start, span_used, expires in sorted(spans, key=lambda span: span[2]):
+            used -= span_used
+            if used < rate:
+                return max(expires - now, 0.0)
+        return 0.0
+
+    def tokens(self: Self, key: str, rate: int, per: float, now: float) -> int:
+        """The uses ``key`` has left."""
+        self._expire(now)
+        window = self._windows.get(key)
+        if window is None:
+            return rate
+        return max(rate - sum(span[1] for span in self._spans(window, now)), 0)
+
+    def retry_after(self: Self, key: str, rate: int, per: float, now: float) -> float:
+        """Seconds until ``key`` can be used again, 0 when it can be used now."""
+        if self.tokens(key, rate, per, now) > 0:
+            return 0.0
+        return self._retry_after(self._spans(self._windows[key], now), rate, now)
+
+    def hit(self: Self, key: str, rate: int, per: float, now: float, tokens: int = 1) -> Optional[float]:
+        """
+        Uses ``key``.
+
+        Returns
+        -------
+            Optional[float]
+                The seconds to wait when ``key`` is on cooldown, None otherwise.
+        """
+        self._expire(now)
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = _Window(now, per)
+            self._file(key, window.expires)
+        elif not window.used or now > window.expires:
+            # Like a Cooldown whose tokens are full again, other processes' uses are kept.
+            window.start, window.used, window.per = now, 0, per
+            self._file(key, window.expires)
+        window.used += tokens
+        window.dirty = True
+        self.uses += 1
+        spans = self._spans(window, now)
+        if sum(span[1] for span in spans) > rate:
+            self.limited += 1
+            return self._retry_after(spans, rate, now)
+        return None
+
+    def reset(self: Self, key: str) -> None:
+        """Forgets the uses of ``key``, those other processes make after the reset still count."""
+        window = self._windows.get(key)
+        if window is not None:
+            window.used = 0
+            window.dirty = True
+            if window.remote:
+                window.remote.clear()
+
+    async def start(self: Self) -> None:
+        pass
+
+    async def close(self: Self) -> None:
+        pass
+
+    def stats(self: Self) -> Dict[str, Any]:
+        """
+        Returns the open windows, the uses and how many were on cooldown.
+
+        Returns
+        -------
+            Dict[str, Any]
+        """
+        return {
+            "backend": "memory",
+            "windows": len(self._windows),
+            "expiry_buckets": len(self._buckets),
+            "uses": self.uses,
+            "limited": self.limited,
+            "expired": self.expired,
+        }
+
+    def families(self: Self, base: Dict[str, str]) -> List[Family]:
+        return [
+            family(
+                "tinybot_cooldown_windows",
+                "gauge",
+                "Open cooldown windows.",
+                [["", base, len(self._windows)]],
+            ),
+            family(
+                "tinybot_cooldown_uses_total",
+                "counter",
+                "Uses of commands with a cooldown, and those that were on cooldown.",
+                [
+                    ["", {**base, "kind": "uses"}, self.uses],
+                    ["", {**base, "kind": "limited"}, self.limited],
+                ],
+            ),
+        ]
+
+
+class CommandCooldowns(Table, tablename="command_cooldowns"):
+    # "<key>@<owner>", every process only writes its own rows.
+    slot = Text(unique=True)
+    key = Text(index=True)
+    owner = Varchar(length=64)
+    started = DoublePrecision()
+    used = Integer()
+    expires = DoublePrecision(index=True)
+    updated = DoublePrecision(index=True)
+
+
+class SharedCooldowns(MemoryCooldowns):
+    """
+    Cooldown state shared by every process using the same database, for bots running
+    as several clusters.
+
+    Uses are decided in memory like :class:`MemoryCooldowns`, so a command never waits
+    for the database. Every ``interval`` seconds the windows that changed are written
+    in one batch, each process writing only its own rows, and the rows the other
+    processes wrote since the previous sync are read back in one query. A key is on
+    cooldown when the uses of every process add up to its rate, so processes can
+    overshoot a rate by what they allow within one ``interval``.
+
+    Parameters
+    ----------
+    db: DBEngine
+        The engine the ``command_cooldowns`` table is created with.
+    interval: float
+        Seconds between two syncs.
+    resolution: float
+        Width in seconds of the expiry buckets.
+    """
+
+    def __init__(self: Self, db: DBEngine, interval: float = 1.0, resolution: float = 1.0) -> None:
+        super().__init__(resolution)
+        self.db = db
+        self.interval = interval
+        self.owner: str = uuid.uuid4().hex
+        self.table = CommandCooldowns
+        self.syncs: int = 0
+        self.pushed: int = 0
+        self.pulled: int = 0
+        self.errors: int = 0
+        self.sync_time: float = 0.0
+        self._since: float = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def _spans(self: Self, window: _Window, now: float) -> List[Span]:
+        spans = super()._spans(window, now)
+        if window.remote:
+            spans.extend(span for span in window.remote.values() if span[1] and now <= span[2])
+        return spans
+
+    async def start(self: Self) -> None:
+        registry.load_env(self.db.path)
+        if registry.db_type is None:
+            log.error("COOLDOWN_BACKEND is shared but DB_TYPE is not set, cooldowns stay local to this process")
+            return
+        self.table._meta.db = self.db.connect()
+        await self.db.setup([self.table])
+        self._since = time.time() - self.interval
+        self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self: Self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sync()
+            except Exception:
+                self.errors += 1
+                log.exception("Could not sync the cooldowns")
+
+    async def sync(self: Self) -> None:
+        """Writes the windows that changed and reads those the other processes changed."""
+        started = time.perf_counter()
+        now = time.time()
+        table = self.table
+        rows = []
+        for key, window in self._windows.items():
+            if window.dirty:
+                window.dirty = False
+                rows.append(
+                    {
+                        "slot": f"{key}@{self.owner}",
+                        "key": key,
+                        "owner": self.owner,
+                        "started": window.start,
+                        "used": window.used,
+                        "expires": window.expires,
+                        "updated": now,
+                    }
+                )
+        try:
+            await self.db.upsert_many(table, rows, ["slot"])
+        except Exception:
+            for row in rows:
+                window = self._windows.get(row["key"])
+                if window is not None:
+                    window.dirty = True
+            raise
+        self.pushed += len(rows)
+
+        # Rows written right before the previous read may carry an older timestamp, read a second again.
+        since, self._since = self._since - 1.0, now
+        remote = await table.select(
+            table.key, table.owner, table.started, table.used, table.expires
+        ).where((table.updated >= since) & (table.expires > now) & (table.owner != self.owner))
+        for row in remote:
+            window = self._windows.get(row["key"])
+            if window is None:
+                # Used elsewhere only, an empty local window holds the remote uses.
+                window = self._windows[row["key"]] = _Window(row["started"], row["expires"] - row["started"])
+            if window.remote is None:
+                window.remote = {}
+            window.remote[row["owner"]] = (row["started"], row["used"], row["expires"])
+            self._file(row["key"], row["expires"])
+        self.pulled += len(remote)
+
+        self.syncs += 1
+        if self.syncs % 60 == 0:
+            await table.delete().where(table.expires < now - 60)
+        self.sync_time = time.perf_counter() - started
+
+    async def close(self: Self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        try:
+            await self.sync()
+        except Exception:
+            log.exception("Could not sync the cooldowns")
+
+    def stats(self: Self) -> Dict[str, Any]:
+        return {
+            **super().stats(),
+            "backend": "shared",
+            "syncing": self._task is not None,
+            "syncs": self.syncs,
+            "pushed": self.pushed,
+            "pulled": self.pulled,
+            "errors": self.errors,
+            "sync_seconds": self.sync_time,
+        }
+
+
+class BackendCooldown(commands.Cooldown):
+    """A ``Cooldown`` whose state lives in a cooldown backend, under ``key``."""
+
+    __slots__ = ("backend", "key")
+
+    def __init__(self: Self, rate: float, per: float, backend: MemoryCooldowns, key: str) -> None:
+        super().__init__(rate, per)
+        self.backend = backend
+        self.key = key
+
+    def get_tokens(self: Self, current: Optional[float] = None) -> int:
+        return self.backend.tokens(self.key, self.rate, self.per, current or time.time())
+
+    def get_retry_after(self: Self, current: Optional[float] = None) -> float:
+        return self.backend.retry_after(self.key, self.rate, self.per, current or time.time())
+
+    def update_rate_limit(self: Self, current: Optional[float] = None, *, tokens: int = 1) -> Optional[float]:
+        return self.backend.hit(self.key, self.rate, self.per, current or time.time(), tokens)
+
+    def reset(self: Self) -> None:
+        self.backend.reset(self.key)
+
+    def copy(self: Self) -> commands.Cooldown:
+        return commands.Cooldown(self.rate, self.per)
+
+
+class BackendCooldownMapping(commands.CooldownMapping):
+    """
+    Stands in for a command's ``CooldownMapping``, keeping its rate and bucket type
+    but storing the state in a backend, under the command's name and bucket key.
+    """
+
+    def __init__(self: Self, original: commands.CooldownMapping, backend: MemoryCooldowns, name: str) -> None:
+        super().__init__(original._cooldown, original._type)
+        self._original = original
+        self._backend = backend
+        self._name = name
+
+    @property
+    def valid(self: Self) -> bool:
+        return self._original.valid
+
+    def copy(self: Self) -> BackendCooldownMapping:
+        return BackendCooldownMapping(self._original.copy(), self._backend, self._name)
+
+    def get_bucket(self: Self, message: Any, current: Optional[float] = None) -> Optional[commands.Cooldown]:
+        if isinstance(self._original, commands.DynamicCooldownMapping):
+            cooldown = self._original.create_bucket(message)
+            if cooldown is None:
+                return None
+        else:
+            cooldown = self._cooldown
+        key = f"{self._name}:{self._bucket_key(message)!r}"
+        return BackendCooldown(cooldown.rate, cooldown.per, self._backend, key)
+
+
+def use_backend(command: commands.Command, backend: MemoryCooldowns) -> None:
+    """Moves the cooldowns of ``command`` and of its subcommands to ``backend``."""
+    commands_ = [command]
+    if isinstance(command, commands.Group):
+        commands_.extend(command.walk_commands())
+    for cmd in commands_:
+        if cmd._buckets.valid and not isinstance(cmd._buckets, BackendCooldownMapping):
+            cmd._buckets = BackendCooldownMapping(cmd._buckets, backend, cmd.qualified_name)
+
+
+def create_backend(name: str) -> MemoryCooldowns:
+    """
+    Returns the ``memory`` or ``shared`` cooldown backend, the shared one stores its
+    table with the core cog's tables.
+    """
+    if name == "memory":
+        return MemoryCooldowns()
+    if name == "shared":
+        return SharedCooldowns(
+            DBEngine(path=os.getcwd(), cog_name="Core"),
+            interval=float(os.getenv("COOLDOWN_SYNC_INTERVAL", 1.0)),
+        )
+    raise ValueError(f"Unknown cooldown backend {name!r}, expected memory or shared")
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import hashlib
+import logging
+import traceback
+from typing import TYPE_CHECKING, Dict, List, Optional, Self, Set
+
+import discord
+
+if TYPE_CHECKING:
+    from tinybot.bot import TinyBot
+
+log = logging.getLogger("tinybot.errors")
+
+# Traceback characters per report, leaving room for the summary in Discord's 2000 characters.
+MAX_REPORT_LENGTH = 1500
+
+
+def fingerprint(error: BaseException) -> str:
+    """
+    Identifies an error by its type and the place it was raised from.
+
+    Only walks the traceback objects, no source lines are read.
+    """
+    tb = error.__traceback__
+    location = ""
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        location = f"{code.co_filename}:{code.co_name}:{tb.tb_lineno}"
+        tb = tb.tb_next
+    error_type = type(error)
+    key = f"{error_type.__module__}.{error_type.__qualname__}@{location}"
+    return hashlib.sha1(key.encode()).hexdigest()[:10]
+
+
+class ErrorGroup:
+    """Occurrences of one fingerprint since it was last reported."""
+
+    __slots__ = ("fingerprint", "error", "count", "total", "commands")
+
+    def __init__(self: Self, fingerprint: str, error: BaseException) -> None:
+        self.fingerprint = fingerprint
+        # The first occurrence is kept to format its traceback later.
+        self.error: Optional[BaseException] = error
+        self.count: int = 0
+        self.total: int = 0
+        self.commands: collections.Counter = collections.Counter()
+
+
+class ErrorReporter:
+    """
+    Aggregates command errors and forwards them to the bot owners.
+
+    Recording an error only computes its fingerprint and bumps a counter. Every
+    ``interval`` seconds a background task formats one report per fingerprint that
+    occurred since the last one, at most ``max_reports`` of them, and sends it to
+    the owners. Only the first occurrence of a fingerprint in a window is logged
+    with its traceback, so an error storm neither floods the log nor the owners.
+
+    Parameters
+    ----------
+    bot: TinyBot
+        The bot whose owners get the reports.
+    interval: float
+        Seconds between two reports.
+    max_reports: int
+        Reports sent per interval, the other fingerprints are summed up in one line.
+    max_groups: int
+        Distinct fingerprints kept, new ones are only counted past that.
+    """
+
+    def __init__(
+        self: Self,
+        bot: TinyBot,
+        interval: float = 60.0,
+        max_reports: int = 5,
+        max_groups: int = 1000,
+    ) -> None:
+        self.bot = bot
+        self.interval = interval
+        self.max_reports = max_reports
+        self.max_groups = max_groups
+        self.groups: Dict[str, ErrorGroup] = {}
+        self.dropped: int = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self: Self, error: BaseException, command: Optional[str] = None) -> str:
+        """
+        Records an occurrence of ``error``, raised by ``command``.
+
+        Returns
+        -------
+            str
+                The fingerprint of the error.
+        """
+        key = fingerprint(error)
+        group = self.groups.get(key)
+        if group is None:
+            if len(self.groups) >= self.max_groups:
+                self.dropped += 1
+                return key
+            group = self.groups[key] = ErrorGroup(key, error)
+        if group.count == 0:
+            group.error = error
+            log.error("Exception in command '%s' [%s]", command, key, exc_info=error)
+        group.count += 1
+        group.total += 1
+        group.commands[command] += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._report_loop())
+        return key
+
+    async def _report_loop(self: Self) -> None:
+        while any(group.count for group in self.groups.values()):
+            await asyncio.sleep(self.interval)
+            try:
+                await self.report()
+            except Exception:
+                log.exception("Could not report errors")
+
+    def _summary(self: Self, group: ErrorGroup) -> str:
+        commands = ", ".join(f"{name} ({count})" for name, count in group.commands.most_common(5))
+        cluster = "" if self.bot.cluster_id is None else f" on cluster {self.bot.cluster_id}"
+        return (
+            f"**{type(group.error).__name__}** `{group.fingerprint}`{cluster}: {group.count} times in the last "
+            f"{self.interval:.0f}s, {group.total} in total. Commands: {commands}"
+        )
+
+    @staticmethod
+    def _format(error: BaseException) -> str:
+        text = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+        if len(text) > MAX_REPORT_LENGTH:
+            text = "...\n" + text[-MAX_REPORT_LENGTH:]
+        return text
+
+    async def owners(self: Self) -> Set[int]:
+        owner_ids = set(self.bot.owner_ids or ())
+        if self.bot.owner_id:
+            owner_ids.add(self.bot.owner_id)
+        if not owner_ids:
+            app = await self.bot.application_info()
+            if app.team:
+                owner_ids.update(member.id for member in app.team.members)
+            else:
+                owner_ids.add(app.owner.id)
+        return owner_ids
+
+    async def report(self: Self) -> List[str]:
+        """
+        Sends the pending reports now.
+
+        Returns
+        -------
+            List[str]
+                The messages that were sent.
+        """
+        # Errors that did not happen again since their last report are forgotten.
+        self.groups = {key: group for key, group in self.groups.items() if group.count}
+        pending = sorted(self.groups.values(), key=lambda g: g.count, reverse=True)
+        if not pending:
+            return []
+
+        messages = []
+        for group in pending[: self.max_reports]:
+            # Reading the source lines of a traceback hits the disk.
+            formatted = await asyncio.to_thread(self._format, group.error)
+            messages.append(f"{self._summary(group)}\n```py\n{formatted}```")
+        rest = pending[self.max_reports :]
+        if rest:
+            messages.append(
+                f"And {sum(g.count for g in rest)} more errors of {len(rest)} other kinds: "
+                + ", ".join(f"`{g.fingerprint}` ({g.count})" for g in rest[:20])
+            )
+        if self.dropped:
+            messages.append(f"{self.dropped} errors were not grouped, too many distinct errors.")
+            self.dropped = 0
+
+        for group in pending:
+            group.count = 0
+            group.commands.clear()
+            group.error = None
+
+        for owner_id in await self.owners():
+            try:
+                user = self.bot.get_user(owner_id) or await self.bot.fetch_user(owner_id)
+                for message in messages:
+                    await user.send(message)
+            except discord.HTTPException:
+                log.warning("Could not send the error report to %s", owner_id)
+        return messages
+
+    async def close(self: Self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import functools
+import importlib
+import logging
+import multiprocessing
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Literal, Optional, Self, Tuple, TypeVar
+
+log = logging.getLogger("tinybot.executors")
+
+Pool = Literal["thread", "process"]
+T = TypeVar("T")
+
+
+def _timed(func: Callable[..., T], args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Tuple[T, float]:
+    """Runs in the worker, returns the result with the time the worker spent on it."""
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def _call_by_name(module: str, qualname: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Any:
+    """
+    Calls a decorated function in a worker process. The decorated name refers to the
+    coroutine wrapper, which cannot be pickled, so the worker looks it up and unwraps it.
+    """
+    target: Any = importlib.import_module(module)
+    for name in qualname.split("."):
+        target = getattr(target, name)
+    return getattr(target, "__wrapped__", target)(*args, **kwargs)
+
+
+class PoolStats:
+    __slots__ = ("workers", "created", "submitted", "completed", "failed", "cancelled", "timeouts", "busy")
+
+    def __init__(self: Self, workers: int) -> None:
+        self.workers = workers
+        self.created: float = time.perf_counter()
+        self.submitted: int = 0
+        self.completed: int = 0
+        self.failed: int = 0
+        self.cancelled: int = 0
+        self.timeouts: int = 0
+        # Seconds the workers spent running calls.
+        self.busy: float = 0.0
+
+    def to_dict(self: Self) -> Dict[str, Any]:
+        inflight = self.submitted - self.completed - self.failed - self.cancelled - self.timeouts
+        return {
+            "workers": self.workers,
+            "inflight": inflight,
+            "queued": max(0, inflight - self.workers),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "timeouts": self.timeouts,
+            "busy_seconds": self.busy,
+            "utilization": self.busy / ((time.perf_counter() - self.created) * self.workers),
+        }
+
+
+class Executors:
+    """
+    Process-wide thread and process pools for blocking and CPU-bound cog work.
+
+    Threads suit blocking I/O and C extensions that release the GIL, like image
+    and compression libraries. Processes suit pure Python CPU work, their calls
+    and arguments have to be picklable. Each pool is created on its first use.
+
+    A call that times out or is cancelled is removed from the pool's queue when
+    it did not start yet. A call that already runs cannot be interrupted, it
+    finishes in the background and its result is dropped.
+
+    Parameters
+    ----------
+    threads: Optional[int]
+        Workers of the thread pool, ``min(32, cpus + 4)`` by default.
+    processes: Optional[int]
+        Workers of the process pool, one per CPU by default.
+    """
+
+    def __init__(self: Self, threads: Optional[int] = None, processes: Optional[int] = None) -> None:
+        self.threads = threads or min(32, (os.cpu_count() or 1) + 4)
+        self.processes = processes or os.cpu_count() or 1
+        self._pools: Dict[str, concurrent.futures.Executor] = {}
+        self._stats: Dict[str, PoolStats] = {}
+
+    def configure(self: Self, threads: Optional[int] = None, processes: Optional[int] = None) -> None:
+        """Sizes the pools, only affects the ones not created yet."""
+        if threads:
+            self.threads = threads
+        if processes:
+            self.processes = processes
+
+    def pool(self: Self, kind: Pool) -> concurrent.futures.Executor:
+        executor = self._pools.get(kind)
+        if executor is not None:
+            return executor
+        if kind == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix="tinybot-worker")
+            workers = self.threads
+        elif kind == "process":
+            # Forking a process running the event loop and the watchdog thread is unsafe.
+            executor = concurrent.futures.ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context("spawn")
+            )
+            workers = self.processes
+        else:
+            raise ValueError(f"Unknown pool {kind!r}")
+        log.info("Started the %s pool with %s workers", kind, workers)
+        self._pools[kind] = executor
+        self._stats[kind] = PoolStats(workers)
+        return executor
+
+    async def run(
+        self: Self,
+        func: Callable[..., T],
+        /,
+        *args: Any,
+        pool: Pool = "thread",
+        timeout: Optional[float] = None,
+        **kwargs: Any,
+    ) -> T:
+        """
+        Runs ``func(*args, **kwargs)`` in a pool.
+
+        Parameters
+        ----------
+        func: Callable[..., T]
+            The function to run.
+        pool: Pool
+            ``thread`` or ``process``.
+        timeout: Optional[float]
+            Seconds to wait for the result.
+
+        Returns
+        -------
+            T
+
+        Raises
+        ------
+        TimeoutError
+            The call did not finish within ``timeout`` seconds.
+        """
+        executor = self.pool(pool)
+        stats = self._stats[pool]
+        future = executor.submit(_timed, func, args, kwargs)
+        stats.submitted += 1
+        try:
+            async with asyncio.timeout(timeout):
+                result, busy = await asyncio.wrap_future(future)
+        except TimeoutError:
+            future.cancel()
+            stats.timeouts += 1
+            raise
+        except asyncio.CancelledError:
+            future.cancel()
+            stats.cancelled += 1
+            raise
+        except BaseException:
+            stats.failed += 1
+            raise
+        stats.completed += 1
+        stats.busy += busy
+        return result
+
+    def stats(self: Self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the usage of every pool created so far.
+
+        Returns
+        -------
+            Dict[str, Dict[str, Any]]
+        """
+        return {kind: stats.to_dict() for kind, stats in self._stats.items()}
+
+    async def close(self: Self) -> None:
+        """Shuts the pools down, dropping the calls that did not start."""
+        pools, self._pools = self._pools, {}
+        for executor in pools.values():
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+
+executors: Executors = Executors()
+
+
+def offload(
+    pool: Pool = "thread", timeout: Optional[float] = None
+) -> Callable[[Callable[..., T]], Callable[..., Awaitable[T]]]:
+    """
+    Turns a blocking function into a coroutine function running in the shared pools.
+
+    Cog methods can use the thread pool:
+
+        @offload(timeout=10)
+        def render(self, image: bytes) -> bytes: ...
+
+        data = await self.render(image)
+
+    The process pool needs a module level function or a staticmethod, which
+    the workers import by name, and picklable arguments.
+
+    Parameters
+    ----------
+    pool: Pool
+        ``thread`` or ``process``.
+    timeout: Optional[float]
+        Seconds to wait for the result before raising ``TimeoutError``.
+    """
+
+    def decorator(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            if pool == "process":
+                return await executors.run(
+                    _call_by_name, func.__module__, func.__qualname__, args, kwargs, pool=pool, timeout=timeout
+                )
+            return await executors.run(func, *args, pool=pool, timeout=timeout, **kwargs)
+
+        return wrapper
+
+    return decorator
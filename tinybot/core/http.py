@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import json
+import logging
+import re
+import time
+from typing import Any, Dict, Mapping, Optional, Self, Tuple
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+log = logging.getLogger("tinybot.http")
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class Response:
+    """A fully read response, safe to share between coalesced requests and to cache."""
+
+    __slots__ = ("url", "status", "headers", "body")
+
+    def __init__(self: Self, url: URL, status: int, headers: CIMultiDictProxy, body: bytes) -> None:
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self: Self) -> bool:
+        return self.status < 400
+
+    def text(self: Self, encoding: str = "utf-8") -> str:
+        return self.body.decode(encoding, errors="replace")
+
+    def json(self: Self) -> Any:
+        return json.loads(self.body)
+
+
+class _CacheEntry:
+    __slots__ = ("response", "etag", "last_modified", "expires")
+
+    def __init__(self: Self, response: Response) -> None:
+        self.response = response
+        self.etag: Optional[str] = response.headers.get("ETag")
+        self.last_modified: Optional[str] = response.headers.get("Last-Modified")
+        self.expires: float = 0.0
+        self.refresh()
+
+    def refresh(self: Self) -> None:
+        match = _MAX_AGE_RE.search(self.response.headers.get("Cache-Control", ""))
+        self.expires = time.monotonic() + int(match.group(1)) if match else 0.0
+
+    @property
+    def fresh(self: Self) -> bool:
+        return time.monotonic() < self.expires
+
+
+class HostStats:
+    __slots__ = ("requests", "errors", "latency_total", "latency_max", "hits", "revalidated", "misses", "coalesced")
+
+    def __init__(self: Self) -> None:
+        self.requests: int = 0
+        self.errors: int = 0
+        self.latency_total: float = 0.0
+        self.latency_max: float = 0.0
+        self.hits: int = 0
+        self.revalidated: int = 0
+        self.misses: int = 0
+        self.coalesced: int = 0
+
+    def to_dict(self: Self) -> Dict[str, Any]:
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_avg": self.latency_total / self.requests if self.requests else 0.0,
+            "latency_max": self.latency_max,
+            "hit_rate": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+class HTTPClient:
+    """
+    Shared HTTP client for cogs calling external APIs.
+
+    Wraps one ``aiohttp.ClientSession`` whose connector caps the open connections in
+    total and per host, caches DNS lookups and keeps idle connections alive.
+
+    ``get`` shares one in-flight request between identical concurrent GETs. With
+    ``cache=True`` the response is kept in a LRU cache bounded in bytes. A cached
+    response is served without any request while its ``Cache-Control: max-age`` is
+    fresh, and revalidated with ``If-None-Match``/``If-Modified-Since`` afterwards,
+    a ``304`` then costs no body transfer.
+
+    Parameters
+    ----------
+    limit: int
+        Open connections in total, 0 for no limit.
+    limit_per_host: int
+        Open connections per host, 0 for no limit.
+    dns_ttl: int
+        Seconds DNS lookups are cached.
+    keepalive: float
+        Seconds idle connections are kept open.
+    cache_size: int
+        Bytes of response bodies kept in the cache.
+    timeout: float
+        Total timeout of a request in seconds.
+    headers: Optional[Mapping[str, str]]
+        Headers sent with every request.
+    """
+
+    def __init__(
+        self: Self,
+        limit: int = 100,
+        limit_per_host: int = 10,
+        dns_ttl: int = 300,
+        keepalive: float = 30.0,
+        cache_size: int = 16 * 1024 * 1024,
+        timeout: float = 30.0,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> None:
+        self.session: aiohttp.ClientSession = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=limit,
+                limit_per_host=limit_per_host,
+                ttl_dns_cache=dns_ttl,
+                keepalive_timeout=keepalive,
+            ),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers=headers,
+        )
+        self.cache_size = cache_size
+        self.cache_bytes: int = 0
+        self._cache: collections.OrderedDict[Tuple, _CacheEntry] = collections.OrderedDict()
+        self._inflight: Dict[Tuple, asyncio.Task] = {}
+        self._stats: Dict[str, HostStats] = collections.defaultdict(HostStats)
+
+    @staticmethod
+    def _key(url: URL, headers: Optional[Mapping[str, str]]) -> Tuple:
+        return str(url), tuple(sorted((k.lower(), v) for k, v in (headers or {}).items()))
+
+    async def request(self: Self, method: str, url: str | URL, **kwargs: Any) -> Response:
+        """
+        Sends a request and reads its whole body.
+
+        Parameters
+        ----------
+        method: str
+            The HTTP method.
+        url: str | URL
+            The URL to request.
+        kwargs: Any
+            Passed to ``aiohttp.ClientSession.request``.
+
+        Returns
+        -------
+            Response
+        """
+        url = URL(url)
+        stats = self._stats[url.host or ""]
+        started = time.perf_counter()
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                body = await response.read()
+                result = Response(response.url, response.status, response.headers, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            stats.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            stats.requests += 1
+            stats.latency_total += elapsed
+            stats.latency_max = max(stats.latency_max, elapsed)
+        return result
+
+    async def get(
+        self: Self,
+        url: str | URL,
+        *,
+        params: Optional[Mapping[str, Any]] = None,
+        headers: Optional[Mapping[str, str]] = None,
+        cache: bool = False,
+    ) -> Response:
+        """
+        GETs ``url``, sharing the request with identical concurrent calls.
+
+        Parameters
+        ----------
+        url: str | URL
+            The URL to request.
+        params: Optional[Mapping[str, Any]]
+            Query parameters.
+        headers: Optional[Mapping[str, str]]
+            Extra request headers, part of the cache key.
+        cache: bool
+            Serve and store the response from the cache.
+
+        Returns
+        -------
+            Response
+        """
+        url = URL(url)
+        if params:
+            url = url.update_query(params)
+        key = self._key(url, headers)
+        stats = self._stats[url.host or ""]
+
+        # Only calls agreeing on the cache share a request, a cached response is not a fresh one.
+        inflight_key = (key, cache)
+        task = self._inflight.get(inflight_key)
+        if task is not None:
+            stats.coalesced += 1
+        else:
+            # A task of its own, so cancelling the first caller does not fail the others.
+            task = asyncio.create_task(self._get(url, headers, key, stats, cache))
+            self._inflight[inflight_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(inflight_key, None))
+        return await asyncio.shield(task)
+
+    async def _get(
+        self: Self,
+        url: URL,
+        headers: Optional[Mapping[str, str]],
+        key: Tuple,
+        stats: HostStats,
+        cache: bool,
+    ) -> Response:
+        entry = self._cache.get(key) if cache else None
+        if entry is not None and entry.fresh:
+            stats.hits += 1
+            self._cache.move_to_end(key)
+            return entry.response
+
+        request_headers = CIMultiDict(headers or {})
+        if entry is not None:
+            if entry.etag:
+                request_headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                request_headers["If-Modified-Since"] = entry.last_modified
+
+        response = await self.request("GET", url, headers=request_headers)
+        if entry is not None and response.status == 304:
+            stats.revalidated += 1
+            entry.refresh()
+            self._cache.move_to_end(key)
+            return entry.response
+
+        if cache:
+            stats.misses += 1
+            self._store(key, response)
+        return response
+
+    def _store(self: Self, key: Tuple, response: Response) -> None:
+        self._evict(key)
+        cache_control = response.headers.get("Cache-Control", "")
+        if response.status != 200 or "no-store" in cache_control or len(response.body) > self.cache_size:
+            return
+        entry = _CacheEntry(response)
+        if not (entry.etag or entry.last_modified or entry.expires):
+            return
+        self._cache[key] = entry
+        self.cache_bytes += len(response.body)
+        while self.cache_bytes > self.cache_size:
+            self._evict(next(iter(self._cache)))
+
+    def _evict(self: Self, key: Tuple) -> None:
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            self.cache_bytes -= len(entry.response.body)
+
+    def clear_cache(self: Self) -> None:
+        self._cache.clear()
+        self.cache_bytes = 0
+
+    def stats(self: Self) -> Dict[str, Any]:
+        """
+        Returns the request and cache statistics of every host.
+
+        Returns
+        -------
+            Dict[str, Any]
+        """
+        return {
+            "cache_entries": len(self._cache),
+            "cache_bytes": self.cache_bytes,
+            "inflight": len(self._inflight),
+            "hosts": {host: stats.to_dict() for host, stats in self._stats.items()},
+        }
+
+    async def close(self: Self) -> None:
+        await self.session.close()
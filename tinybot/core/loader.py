@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import asyncio
+import graphlib
+import json
+import logging
+import os
+import pathlib
+import sys
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Self, Tuple
+
+if TYPE_CHECKING:
+    from tinybot.bot import TinyBot
+
+log = logging.getLogger("tinybot.loader")
+
+COGS_PATH: pathlib.Path = pathlib.Path(__file__).parent.parent / "cogs"
+
+
+def downloader_path() -> pathlib.Path:
+    """Where the downloader keeps its repos, index and libraries."""
+    return pathlib.Path(os.getenv("DOWNLOADER_PATH", "downloader"))
+
+
+def libs_path(data_path: pathlib.Path) -> pathlib.Path:
+    return data_path / "libs"
+
+
+def activate_libs(data_path: pathlib.Path) -> Optional[pathlib.Path]:
+    """
+    Puts the current dependency directory on ``sys.path`` and removes the other ones.
+
+    Called before loading cogs so installed cogs can import their requirements. The
+    directory goes last, so a cog pinning one of the bot's own dependencies does not
+    replace the bot's copy.
+
+    Returns
+    -------
+        Optional[pathlib.Path]
+    """
+    current_file = libs_path(data_path) / "current"
+    if not current_file.exists():
+        return None
+    target = libs_path(data_path) / current_file.read_text(encoding="utf-8").strip()
+    root = str(libs_path(data_path).resolve())
+    sys.path[:] = [path for path in sys.path if not path.startswith(root)]
+    sys.path.append(str(target.resolve()))
+    return target
+
+
+class CogInfo:
+    """
+    Loading metadata of a cog.
+
+    Read from an optional ``info.json`` next to the cog's ``__init__.py``:
+        requires: Names of the cogs that have to be loaded first.
+        lazy: Defer importing the cog until one of its commands is used.
+        commands: Top level command names of a lazy cog, needed to know when to load it.
+        intents: Gateway intents the cog needs, e.g. ``["members", "presences"]``.
+        member_cache: Member cache flags the cog needs, ``joined`` and/or ``voice``.
+        chunk_guilds: Chunk a guild before running any of the cog's commands in it.
+    """
+
+    __slots__ = ("name", "requires", "lazy", "commands", "intents", "member_cache", "chunk_guilds")
+
+    def __init__(
+        self: Self,
+        name: str,
+        requires: List[str] | None = None,
+        lazy: bool = False,
+        commands: List[str] | None = None,
+        intents: List[str] | None = None,
+        member_cache: List[str] | None = None,
+        chunk_guilds: bool = False,
+    ) -> None:
+        self.name = name
+        self.requires = requires or []
+        self.lazy = lazy
+        self.commands = commands or []
+        self.intents = intents or []
+        self.member_cache = member_cache or []
+        self.chunk_guilds = chunk_guilds
+
+    @property
+    def extension(self: Self) -> str:
+        return f"tinybot.cogs.{self.name}"
+
+    @classmethod
+    def from_path(cls, path: pathlib.Path) -> CogInfo:
+        name = path.stem
+        info_file = path / "info.json"
+        if path.is_dir() and info_file.exists():
+            data = json.loads(info_file.read_text(encoding="utf-8"))
+            return cls(
+                name,
+                requires=data.get("requires"),
+                lazy=data.get("lazy", False),
+                commands=data.get("commands"),
+                intents=data.get("intents"),
+                member_cache=data.get("member_cache"),
+                chunk_guilds=data.get("chunk_guilds", False),
+            )
+        return cls(name)
+
+
+def discover_cogs(path: pathlib.Path = COGS_PATH) -> Dict[str, CogInfo]:
+    """
+    Lists the cogs in ``path``, skipping private modules and packages.
+
+    Returns
+    -------
+        Dict[str, CogInfo]
+    """
+    cogs = {}
+    for entry in sorted(path.iterdir()):
+        if entry.name.startswith("_"):
+            continue
+        if entry.is_dir() or entry.suffix == ".py":
+            info = CogInfo.from_path(entry)
+            cogs[info.name] = info
+    return cogs
+
+
+def _with_requirements(cogs: Dict[str, CogInfo], names: List[str]) -> List[str]:
+    """Returns ``names`` along with every cog they require, directly or not."""
+    wanted: List[str] = []
+    stack = list(names)
+    while stack:
+        name = stack.pop()
+        if name in wanted:
+            continue
+        wanted.append(name)
+        if name in cogs:
+            stack.extend(cogs[name].requires)
+    return wanted
+
+
+async def load_cogs(
+    bot: TinyBot, cogs: Dict[str, CogInfo], names: List[str]
+) -> Dict[str, Tuple[str, float]]:
+    """
+    Loads the cogs ``names`` and their requirements, running every cog whose
+    requirements are loaded concurrently.
+
+    Cogs that are already loaded are skipped. A cog is not loaded when one of
+    its requirements is missing, failed, or is part of a dependency cycle.
+
+    Parameters
+    ----------
+    bot: TinyBot
+        The bot to load the cogs on.
+    cogs: Dict[str, CogInfo]
+        Every known cog.
+    names: List[str]
+        Names of the cogs to load.
+
+    Returns
+    -------
+        Dict[str, Tuple[str, float]]
+            The status and load time in seconds of each cog.
+    """
+    results: Dict[str, Tuple[str, float]] = {}
+    graph = {
+        name: cogs[name].requires if name in cogs else []
+        for name in _with_requirements(cogs, names)
+    }
+
+    # Each pass drops one cycle, until the rest of the graph sorts. The cogs requiring
+    # a cog of a cycle are still sorted, and not loaded because it is not loaded.
+    while True:
+        sorter = graphlib.TopologicalSorter(graph)
+        try:
+            sorter.prepare()
+        except graphlib.CycleError as e:
+            cycle = set(e.args[1])
+            log.error("Dependency cycle between cogs: %s", " -> ".join(e.args[1]))
+            for name in cycle:
+                results[name] = ("dependency cycle", 0.0)
+            graph = {
+                name: [r for r in requires if r not in cycle]
+                for name, requires in graph.items()
+                if name not in cycle
+            }
+        else:
+            break
+
+    async def load(name: str) -> None:
+        if name not in cogs:
+            results[name] = ("not found", 0.0)
+            return
+        info = cogs[name]
+        if info.extension in bot.extensions:
+            results[name] = ("loaded", 0.0)
+            return
+        for required in info.requires:
+            if results.get(required, ("not found",))[0] != "loaded":
+                log.error("Not loading cog %s, it requires %s which is not loaded.", name, required)
+                results[name] = (f"requires {required}", 0.0)
+                return
+        started = time.perf_counter()
+        try:
+            await bot.load_extension(info.extension)
+        except Exception:
+            log.exception(f"Failed to load cog: {info.extension}", exc_info=True)
+            results[name] = ("failed", time.perf_counter() - started)
+        else:
+            log.info(f"Loaded cog: {info.extension}")
+            results[name] = ("loaded", time.perf_counter() - started)
+
+    pending: Dict[asyncio.Task, str] = {}
+    while sorter.is_active():
+        for name in sorter.get_ready():
+            pending[asyncio.create_task(load(name))] = name
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            sorter.done(pending.pop(task))
+
+    return results
+
+
+def log_load_times(results: Dict[str, Tuple[str, float]], total: float) -> None:
+    width = max([len(name) for name in results] + [len("Cog")])
+    log.info("-" * (width + 32))
+    log.info(f"{'Cog':<{width}} | {'Status':<18} | {'Time':>6}")
+    log.info("-" * (width + 32))
+    for name, (status, elapsed) in sorted(results.items(), key=lambda item: -item[1][1]):
+        log.info(f"{name:<{width}} | {status:<18} | {elapsed:>5.2f}s")
+    log.info("-" * (width + 32))
+    loaded = sum(1 for status, _ in results.values() if status == "loaded")
+    log.info(f"Loaded {loaded}/{len(results)} cogs in {total:.2f}s")
@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+import collections
+import datetime
+import logging
+import sys
+from typing import Any, Collection, Dict, Iterator, List, Literal, Optional, Self, Set, Union
+
+import discord
+from discord.raw_models import RawBulkMessageDeleteEvent
+from discord.state import AutoShardedConnectionState
+
+log = logging.getLogger("tinybot.messages")
+
+Mode = Literal["full", "compact", "off"]
+MODES = ("full", "compact", "off")
+
+
+class CachedMessage:
+    """
+    What the compact cache keeps of a message. Embeds, attachments, reactions and the
+    author's member object are dropped, :meth:`inflate` builds a ``Message`` back.
+    """
+
+    __slots__ = ("id", "channel_id", "guild_id", "author_id", "content", "edited_at")
+
+    def __init__(
+        self: Self,
+        id: int,
+        channel_id: int,
+        guild_id: Optional[int],
+        author_id: int,
+        content: str,
+        edited_at: Optional[datetime.datetime] = None,
+    ) -> None:
+        self.id = id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.content = content
+        self.edited_at = edited_at
+
+    @classmethod
+    def from_message(cls: type[CachedMessage], message: discord.Message) -> CachedMessage:
+        return cls(
+            message.id,
+            message.channel.id,
+            message.guild.id if message.guild is not None else None,
+            message.author.id,
+            message.content,
+            message.edited_at,
+        )
+
+    @property
+    def created_at(self: Self) -> datetime.datetime:
+        return discord.utils.snowflake_time(self.id)
+
+    def inflate(self: Self, state: Any) -> discord.Message:
+        """
+        Builds a ``Message`` from the record. The channel and author are resolved from
+        the current caches, an author that left them is a bare ``User``.
+        """
+        data: Dict[str, Any] = {
+            "id": self.id,
+            "channel_id": self.channel_id,
+            "attachments": [],
+            "embeds": [],
+            "edited_timestamp": self.edited_at.isoformat() if self.edited_at is not None else None,
+            "type": 0,
+            "pinned": False,
+            "mention_everyone": False,
+            "tts": False,
+            "content": self.content,
+        }
+        if self.guild_id is not None:
+            data["guild_id"] = self.guild_id
+        channel, guild = state._get_guild_channel(data)
+        message = discord.Message(state=state, channel=channel, data=data)  # type: ignore
+        author = guild.get_member(self.author_id) if guild is not None else None
+        if author is None:
+            author = state.get_user(self.author_id) or discord.User(
+                state=state,
+                data={"id": self.author_id, "username": "Unknown User", "discriminator": "0000", "avatar": None},
+            )
+        message.author = author
+        return message
+
+    def size(self: Self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.content)
+
+
+Entry = Union[discord.Message, CachedMessage]
+
+
+def _keys(entry: Entry) -> tuple[int, Optional[int]]:
+    if isinstance(entry, CachedMessage):
+        return entry.channel_id, entry.guild_id
+    return entry.channel.id, entry.guild.id if entry.guild is not None else None
+
+
+def _message_size(message: discord.Message) -> int:
+    """Shallow size of a message and of the objects only it references."""
+    size = sys.getsizeof(message) + sys.getsizeof(message.content)
+    for items in (message.embeds, message.attachments, message.reactions, message.mentions, message.stickers):
+        size += sys.getsizeof(items) + sum(sys.getsizeof(item) for item in items)
+    return size
+
+
+class MessageCache:
+    """
+    The message cache of the bot, in place of discord.py's single deque.
+
+    Messages are bounded in total, per channel and per guild, so a busy channel only
+    evicts its own history. Lookups by id are a dict access instead of a scan.
+
+    Modes:
+        full: Keeps the ``Message`` objects, like discord.py does.
+        compact: Keeps a :class:`CachedMessage` per message, with its ids, content and
+            edit time, and builds a ``Message`` when one is read. Much smaller, but
+            embeds, attachments and reactions are not kept, and edits made to a
+            returned message, other than by ``MESSAGE_UPDATE``, are not stored.
+        off: Keeps nothing.
+
+    Parameters
+    ----------
+    mode: Mode
+        ``full``, ``compact`` or ``off``.
+    size: int
+        Messages kept in total.
+    channel_size: int
+        Messages kept per channel, 0 for no limit besides ``size``.
+    guild_size: int
+        Messages kept per guild, 0 for no limit besides ``size``.
+    """
+
+    def __init__(
+        self: Self, mode: Mode = "full", size: int = 1000, channel_size: int = 0, guild_size: int = 0
+    ) -> None:
+        if mode not in MODES:
+            raise ValueError(f"Unknown message cache mode {mode!r}, expected one of {', '.join(MODES)}")
+        self.mode = mode
+        self.size = size
+        self.channel_size = channel_size
+        self.guild_size = guild_size
+        self.state: Any = None
+        # Oldest first, snowflakes grow with time so every order by id is also by age.
+        self._entries: collections.OrderedDict[int, Entry] = collections.OrderedDict()
+        self._channels: Dict[int, collections.OrderedDict[int, None]] = {}
+        self._guild_channels: Dict[int, Set[int]] = {}
+        self._guild_counts: collections.Counter = collections.Counter()
+        self.evicted: collections.Counter = collections.Counter()
+
+    @property
+    def compact(self: Self) -> bool:
+        return self.mode == "compact"
+
+    def clear(self: Self) -> None:
+        self._entries.clear()
+        self._channels.clear()
+        self._guild_channels.clear()
+        self._guild_counts.clear()
+
+    def __len__(self: Self) -> int:
+        return len(self._entries)
+
+    def __iter__(self: Self) -> Iterator[discord.Message]:
+        for entry in list(self._entries.values()):
+            yield self._message(entry)
+
+    def __reversed__(self: Self) -> Iterator[discord.Message]:
+        for entry in reversed(list(self._entries.values())):
+            yield self._message(entry)
+
+    def _message(self: Self, entry: Entry) -> discord.Message:
+        return entry.inflate(self.state) if isinstance(entry, CachedMessage) else entry
+
+    # Writes, called by the connection state.
+
+    def append(self: Self, message: discord.Message) -> None:
+        if message.id in self._entries:
+            self._pop(message.id)
+        entry = CachedMessage.from_message(message) if self.compact else message
+        channel_id, guild_id = _keys(entry)
+        self._entries[message.id] = entry
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = self._channels[channel_id] = collections.OrderedDict()
+        channel[message.id] = None
+        if guild_id is not None:
+            self._guild_channels.setdefault(guild_id, set()).add(channel_id)
+            self._guild_counts[guild_id] += 1
+
+        if self.channel_size and len(channel) > self.channel_size:
+            self._evict(next(iter(channel)), "channel")
+        if guild_id is not None and self.guild_size and self._guild_counts[guild_id] > self.guild_size:
+            self._evict(self._oldest_in_guild(guild_id), "guild")
+        while len(self._entries) > self.size:
+            self._evict(next(iter(self._entries)), "size")
+
+    def _oldest_in_guild(self: Self, guild_id: int) -> int:
+        return min(next(iter(self._channels[channel_id])) for channel_id in self._guild_channels[guild_id])
+
+    def _evict(self: Self, message_id: int, reason: str) -> None:
+        self._pop(message_id)
+        self.evicted[reason] += 1
+
+    def _pop(self: Self, message_id: int) -> Optional[Entry]:
+        entry = self._entries.pop(message_id, None)
+        if entry is None:
+            return None
+        channel_id, guild_id = _keys(entry)
+        channel = self._channels[channel_id]
+        del channel[message_id]
+        if not channel:
+            del self._channels[channel_id]
+            if guild_id is not None:
+                channels = self._guild_channels[guild_id]
+                channels.discard(channel_id)
+                if not channels:
+                    del self._guild_channels[guild_id]
+        if guild_id is not None:
+            self._guild_counts[guild_id] -= 1
+            if self._guild_counts[guild_id] <= 0:
+                del self._guild_counts[guild_id]
+        return entry
+
+    def remove(self: Self, message: discord.abc.Snowflake) -> None:
+        self._pop(message.id)
+
+    def pop_many(self: Self, message_ids: Collection[int]) -> List[discord.Message]:
+        """Removes the cached messages among ``message_ids`` and returns them."""
+        entries = [self._pop(message_id) for message_id in message_ids]
+        return [self._message(entry) for entry in entries if entry is not None]
+
+    def remove_guild(self: Self, guild_id: int) -> None:
+        for channel_id in list(self._guild_channels.get(guild_id, ())):
+            for message_id in list(self._channels.get(channel_id, ())):
+                self._pop(message_id)
+
+    def update(self: Self, data: Dict[str, Any]) -> None:
+        """Applies a ``MESSAGE_UPDATE`` to a compact record, full messages are updated by discord.py."""
+        entry = self._entries.get(int(data["id"]))
+        if not isinstance(entry, CachedMessage):
+            return
+        if "content" in data:
+            entry.content = data["content"]
+        if data.get("edited_timestamp"):
+            entry.edited_at = discord.utils.parse_time(data["edited_timestamp"])
+
+    # Reads
+
+    def get(self: Self, message_id: Optional[int]) -> Optional[discord.Message]:
+        entry = self._entries.get(message_id)  # type: ignore
+        return self._message(entry) if entry is not None else None
+
+    def history(self: Self, channel_id: int, limit: Optional[int] = None) -> List[discord.Message]:
+        """
+        Returns the cached messages of a channel, newest first.
+
+        Parameters
+        ----------
+        channel_id: int
+            A channel or thread id.
+        limit: Optional[int]
+            How many messages to return at most.
+
+        Returns
+        -------
+            List[discord.Message]
+        """
+        ids = list(reversed(self._channels.get(channel_id, ())))[:limit]
+        return [self._message(self._entries[message_id]) for message_id in ids]
+
+    def stats(self: Self) -> Dict[str, Any]:
+        """
+        Returns the size of the cache, its limits and evictions, and an estimate of the
+        memory the cached messages use. The estimate walks every message.
+
+        Returns
+        -------
+            Dict[str, Any]
+        """
+        if self.compact:
+            size = sum(entry.size() for entry in self._entries.values())  # type: ignore
+        else:
+            size = sum(_message_size(entry) for entry in self._entries.values())  # type: ignore
+        # The id index, the per channel index and the records.
+        size += sys.getsizeof(self._entries) + sum(sys.getsizeof(channel) for channel in self._channels.values())
+        return {
+            "mode": self.mode,
+            "messages": len(self._entries),
+            "channels": len(self._channels),
+            "guilds": len(self._guild_counts),
+            "size": self.size,
+            "channel_size": self.channel_size,
+            "guild_size": self.guild_size,
+            "evicted": dict(self.evicted),
+            "bytes": size,
+            "bytes_per_message": size / len(self._entries) if self._entries else 0.0,
+        }
+
+
+class MessageCacheState(AutoShardedConnectionState):
+    """The connection state of the bot, keeps its messages in a :class:`MessageCache`."""
+
+    def __init__(self: Self, *args: Any, message_cache: MessageCache, **kwargs: Any) -> None:
+        # clear() runs in the parent's __init__ and installs the cache.
+        self.message_cache = message_cache
+        message_cache.state = self
+        super().__init__(*args, **kwargs)
+
+    def clear(self: Self, *, views: bool = True) -> None:
+        super().clear(views=views)
+        self.message_cache.clear()
+        self._messages = None if self.message_cache.mode == "off" else self.message_cache  # type: ignore
+
+    def _get_message(self: Self, msg_id: Optional[int]) -> Optional[discord.Message]:
+        return self._messages.get(msg_id) if self._messages is not None else None  # type: ignore
+
+    def _update_message_references(self: Self) -> None:
+        # Compact records resolve their guild and channel when they are read.
+        if not self.message_cache.compact:
+            super()._update_message_references()
+
+    def parse_message_update(self: Self, data: Any) -> None:
+        super().parse_message_update(data)
+        if self._messages is not None:
+            self.message_cache.update(data)
+
+    def parse_message_delete_bulk(self: Self, data: Any) -> None:
+        raw = RawBulkMessageDeleteEvent(data)
+        found = self.message_cache.pop_many(raw.message_ids) if self._messages is not None else []
+        raw.cached_messages = found
+        self.dispatch("raw_bulk_message_delete", raw)
+        if found:
+            self.dispatch("bulk_message_delete", found)
+
+    def parse_guild_delete(self: Self, data: Any) -> None:
+        if self._messages is None:
+            super().parse_guild_delete(data)
+            return
+        guild = self._get_guild(int(data["id"]))
+        if guild is not None and not data.get("unavailable", False):
+            self.message_cache.remove_guild(guild.id)
+        # discord.py would rebuild a deque from the messages of the other guilds.
+        self._messages = None
+        try:
+            super().parse_guild_delete(data)
+        finally:
+            self._messages = self.message_cache  # type: ignore
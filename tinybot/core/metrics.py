@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import collections
+import logging
+import math
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Self, Tuple
+
+from aiohttp import web
+
+from tinybot.utils import get_rss
+
+if TYPE_CHECKING:
+    from tinybot.bot import TinyBot
+
+log = logging.getLogger("tinybot.metrics")
+
+# A metric family: {"name", "type", "help", "samples": [[suffix, labels, value], ...]}, plain JSON so
+# clusters can send theirs to the launcher.
+Family = Dict[str, Any]
+
+COMMAND_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds, as Prometheus expects them."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self: Self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts: List[int] = [0] * len(buckets)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self: Self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self: Self, labels: Dict[str, str]) -> List[list]:
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append(["_bucket", {**labels, "le": str(bound)}, cumulative])
+        samples.append(["_bucket", {**labels, "le": "+Inf"}, self.count])
+        samples.append(["_sum", labels, self.sum])
+        samples.append(["_count", labels, self.count])
+        return samples
+
+
+def family(name: str, kind: str, help_text: str, samples: List[list]) -> Family:
+    return {"name": name, "type": kind, "help": help_text, "samples": samples}
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items()) + "}"
+
+
+def render(families: List[Family]) -> str:
+    """Renders metric families in the Prometheus text format, merging the ones with the same name."""
+    merged: Dict[str, Family] = {}
+    for item in families:
+        if item["name"] in merged:
+            merged[item["name"]]["samples"].extend(item["samples"])
+        else:
+            merged[item["name"]] = {**item, "samples": list(item["samples"])}
+    lines = []
+    for item in merged.values():
+        lines.append(f"# HELP {item['name']} {item['help']}")
+        lines.append(f"# TYPE {item['name']} {item['type']}")
+        for suffix, labels, value in item["samples"]:
+            lines.append(f"{item['name']}{suffix}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """
+    Counters and histograms of a bot process.
+
+    Updating them is a dict lookup and an addition, everything else, like the
+    per-shard latencies and the cache sizes, is read when the metrics are collected.
+
+    Parameters
+    ----------
+    bot: TinyBot
+        The bot to observe.
+    lag_interval: float
+        Seconds between two event loop lag measurements.
+    """
+
+    def __init__(self: Self, bot: TinyBot, lag_interval: float = 0.5) -> None:
+        self.bot = bot
+        self.lag_interval = lag_interval
+        self.events: collections.Counter = collections.Counter()
+        self.gateway_events: collections.Counter = collections.Counter()
+        self.shard_events: collections.Counter = collections.Counter()
+        self.commands: collections.Counter = collections.Counter()
+        self.command_errors: collections.Counter = collections.Counter()
+        self.command_latency: Dict[str, Histogram] = {}
+        self.loop_lag: Histogram = Histogram(LAG_BUCKETS)
+        self.loop_lag_max: float = 0.0
+        self._lag_task: Optional[asyncio.Task] = None
+
+    def on_dispatch(self: Self, event_name: str, args: Tuple[Any, ...]) -> None:
+        self.events[event_name] += 1
+        if event_name == "socket_event_type":
+            self.gateway_events[args[0]] += 1
+        elif event_name in ("shard_connect", "shard_disconnect", "shard_resumed"):
+            self.shard_events[(args[0], event_name[6:])] += 1
+
+    def on_command(self: Self, command: str, seconds: float) -> None:
+        self.commands[command] += 1
+        histogram = self.command_latency.get(command)
+        if histogram is None:
+            histogram = self.command_latency[command] = Histogram(COMMAND_BUCKETS)
+        histogram.observe(seconds)
+
+    def on_command_error(self: Self, command: Optional[str], error: BaseException) -> None:
+        self.command_errors[(command or "", type(error).__name__)] += 1
+
+    def start(self: Self) -> None:
+        if self._lag_task is None:
+            self._lag_task = asyncio.create_task(self._measure_lag())
+
+    async def close(self: Self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+
+    async def _measure_lag(self: Self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, loop.time() - expected)
+            self.loop_lag.observe(lag)
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+
+    def collect(self: Self) -> List[Family]:
+        """
+        Returns the current value of every metric.
+
+        Returns
+        -------
+            List[Family]
+        """
+        bot = self.bot
+        base = {} if bot.cluster_id is None else {"cluster": str(bot.cluster_id)}
+        # Read and reset, so the gauge shows the worst lag since the last scrape.
+        lag_max, self.loop_lag_max = self.loop_lag_max, 0.0
+        rss = get_rss()
+        queue = self.bot.scheduler.families(base)
+        if bot.send_queue is not None:
+            queue += bot.send_queue.families(base)
+        queue += bot.cooldowns.families(base)
+        return queue + [
+            family(
+                "tinybot_shard_latency_seconds",
+                "gauge",
+                "Gateway heartbeat latency per shard.",
+                [["", {**base, "shard": str(shard_id)}, latency] for shard_id, latency in bot.latencies],
+            ),
+            family(
+                "tinybot_shard_events_total",
+                "counter",
+                "Shard connects, disconnects and resumes.",
+                [
+                    ["", {**base, "shard": str(shard_id), "event": event}, count]
+                    for (shard_id, event), count in self.shard_events.items()
+                ],
+            ),
+            family(
+                "tinybot_events_total",
+                "counter",
+                "Dispatched client events by name.",
+                [["", {**base, "event": name}, count] for name, count in self.events.items()],
+            ),
+            family(
+                "tinybot_gateway_events_total",
+                "counter",
+                "Received gateway events by type.",
+                [["", {**base, "type": str(name)}, count] for name, count in self.gateway_events.items()],
+            ),
+            family(
+                "tinybot_commands_total",
+                "counter",
+                "Invoked commands.",
+                [["", {**base, "command": name}, count] for name, count in self.commands.items()],
+            ),
+            family(
+                "tinybot_command_errors_total",
+                "counter",
+                "Command errors by command and error type.",
+                [
+                    ["", {**base, "command": name, "error": error}, count]
+                    for (name, error), count in self.command_errors.items()
+                ],
+            ),
+            family(
+                "tinybot_command_duration_seconds",
+                "histogram",
+                "Time spent running a command.",
+                [
+                    sample
+                    for name, histogram in self.command_latency.items()
+                    for sample in histogram.samples({**base, "command": name})
+                ],
+            ),
+            family(
+                "tinybot_event_loop_lag_seconds",
+                "histogram",
+                "Delay of the event loop in running a scheduled callback.",
+                self.loop_lag.samples(base),
+            ),
+            family(
+                "tinybot_event_loop_lag_max_seconds",
+                "gauge",
+                "Worst event loop lag since the last scrape.",
+                [["", base, lag_max]],
+            ),
+            family(
+                "tinybot_cached_objects",
+                "gauge",
+                "Objects in the client caches.",
+                [
+                    ["", {**base, "cache": "guilds"}, len(bot.guilds)],
+                    ["", {**base, "cache": "members"}, sum(len(guild.members) for guild in bot.guilds)],
+                    ["", {**base, "cache": "users"}, len(bot.users)],
+                    ["", {**base, "cache": "messages"}, len(bot.cached_messages)],
+                ],
+            ),
+            family(
+                "tinybot_resident_memory_bytes",
+                "gauge",
+                "Resident set size of the process.",
+                # Left without a sample where the platform does not report it.
+                [["", base, rss]] if rss is not None else [],
+            ),
+        ]
+
+
+class MetricsServer:
+    """
+    Serves ``/metrics`` in the Prometheus text format.
+
+    Parameters
+    ----------
+    collect: Callable[[], Awaitable[List[Family]]]
+        Returns the metric families on every scrape.
+    port: int
+        Port to listen on.
+    host: str
+        Address to listen on, only local by default.
+    """
+
+    def __init__(
+        self: Self, collect: Callable[[], Awaitable[List[Family]]], port: int, host: str = "127.0.0.1"
+    ) -> None:
+        self.collect = collect
+        self.port = port
+        self.host = host
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self: Self, _request: web.Request) -> web.Response:
+        started = time.perf_counter()
+        families = await self.collect()
+        families.append(
+            family(
+                "tinybot_scrape_duration_seconds",
+                "gauge",
+                "Time spent collecting these metrics.",
+                [["", {}, time.perf_counter() - started]],
+            )
+        )
+        return web.Response(text=render(families), content_type="text/plain", charset="utf-8")
+
+    async def start(self: Self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info("Serving metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def close(self: Self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
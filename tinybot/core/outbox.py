@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+from typing import Any, Deque, Dict, List, Optional, Self
+
+import discord
+
+from tinybot.core.metrics import COMMAND_BUCKETS, Family, Histogram, family
+
+log = logging.getLogger("tinybot.outbox")
+
+# Discord's limit on the content of a message.
+MAX_LENGTH = 2000
+# Keyword arguments that do not stop two messages from being merged, as long as they are equal.
+MERGEABLE = ("allowed_mentions", "silent", "suppress_embeds")
+SEPARATOR = "\n"
+# The route whose rate limits discord.py tracks per channel, see discord.http.HTTPClient.request.
+MESSAGE_ROUTE = "POST /channels/{channel_id}/messages"
+
+
+class _Pending:
+    __slots__ = ("content", "kwargs", "future", "enqueued")
+
+    def __init__(self: Self, content: Optional[str], kwargs: Dict[str, Any], now: float) -> None:
+        self.content = content
+        self.kwargs = kwargs
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued = now
+
+    @property
+    def mergeable(self: Self) -> bool:
+        return bool(self.content) and all(key in MERGEABLE for key in self.kwargs)
+
+
+class ChannelQueue:
+    """The messages waiting to be sent to one channel and the local view of its rate limit."""
+
+    __slots__ = (
+        "channel", "pending", "sending", "task", "limit", "remaining", "reset_at",
+        "requests", "messages", "wait_total", "wait_max", "last_used",
+    )
+
+    def __init__(self: Self, channel: discord.abc.Messageable, limit: int, now: float) -> None:
+        self.channel = channel
+        self.pending: Deque[_Pending] = collections.deque()
+        # The batch being sent, already taken from pending.
+        self.sending: List[_Pending] = []
+        self.task: Optional[asyncio.Task] = None
+        self.limit = limit
+        self.remaining = limit
+        # Loop time at which the rate limit window resets, 0 when no window is open.
+        self.reset_at: float = 0.0
+        self.requests: int = 0
+        self.messages: int = 0
+        self.wait_total: float = 0.0
+        self.wait_max: float = 0.0
+        self.last_used = now
+
+    def to_dict(self: Self) -> Dict[str, Any]:
+        return {
+            "pending": len(self.pending),
+            "requests": self.requests,
+            "messages": self.messages,
+            "remaining": self.remaining,
+            "limit": self.limit,
+            "wait_avg": self.wait_total / self.messages if self.messages else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+class SendQueue:
+    """
+    Sends messages one channel at a time, merging bursts and pacing them by the channel's rate limit.
+
+    Every channel has a queue drained by one task. A message to a quiet channel goes
+    out at once. While a channel is busy, that is when it already used part of its
+    rate limit, the first waiting message waits up to ``window`` seconds for others,
+    then consecutive plain text messages are merged into one, separated by new lines,
+    as long as the result fits in 2000 characters. The callers of a merged message
+    all get the same :class:`discord.Message`.
+
+    The queue keeps a local view of every channel's rate limit, taken from
+    discord.py's bucket after each request, and waits for the window to reset
+    instead of handing discord.py requests that would be rate limited. Before
+    Discord's headers are known, a channel is assumed to allow ``limit`` messages
+    per ``per`` seconds.
+
+    Parameters
+    ----------
+    window: float
+        Seconds the first waiting message of a busy channel waits for others to merge with.
+    limit: int
+        Messages per rate limit window assumed before Discord's headers are known.
+    per: float
+        Seconds of the assumed rate limit window.
+    """
+
+    def __init__(self: Self, window: float = 0.05, limit: int = 5, per: float = 5.0) -> None:
+        self.window = window
+        self.limit = limit
+        self.per = per
+        self.channels: Dict[int, ChannelQueue] = {}
+        self.wait_time: Histogram = Histogram(COMMAND_BUCKETS)
+        self.requests: int = 0
+        self.messages: int = 0
+        self.closed: bool = False
+
+    async def send(
+        self: Self, destination: discord.abc.Messageable, content: Optional[str] = None, **kwargs: Any
+    ) -> discord.Message:
+        """
+        Queues a message, accepts the arguments of :meth:`discord.abc.Messageable.send`.
+
+        Returns
+        -------
+            discord.Message
+                The message sent, shared with the other messages merged into it.
+        """
+        if self.closed:
+            raise RuntimeError("The send queue is closed.")
+        channel = await destination._get_channel()
+        loop = asyncio.get_running_loop()
+        queue = self.channels.get(channel.id)
+        if queue is None:
+            self._prune(loop.time())
+            queue = self.channels[channel.id] = ChannelQueue(channel, self.limit, loop.time())
+        pending = _Pending(str(content) if content is not None else None, kwargs, loop.time())
+        queue.pending.append(pending)
+        if queue.task is None:
+            queue.task = asyncio.create_task(self._drain(queue))
+        return await pending.future
+
+    def _prune(self: Self, now: float) -> None:
+        """Forgets the channels that sent nothing in the last five minutes, once there are many."""
+        if len(self.channels) < 1024:
+            return
+        idle = [
+            channel_id
+            for channel_id, queue in self.channels.items()
+            if queue.task is None and now - queue.last_used > 300
+        ]
+        for channel_id in idle:
+            del self.channels[channel_id]
+
+    def _batch(self: Self, queue: ChannelQueue) -> List[_Pending]:
+        """Takes the next message and the consecutive ones that can be merged with it."""
+        while queue.pending and queue.pending[0].future.done():
+            # Its caller was cancelled.
+            queue.pending.popleft()
+        if not queue.pending:
+            return []
+        batch = [queue.pending.popleft()]
+        first = batch[0]
+        if not first.mergeable:
+            return batch
+        length = len(first.content)
+        while queue.pending:
+            candidate = queue.pending[0]
+            if candidate.future.done():
+                queue.pending.popleft()
+                continue
+            if not candidate.mergeable or candidate.kwargs != first.kwargs:
+                break
+            length += len(SEPARATOR) + len(candidate.content)
+            if length > MAX_LENGTH:
+                break
+            batch.append(queue.pending.popleft())
+        return batch
+
+    def _sync(self: Self, queue: ChannelQueue, http: Any) -> None:
+        """Copies what discord.py learnt from Discord's headers about the channel's bucket."""
+        # Keyed by Discord's bucket hash once discord.py knows it, by the route before.
+        bucket_hash = http._bucket_hashes.get(MESSAGE_ROUTE, MESSAGE_ROUTE)
+        ratelimit = http._buckets.get(f"{bucket_hash}:{queue.channel.id}") or http._buckets.get(
+            f"{MESSAGE_ROUTE}:{queue.channel.id}"
+        )
+        if ratelimit is None or not ratelimit.dirty or ratelimit.expires is None:
+            return
+        queue.limit = ratelimit.limit
+        queue.remaining = ratelimit.remaining
+        queue.reset_at = ratelimit.expires
+
+    async def _drain(self: Self, queue: ChannelQueue) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while queue.pending:
+                now = loop.time()
+                if now >= queue.reset_at:
+                    queue.remaining, queue.reset_at = queue.limit, 0.0
+                elif queue.remaining <= 0:
+                    await asyncio.sleep(queue.reset_at - now)
+                    continue
+                if queue.remaining < queue.limit and queue.pending[0].mergeable:
+                    delay = queue.pending[0].enqueued + self.window - now
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                batch = self._batch(queue)
+                if not batch:
+                    continue
+                queue.sending = batch
+                await self._send(queue, batch, loop)
+                queue.sending = []
+        finally:
+            # Only left with messages when cancelled, as the bot closes.
+            error = RuntimeError("The send queue was closed before the message was sent.")
+            for pending in (*queue.sending, *queue.pending):
+                if not pending.future.done():
+                    pending.future.set_exception(error)
+            queue.sending = []
+            queue.pending.clear()
+            queue.task = None
+            queue.last_used = loop.time()
+
+    async def _send(
+        self: Self, queue: ChannelQueue, batch: List[_Pending], loop: asyncio.AbstractEventLoop
+    ) -> None:
+        now = loop.time()
+        for pending in batch:
+            waited = now - pending.enqueued
+            self.wait_time.observe(waited)
+            queue.wait_total += waited
+            queue.wait_max = max(queue.wait_max, waited)
+        queue.messages += len(batch)
+        queue.requests += 1
+        self.messages += len(batch)
+        self.requests += 1
+        queue.remaining -= 1
+        if not queue.reset_at:
+            queue.reset_at = now + self.per
+
+        if len(batch) == 1:
+            content = batch[0].content
+        else:
+            content = SEPARATOR.join(pending.content for pending in batch)
+        try:
+            message = await queue.channel.send(content, **batch[0].kwargs)
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+        else:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_result(message)
+        self._sync(queue, queue.channel._state.http)
+
+    async def close(self: Self) -> None:
+        """Stops sending, the callers of the messages not sent yet get a ``RuntimeError``."""
+        self.closed = True
+        tasks = [queue.task for queue in self.channels.values() if queue.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self: Self) -> Dict[str, Any]:
+        """
+        Returns the messages queued, sent and merged, and the queue latency, in total and
+        for the channels with the most queued messages and the longest waits.
+
+        Returns
+        -------
+            Dict[str, Any]
+        """
+        busiest = sorted(
+            self.channels.items(), key=lambda item: (len(item[1].pending), item[1].wait_max), reverse=True
+        )[:5]
+        return {
+            "channels": len(self.channels),
+            "pending": sum(len(queue.pending) for queue in self.channels.values()),
+            "requests": self.requests,
+            "messages": self.messages,
+            "merged": self.messages - self.requests,
+            "wait_avg": self.wait_time.sum / self.wait_time.count if self.wait_time.count else 0.0,
+            "busiest": {channel_id: queue.to_dict() for channel_id, queue in busiest},
+        }
+
+    def families(self: Self, base: Dict[str, str]) -> List[Family]:
+        return [
+            family(
+                "tinybot_send_queue_pending",
+                "gauge",
+                "Messages waiting in the send queue.",
+                [["", base, sum(len(queue.pending) for queue in self.channels.values())]],
+            ),
+            family(
+                "tinybot_send_queue_wait_seconds",
+                "histogram",
+                "Time messages waited in the send queue.",
+                self.wait_time.samples(base),
+            ),
+            family(
+                "tinybot_send_queue_messages_total",
+                "counter",
+                "Messages sent through the send queue, and the requests they took.",
+                [
+                    ["", {**base, "kind": "messages"}, self.messages],
+                    ["", {**base, "kind": "requests"}, self.requests],
+                ],
+            ),
+        ]
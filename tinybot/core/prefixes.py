@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Self, Tuple
+
+import discord
+
+
+class PrefixMatcher:
+    """
+    Finds which of several prefixes a message starts with.
+
+    Prefixes are grouped by their first character and sorted longest first, so a
+    message is only compared with the prefixes sharing its first character and
+    ``!!`` wins over ``!``.
+    """
+
+    __slots__ = ("prefixes", "_by_first")
+
+    def __init__(self: Self, prefixes: Iterable[str]) -> None:
+        self.prefixes: List[str] = sorted({prefix for prefix in prefixes if prefix}, key=len, reverse=True)
+        by_first: Dict[str, List[str]] = {}
+        for prefix in self.prefixes:
+            by_first.setdefault(prefix[0], []).append(prefix)
+        self._by_first: Dict[str, Tuple[str, ...]] = {first: tuple(group) for first, group in by_first.items()}
+
+    def match(self: Self, content: str) -> Optional[str]:
+        candidates = self._by_first.get(content[:1])
+        if candidates is not None:
+            for prefix in candidates:
+                if content.startswith(prefix):
+                    return prefix
+        return None
+
+
+class PrefixCache:
+    """
+    In-memory map of the guilds that have their own prefixes.
+
+    Every message is matched against this map instead of the database, guilds
+    without an entry use the default prefixes. Mentioning the bot always works.
+
+    Parameters
+    ----------
+    default: Iterable[str]
+        Prefixes of guilds without their own and of direct messages.
+    """
+
+    def __init__(self: Self, default: Iterable[str]) -> None:
+        self.default: PrefixMatcher = PrefixMatcher(default)
+        self.mentions: PrefixMatcher = PrefixMatcher([])
+        self._guilds: Dict[int, PrefixMatcher] = {}
+
+    def __len__(self: Self) -> int:
+        return len(self._guilds)
+
+    def set_user(self: Self, user: discord.abc.User) -> None:
+        """Enables the mention prefixes of the bot user."""
+        self.mentions = PrefixMatcher([f"<@{user.id}> ", f"<@!{user.id}> "])
+
+    def set(self: Self, guild_id: int, prefixes: Optional[Iterable[str]]) -> None:
+        """Replaces the prefixes of a guild, ``None`` or an empty list restores the default ones."""
+        prefixes = list(prefixes or [])
+        if prefixes:
+            self._guilds[guild_id] = PrefixMatcher(prefixes)
+        else:
+            self._guilds.pop(guild_id, None)
+
+    def invalidate(self: Self, guild_id: Optional[int] = None) -> None:
+        """Drops the prefixes of a guild, or of every guild when ``guild_id`` is None."""
+        if guild_id is None:
+            self._guilds.clear()
+        else:
+            self._guilds.pop(guild_id, None)
+
+    def matcher(self: Self, guild_id: Optional[int]) -> PrefixMatcher:
+        return self._guilds.get(guild_id, self.default) if guild_id is not None else self.default
+
+    def prefixes(self: Self, guild_id: Optional[int]) -> List[str]:
+        return self.matcher(guild_id).prefixes
+
+    def match(self: Self, message: discord.Message) -> Optional[str]:
+        """Returns the prefix ``message`` starts with, ``None`` when it cannot be a command."""
+        content = message.content
+        if not content:
+            return None
+        return self.matcher(message.guild.id if message.guild else None).match(content) or self.mentions.match(
+            content
+        )
+
+    def command_prefix(self: Self, _bot: discord.Client, message: discord.Message) -> str | List[str]:
+        """``command_prefix`` callable, returns the matched prefix so discord.py does not search again."""
+        prefix = self.match(message)
+        if prefix is not None:
+            return prefix
+        return self.prefixes(message.guild.id if message.guild else None) + self.mentions.prefixes
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import pathlib
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+from typing import Any, Deque, Dict, List, Optional, Self
+
+from tinybot.core.loader import COGS_PATH
+
+log = logging.getLogger("tinybot.profiler")
+
+_COGS_ROOT = str(COGS_PATH.resolve())
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", pathlib.Path(code.co_filename).stem)
+    return f"{module}:{code.co_name}"
+
+
+def owner_of(frames: List[FrameType]) -> str:
+    """
+    Names the cog a stack belongs to, from the innermost frame that lives in a
+    cog package, or the innermost module when no cog is involved.
+    """
+    for frame in reversed(frames):
+        filename = frame.f_code.co_filename
+        if filename.startswith(_COGS_ROOT):
+            cog = pathlib.Path(filename).relative_to(_COGS_ROOT).parts[0].removesuffix(".py")
+            return f"cog {cog} ({_frame_name(frame)})"
+    return _frame_name(frames[-1]) if frames else "unknown"
+
+
+def _stack(frame: Optional[FrameType]) -> List[FrameType]:
+    """Frames from the outermost to ``frame``."""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the event loop thread from a background thread.
+
+    Nothing is traced, the loop runs at full speed and only pays for the GIL the
+    sampler takes every ``interval`` seconds. Samples are aggregated in the
+    collapsed stack format flamegraph tools read: one ``outer;inner count`` line
+    per distinct stack.
+
+    Parameters
+    ----------
+    interval: float
+        Seconds between two samples.
+    """
+
+    def __init__(self: Self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.samples: collections.Counter = collections.Counter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._target: Optional[int] = None
+
+    @property
+    def running(self: Self) -> bool:
+        return self._thread is not None
+
+    def start(self: Self, thread_id: Optional[int] = None) -> None:
+        """Starts sampling ``thread_id``, the calling thread by default."""
+        if self._thread is not None:
+            raise RuntimeError("The profiler is already running.")
+        self.samples.clear()
+        self._target = thread_id or threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="tinybot-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self: Self) -> collections.Counter:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.samples
+
+    def _run(self: Self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            self.samples[";".join(_frame_name(f) for f in _stack(frame))] += 1
+
+    async def profile(self: Self, seconds: float) -> collections.Counter:
+        """Samples the running event loop for ``seconds``."""
+        self.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.stop()
+        return self.samples
+
+    def collapsed(self: Self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def top(self: Self, limit: int = 10) -> List[tuple]:
+        """The functions most often on top of the stack, with their share of the samples."""
+        total = sum(self.samples.values()) or 1
+        leaves: collections.Counter = collections.Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return [(name, count / total) for name, count in leaves.most_common(limit)]
+
+
+class SlowStep:
+    __slots__ = ("when", "duration", "owner", "task", "stack")
+
+    def __init__(self: Self, when: float, duration: float, owner: str, task: str, stack: str) -> None:
+        self.when = when
+        self.duration = duration
+        self.owner = owner
+        self.task = task
+        self.stack = stack
+
+
+class LoopWatchdog:
+    """
+    Reports event loop steps that block for longer than ``threshold`` seconds.
+
+    A background thread schedules a no-op on the loop every ``threshold / 2``
+    seconds. When it does not run within ``threshold``, the loop is stuck in a
+    callback: the thread captures the loop's stack and current task right then,
+    waits until the loop is free again and logs how long it was blocked and by
+    which cog. The loop only pays for a few callbacks per second.
+
+    Parameters
+    ----------
+    threshold: float
+        Seconds a loop step may take before it is reported.
+    history: int
+        Slow steps kept for the ``slow`` command.
+    """
+
+    def __init__(self: Self, threshold: float = 0.5, history: int = 20) -> None:
+        self.threshold = threshold
+        self.slow_steps: Deque[SlowStep] = collections.deque(maxlen=history)
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+
+    @property
+    def running(self: Self) -> bool:
+        return self._thread is not None
+
+    def start(self: Self) -> None:
+        """Watches the running event loop, must be called from it."""
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        # One event per thread, a thread still winding down after stop() never sees it cleared.
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), name="tinybot-watchdog", daemon=True)
+        self._thread.start()
+        log.info("Watching for event loop steps longer than %ss", self.threshold)
+
+    def stop(self: Self) -> None:
+        """Signals the thread to stop without waiting for it, which would block the loop."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread = None
+
+    def _run(self: Self, stop: threading.Event) -> None:
+        while not stop.wait(self.threshold / 2):
+            ack = threading.Event()
+            sent = time.perf_counter()
+            try:
+                self._loop.call_soon_threadsafe(ack.set)
+            except RuntimeError:
+                # The loop was closed.
+                return
+            if ack.wait(self.threshold):
+                continue
+
+            frames = _stack(sys._current_frames().get(self._loop_thread))
+            task = asyncio.current_task(self._loop)
+            stack = "".join(traceback.format_list(traceback.StackSummary.extract((f, f.f_lineno) for f in frames)))
+            while not ack.wait(self.threshold) and not stop.is_set():
+                pass
+            step = SlowStep(
+                when=time.time(),
+                duration=time.perf_counter() - sent,
+                owner=owner_of(frames),
+                task=task.get_name() if task is not None else "callback",
+                stack=stack,
+            )
+            self.slow_steps.append(step)
+            log.warning(
+                "Event loop blocked for %.3fs by %s in %s\n%s", step.duration, step.owner, step.task, step.stack
+            )
+
+    def stats(self: Self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "threshold": self.threshold,
+            "slow_steps": len(self.slow_steps),
+        }
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from typing import Callable, Dict, Iterable, Self
+
+import discord
+
+from tinybot.core.loader import CogInfo
+
+# Member cache flags that are only valid with the matching intent.
+FLAG_INTENTS: Dict[str, str] = {"joined": "members", "voice": "voice_states"}
+
+
+class CacheProfile:
+    """
+    Intents and cache settings the bot connects with.
+
+    Profiles:
+        minimal: Default intents and message content, no member cache and no chunking.
+        standard: Adds the members intent, guilds are chunked on demand.
+        full: Every intent, every guild is chunked at startup.
+
+    Cogs add the intents and member cache flags they declare in their ``info.json``
+    on top of the selected profile.
+    """
+
+    __slots__ = ("name", "intents", "member_cache_flags", "chunk_guilds_at_startup")
+
+    def __init__(
+        self: Self,
+        name: str,
+        intents: discord.Intents,
+        member_cache_flags: discord.MemberCacheFlags,
+        chunk_guilds_at_startup: bool = False,
+    ) -> None:
+        self.name = name
+        self.intents = intents
+        self.member_cache_flags = member_cache_flags
+        self.chunk_guilds_at_startup = chunk_guilds_at_startup
+
+    def with_cogs(self: Self, cogs: Iterable[CogInfo]) -> CacheProfile:
+        """
+        Returns a copy of the profile extended with what ``cogs`` declare.
+
+        Parameters
+        ----------
+        cogs: Iterable[CogInfo]
+            The cogs that will be loaded.
+
+        Returns
+        -------
+            CacheProfile
+        """
+        intents = discord.Intents._from_value(self.intents.value)
+        flags = discord.MemberCacheFlags._from_value(self.member_cache_flags.value)
+        for cog in cogs:
+            for intent in cog.intents:
+                setattr(intents, intent, True)
+            for flag in cog.member_cache:
+                setattr(flags, flag, True)
+                setattr(intents, FLAG_INTENTS[flag], True)
+        return CacheProfile(self.name, intents, flags, self.chunk_guilds_at_startup)
+
+
+def _minimal() -> CacheProfile:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    return CacheProfile("minimal", intents, discord.MemberCacheFlags.none())
+
+
+def _standard() -> CacheProfile:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.members = True
+    return CacheProfile("standard", intents, discord.MemberCacheFlags.from_intents(intents))
+
+
+def _full() -> CacheProfile:
+    intents = discord.Intents.all()
+    return CacheProfile(
+        "full", intents, discord.MemberCacheFlags.from_intents(intents), chunk_guilds_at_startup=True
+    )
+
+
+PROFILES: Dict[str, Callable[[], CacheProfile]] = {
+    "minimal": _minimal,
+    "standard": _standard,
+    "full": _full,
+}
+
+
+def get_profile(name: str) -> CacheProfile:
+    return PROFILES[name]()
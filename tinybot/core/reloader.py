@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import graphlib
+import hashlib
+import logging
+import os
+import pathlib
+import sys
+from typing import TYPE_CHECKING, Dict, List, Optional, Self, Tuple
+
+from discord.ext import commands
+
+if TYPE_CHECKING:
+    from tinybot.bot import TinyBot
+
+log = logging.getLogger("tinybot.reloader")
+
+# path -> (mtime_ns, size, sha1)
+Signature = Dict[str, Tuple[int, int, str]]
+
+
+def extension_files(extension: str) -> List[pathlib.Path]:
+    """
+    Source files of a loaded extension: every ``.py`` file of its package, so new
+    submodules count as changes too, or the module file itself.
+    """
+    module = sys.modules.get(extension)
+    if module is None:
+        return []
+    if getattr(module, "__path__", None):
+        return sorted(
+            file for path in module.__path__ for file in pathlib.Path(path).rglob("*.py")
+            if "__pycache__" not in file.parts
+        )
+    return [pathlib.Path(module.__file__)] if getattr(module, "__file__", None) else []
+
+
+def _file_hash(path: pathlib.Path) -> str:
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+
+def _signature(files: List[pathlib.Path], previous: Optional[Signature] = None) -> Signature:
+    """Hashes ``files``, reusing the hashes of ``previous`` for files whose mtime and size did not move."""
+    previous = previous or {}
+    signature = {}
+    for file in files:
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            continue
+        key = str(file)
+        old = previous.get(key)
+        if old is not None and old[:2] == (stat.st_mtime_ns, stat.st_size):
+            signature[key] = old
+        else:
+            signature[key] = (stat.st_mtime_ns, stat.st_size, _file_hash(file))
+    return signature
+
+
+def _digests(signature: Signature) -> Dict[str, str]:
+    return {path: digest for path, (_, _, digest) in signature.items()}
+
+
+class Reloader:
+    """
+    Keeps the file hashes of every loaded extension and reloads the ones whose
+    sources changed.
+
+    Hashes are taken when an extension is loaded. Files are only hashed again when
+    their mtime or size moved, and a touched but identical file is not a change.
+    An extension that failed to reload is rolled back by discord.py and skipped
+    until its files change again.
+
+    Parameters
+    ----------
+    bot: TinyBot
+        The bot whose extensions are reloaded.
+    """
+
+    def __init__(self: Self, bot: TinyBot) -> None:
+        self.bot = bot
+        self._signatures: Dict[str, Signature] = {}
+        self._failed: Dict[str, Dict[str, str]] = {}
+        self._lock: asyncio.Lock = asyncio.Lock()
+        self._watcher: Optional[asyncio.Task] = None
+
+    def snapshot(self: Self, extension: str) -> None:
+        """Records the current sources of ``extension``, called once it is loaded."""
+        self._signatures[extension] = _signature(extension_files(extension))
+        self._failed.pop(extension, None)
+
+    def forget(self: Self, extension: str) -> None:
+        self._signatures.pop(extension, None)
+        self._failed.pop(extension, None)
+
+    def changed(self: Self) -> Dict[str, Signature]:
+        """
+        Returns the loaded extensions whose sources differ from their snapshot.
+
+        Blocking, hashes changed files.
+
+        Returns
+        -------
+            Dict[str, Signature]
+                The changed extensions mapped to their current signature.
+        """
+        changed = {}
+        for extension, old in list(self._signatures.items()):
+            new = _signature(extension_files(extension), old)
+            # Files that were touched but not modified are not hashed again next time.
+            self._signatures[extension] = {
+                path: new[path] if path in new and new[path][2] == value[2] else value
+                for path, value in old.items()
+            }
+            digests = _digests(new)
+            if digests != _digests(old) and digests != self._failed.get(extension):
+                changed[extension] = new
+        return changed
+
+    def _order(self: Self, extensions: List[str]) -> List[str]:
+        """Sorts ``extensions`` so required cogs are reloaded before the cogs requiring them."""
+        names = {extension.rsplit(".", 1)[-1]: extension for extension in extensions}
+        sorter = graphlib.TopologicalSorter(
+            {
+                name: [r for r in self.bot.cog_infos[name].requires if r in names] if name in self.bot.cog_infos else []
+                for name in names
+            }
+        )
+        try:
+            return [names[name] for name in sorter.static_order()]
+        except graphlib.CycleError:
+            return sorted(extensions)
+
+    async def reload_changed(self: Self) -> Dict[str, str]:
+        """
+        Reloads the extensions whose sources changed, in dependency order.
+
+        Returns
+        -------
+            Dict[str, str]
+                The status of each reloaded extension, ``reloaded`` or ``failed``.
+        """
+        async with self._lock:
+            changed = await asyncio.to_thread(self.changed)
+            results = {}
+            for extension in self._order(list(changed)):
+                if extension not in self.bot.extensions:
+                    continue
+                try:
+                    await self.bot.reload_extension(extension)
+                except commands.ExtensionError as e:
+                    log.error(
+                        "Could not reload %s, keeping the previous version",
+                        extension,
+                        exc_info=getattr(e, "original", e),
+                    )
+                    self._failed[extension] = _digests(changed[extension])
+                    results[extension] = "failed"
+                else:
+                    log.info("Reloaded %s", extension)
+                    results[extension] = "reloaded"
+            return results
+
+    def start_watching(self: Self, interval: float = 1.0) -> None:
+        """Reloads changed extensions every ``interval`` seconds, meant for development."""
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch(interval))
+
+    async def stop_watching(self: Self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+
+    async def _watch(self: Self, interval: float) -> None:
+        log.info("Watching %s extensions for changes every %ss", len(self._signatures), interval)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload_changed()
+            except Exception:
+                log.exception("Reload watcher failed")
+
+
+def watch_interval() -> Optional[float]:
+    """``RELOAD_WATCH_INTERVAL`` in seconds when ``RELOAD_WATCH`` is set, otherwise ``None``."""
+    if os.getenv("RELOAD_WATCH", "").lower() not in ("1", "true", "yes"):
+        return None
+    return float(os.getenv("RELOAD_WATCH_INTERVAL", 1.0))
@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import enum
+import logging
+import time
+from typing import Any, AsyncIterator, Deque, Dict, List, Self
+
+from discord.ext import commands
+
+from tinybot.core.metrics import COMMAND_BUCKETS, Family, Histogram, family
+
+log = logging.getLogger("tinybot.scheduler")
+
+
+class Priority(enum.IntEnum):
+    """
+    Priority classes of commands, lower runs first.
+
+    Commands of the bot owners are ``OWNER``, other commands declare theirs with
+    ``@commands.command(extras={"priority": Priority.LOW})`` and are ``NORMAL`` otherwise.
+    """
+
+    OWNER = 0
+    HIGH = 1
+    NORMAL = 2
+    LOW = 3
+
+
+class CommandShed(commands.CommandError):
+    """A command was dropped because the scheduler is overloaded."""
+
+    def __init__(self: Self, reason: str) -> None:
+        super().__init__(f"Command shed: {reason}")
+        self.reason = reason
+
+
+class _Waiter:
+    __slots__ = ("key", "future", "enqueued")
+
+    def __init__(self: Self, key: int) -> None:
+        self.key = key
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued: float = time.perf_counter()
+
+
+class CommandScheduler:
+    """
+    Bounds how many commands run at once, in total and per guild.
+
+    A command that finds no free slot waits in the queue of its priority class.
+    Inside a class, guilds are served round-robin: each freed slot goes to the
+    next guild with a waiting command, so a guild flooding an expensive command
+    only ever delays its own commands. ``OWNER`` commands bypass the limits.
+
+    A command is shed with :class:`CommandShed` instead of being queued when the
+    queue or the queue of its guild is full, and when it waited ``max_wait``
+    seconds without getting a slot.
+
+    Parameters
+    ----------
+    limit: int
+        Commands running at once, 0 for no limit.
+    guild_limit: int
+        Commands running at once per guild, or per user in DMs, 0 for no limit.
+    queue_size: int
+        Commands waiting in total.
+    guild_queue_size: int
+        Commands waiting per guild.
+    max_wait: float
+        Seconds a command waits for a slot before it is shed.
+    """
+
+    def __init__(
+        self: Self,
+        limit: int = 100,
+        guild_limit: int = 5,
+        queue_size: int = 1000,
+        guild_queue_size: int = 20,
+        max_wait: float = 30.0,
+    ) -> None:
+        self.limit = limit
+        self.guild_limit = guild_limit
+        self.queue_size = queue_size
+        self.guild_queue_size = guild_queue_size
+        self.max_wait = max_wait
+        self.running: int = 0
+        self.guild_running: collections.Counter = collections.Counter()
+        # Priority -> guild -> waiters, the guilds in round-robin order.
+        self.queues: Dict[Priority, collections.OrderedDict[int, Deque[_Waiter]]] = {
+            priority: collections.OrderedDict() for priority in Priority
+        }
+        self.queued: int = 0
+        self.wait_time: Histogram = Histogram(COMMAND_BUCKETS)
+        self.wait_max: float = 0.0
+        self.shed: collections.Counter = collections.Counter()
+
+    def _has_slot(self: Self, key: int) -> bool:
+        return (not self.limit or self.running < self.limit) and (
+            not self.guild_limit or self.guild_running[key] < self.guild_limit
+        )
+
+    def _take(self: Self, key: int) -> None:
+        self.running += 1
+        self.guild_running[key] += 1
+
+    def release(self: Self, key: int) -> None:
+        self.running -= 1
+        self.guild_running[key] -= 1
+        if self.guild_running[key] <= 0:
+            del self.guild_running[key]
+        self._wake()
+
+    def _wake(self: Self) -> None:
+        """Hands the free slots to the waiters, one per guild and pass, higher priorities first."""
+        progress = True
+        while progress and self.queued and (not self.limit or self.running < self.limit):
+            progress = False
+            for queue in self.queues.values():
+                for key in list(queue):
+                    if self.limit and self.running >= self.limit:
+                        return
+                    if not self._has_slot(key):
+                        continue
+                    waiters = queue[key]
+                    waiter = waiters.popleft()
+                    if waiters:
+                        queue.move_to_end(key)
+                    else:
+                        del queue[key]
+                    self.queued -= 1
+                    self._take(key)
+                    waited = time.perf_counter() - waiter.enqueued
+                    self.wait_time.observe(waited)
+                    self.wait_max = max(self.wait_max, waited)
+                    waiter.future.set_result(None)
+                    progress = True
+
+    def _shed(self: Self, reason: str, key: int) -> CommandShed:
+        self.shed[reason] += 1
+        log.debug("Shedding a command of %s: %s", key, reason)
+        return CommandShed(reason)
+
+    async def acquire(self: Self, key: int, priority: Priority = Priority.NORMAL) -> None:
+        """
+        Waits for a slot of ``key``, a guild or user id. Pair with :meth:`release`.
+
+        Raises
+        ------
+        CommandShed
+            The queue was full or no slot was free within ``max_wait`` seconds.
+        """
+        if priority is Priority.OWNER or (not self.queued and self._has_slot(key)):
+            self._take(key)
+            return
+
+        queue = self.queues[priority]
+        waiters = queue.get(key)
+        if self.queued >= self.queue_size:
+            raise self._shed("queue full", key)
+        if waiters is not None and len(waiters) >= self.guild_queue_size:
+            raise self._shed("guild queue full", key)
+        if waiters is None:
+            waiters = queue[key] = collections.deque()
+        waiter = _Waiter(key)
+        waiters.append(waiter)
+        self.queued += 1
+        self._wake()
+
+        try:
+            async with asyncio.timeout(self.max_wait):
+                await waiter.future
+        except (asyncio.CancelledError, TimeoutError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # The slot was granted right before, hand it on.
+                self.release(key)
+            else:
+                waiters.remove(waiter)
+                self.queued -= 1
+                if not waiters and queue.get(key) is waiters:
+                    del queue[key]
+            if isinstance(e, TimeoutError):
+                raise self._shed("waited too long", key) from None
+            raise
+
+    @contextlib.asynccontextmanager
+    async def slot(self: Self, key: int, priority: Priority = Priority.NORMAL) -> AsyncIterator[None]:
+        await self.acquire(key, priority)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def stats(self: Self) -> Dict[str, Any]:
+        """
+        Returns the running and queued commands, the wait times and the shed commands.
+
+        Returns
+        -------
+            Dict[str, Any]
+        """
+        depths: collections.Counter = collections.Counter()
+        for queue in self.queues.values():
+            for key, waiters in queue.items():
+                depths[key] += len(waiters)
+        return {
+            "running": self.running,
+            "limit": self.limit,
+            "guild_limit": self.guild_limit,
+            "queued": self.queued,
+            "queued_by_priority": {
+                priority.name: sum(len(waiters) for waiters in queue.values())
+                for priority, queue in self.queues.items()
+            },
+            "busiest": depths.most_common(5),
+            "wait_avg": self.wait_time.sum / self.wait_time.count if self.wait_time.count else 0.0,
+            "wait_max": self.wait_max,
+            "shed": dict(self.shed),
+        }
+
+    def families(self: Self, base: Dict[str, str]) -> List[Family]:
+        return [
+            family(
+                "tinybot_scheduler_running",
+                "gauge",
+                "Commands holding a scheduler slot.",
+                [["", base, self.running]],
+            ),
+            family(
+                "tinybot_scheduler_queued",
+                "gauge",
+                "Commands waiting for a slot by priority.",
+                [
+                    ["", {**base, "priority": priority.name}, sum(len(waiters) for waiters in queue.values())]
+                    for priority, queue in self.queues.items()
+                ],
+            ),
+            family(
+                "tinybot_scheduler_wait_seconds",
+                "histogram",
+                "Time queued commands waited for a slot.",
+                self.wait_time.samples(base),
+            ),
+            family(
+                "tinybot_scheduler_shed_total",
+                "counter",
+                "Commands dropped by the scheduler by reason.",
+                [["", {**base, "reason": reason}, count] for reason, count in self.shed.items()],
+            ),
+        ]
+
+
+def command_priority(ctx: commands.Context) -> Priority:
+    bot = ctx.bot
+    if ctx.author.id == bot.owner_id or ctx.author.id in (bot.owner_ids or ()):
+        return Priority.OWNER
+    return Priority(ctx.command.extras.get("priority", Priority.NORMAL))
+
+
+def scheduler_key(ctx: commands.Context) -> int:
+    """Commands are limited per guild, or per user in DMs."""
+    return ctx.guild.id if ctx.guild is not None else ctx.author.id
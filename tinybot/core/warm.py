@@ -0,0 +1,365 @@
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import pathlib
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Self, Set, Tuple
+
+import discord
+
+if TYPE_CHECKING:
+    from tinybot.bot import TinyBot
+
+log = logging.getLogger("tinybot.warm")
+
+SNAPSHOT_VERSION = 1
+
+# Gateway close code that keeps the session resumable, 1000 and 1001 end it.
+RESUMABLE_CLOSE_CODE = 4000
+
+# Channel payload keys, the attribute they are read from and how to encode it. Only the
+# attributes the channel type has are written.
+_CHANNEL_FIELDS: Tuple[Tuple[str, str, Optional[Callable[[Any], Any]]], ...] = (
+    ("topic", "topic", None),
+    ("nsfw", "nsfw", None),
+    ("rate_limit_per_user", "slowmode_delay", None),
+    ("default_auto_archive_duration", "default_auto_archive_duration", None),
+    ("default_thread_rate_limit_per_user", "default_thread_slowmode_delay", None),
+    ("last_message_id", "last_message_id", None),
+    ("bitrate", "bitrate", None),
+    ("user_limit", "user_limit", None),
+    ("rtc_region", "rtc_region", None),
+    ("video_quality_mode", "video_quality_mode", lambda mode: mode.value),
+    ("flags", "flags", lambda flags: flags.value),
+    ("available_tags", "available_tags", lambda tags: [tag.to_dict() for tag in tags]),
+    ("default_sort_order", "default_sort_order", lambda order: order.value if order is not None else None),
+    ("default_forum_layout", "default_layout", lambda layout: layout.value),
+)
+
+
+def _user(user: discord.abc.User) -> Dict[str, Any]:
+    data = {"id": str(user.id), "username": user.name, "discriminator": user.discriminator, "avatar": user._avatar}
+    if user.bot:
+        data["bot"] = True
+    if user.system:
+        data["system"] = True
+    if user._public_flags:
+        data["public_flags"] = user._public_flags
+    return data
+
+
+def _member(member: discord.Member) -> Dict[str, Any]:
+    data: Dict[str, Any] = {"user": _user(member._user), "roles": [str(r) for r in member._roles], "flags": member._flags}
+    if member.joined_at:
+        data["joined_at"] = member.joined_at.isoformat()
+    if member.nick:
+        data["nick"] = member.nick
+    if member._avatar:
+        data["avatar"] = member._avatar
+    if member.premium_since:
+        data["premium_since"] = member.premium_since.isoformat()
+    if member.pending:
+        data["pending"] = True
+    if member.timed_out_until:
+        data["communication_disabled_until"] = member.timed_out_until.isoformat()
+    return data
+
+
+def _role(role: discord.Role) -> Dict[str, Any]:
+    data = {
+        "id": str(role.id),
+        "name": role.name,
+        "permissions": str(role._permissions),
+        "position": role.position,
+        "color": role._colour,
+        "hoist": role.hoist,
+        "managed": role.managed,
+        "mentionable": role.mentionable,
+        "icon": role._icon,
+        "unicode_emoji": role.unicode_emoji,
+    }
+    if role.tags is not None:
+        tags = role.tags
+        data["tags"] = {
+            key: str(value) for key, value in (("bot_id", tags.bot_id), ("integration_id", tags.integration_id))
+            if value is not None
+        }
+        if tags.is_premium_subscriber():
+            data["tags"]["premium_subscriber"] = None
+    return data
+
+
+def _channel(channel: discord.abc.GuildChannel) -> Dict[str, Any]:
+    data = {
+        "id": str(channel.id),
+        "type": channel.type.value,
+        "name": channel.name,
+        "position": channel.position,
+        "parent_id": str(channel.category_id) if channel.category_id else None,
+        "permission_overwrites": [overwrite._asdict() for overwrite in channel._overwrites],
+    }
+    for key, attribute, encode in _CHANNEL_FIELDS:
+        if hasattr(channel, attribute):
+            value = getattr(channel, attribute)
+            data[key] = encode(value) if encode is not None and value is not None else value
+    return data
+
+
+def _emoji(emoji: discord.Emoji) -> Dict[str, Any]:
+    return {
+        "id": str(emoji.id),
+        "name": emoji.name,
+        "animated": emoji.animated,
+        "managed": emoji.managed,
+        "available": emoji.available,
+        "require_colons": emoji.require_colons,
+        "roles": [str(r) for r in emoji._roles],
+    }
+
+
+def snapshot_guild(guild: discord.Guild) -> Dict[str, Any]:
+    """
+    A ``GUILD_CREATE`` like payload of what the cache holds about ``guild``. Presences,
+    voice states, threads, stickers and scheduled events are left out.
+    """
+    return {
+        "id": str(guild.id),
+        "name": guild.name,
+        "icon": guild._icon,
+        "banner": guild._banner,
+        "splash": guild._splash,
+        "discovery_splash": guild._discovery_splash,
+        "owner_id": str(guild.owner_id) if guild.owner_id else None,
+        "afk_timeout": guild.afk_timeout,
+        "afk_channel_id": str(guild.afk_channel.id) if guild.afk_channel else None,
+        "system_channel_id": str(guild._system_channel_id) if guild._system_channel_id else None,
+        "rules_channel_id": str(guild._rules_channel_id) if guild._rules_channel_id else None,
+        "public_updates_channel_id": (
+            str(guild._public_updates_channel_id) if guild._public_updates_channel_id else None
+        ),
+        "system_channel_flags": guild._system_channel_flags,
+        "verification_level": guild.verification_level.value,
+        "default_message_notifications": guild.default_notifications.value,
+        "explicit_content_filter": guild.explicit_content_filter.value,
+        "mfa_level": guild.mfa_level.value,
+        "nsfw_level": guild.nsfw_level.value,
+        "premium_tier": guild.premium_tier,
+        "premium_subscription_count": guild.premium_subscription_count,
+        "premium_progress_bar_enabled": guild.premium_progress_bar_enabled,
+        "preferred_locale": guild.preferred_locale.value,
+        "features": list(guild.features),
+        "description": guild.description,
+        "vanity_url_code": guild.vanity_url_code,
+        "max_members": guild.max_members,
+        "member_count": guild._member_count,
+        "large": guild._large,
+        "roles": [_role(role) for role in guild.roles],
+        "channels": [_channel(channel) for channel in guild.channels],
+        "emojis": [_emoji(emoji) for emoji in guild.emojis],
+        "members": [_member(member) for member in guild.members],
+    }
+
+
+def restore_guild(state: Any, data: Dict[str, Any]) -> discord.Guild:
+    """
+    Adds a guild of a snapshot to the cache. The members are added the way
+    chunking adds them, whatever the member cache flags say about joins.
+    """
+    members = data.pop("members")
+    guild = state._add_guild_from_data(data)
+    for member_data in members:
+        guild._add_member(discord.Member(data=member_data, guild=guild, state=state))
+    return guild
+
+
+class WarmRestart:
+    """
+    Lets a restarted bot resume its gateway sessions instead of identifying again.
+
+    On close, the shards disconnect with a close code that keeps their session
+    alive, and their session id, resume URL and sequence number are saved with
+    a snapshot of the guild and member cache. On the next start, a shard with a
+    saved session loads the guilds it owns from the snapshot and sends RESUME:
+    Discord replays what it missed, and nothing needs to be chunked.
+
+    When Discord refuses the resume, the shard identifies and chunks as usual,
+    replacing the snapshot's guilds, and those READY does not list are removed.
+    A state older than ``max_age`` seconds, of another bot or another shard
+    count is ignored. It is deleted once read, a crash never resumes twice from
+    the same state.
+
+    Parameters
+    ----------
+    path: pathlib.Path
+        The file the state is kept in.
+    max_age: float
+        Seconds a saved state is worth resuming, Discord drops sessions after a while.
+    """
+
+    def __init__(self: Self, path: pathlib.Path, max_age: float = 120.0) -> None:
+        self.path = path
+        self.max_age = max_age
+        self._sessions: Optional[Dict[int, Dict[str, Any]]] = None
+        self._guilds: List[Dict[str, Any]] = []
+        self._shard_count: Optional[int] = None
+        # Guilds restored for each shard still resuming, dropped if it starts cold.
+        self._restored: Dict[int, List[discord.Guild]] = {}
+        # Shards that resumed a saved session and did not report ready yet.
+        self.pending: Set[int] = set()
+        self.resumed: Set[int] = set()
+        self.cold: Set[int] = set()
+
+    def _read(self: Self) -> Optional[Dict[str, Any]]:
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.warning("Ignoring the unreadable warm restart state %s", self.path, exc_info=True)
+            data = None
+        self.path.unlink(missing_ok=True)
+        return data
+
+    def _write(self: Self, data: Dict[str, Any]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as file:
+            json.dump(data, file, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    async def _load(self: Self, bot: TinyBot) -> None:
+        self._sessions = {}
+        data = await asyncio.to_thread(self._read)
+        if data is None:
+            return
+        age = time.time() - data.get("saved_at", 0)
+        if data.get("version") != SNAPSHOT_VERSION:
+            reason = "it has another version"
+        elif age > self.max_age:
+            reason = f"it is {age:.0f}s old"
+        elif bot.user is None or data["user_id"] != bot.user.id:
+            reason = "it belongs to another bot"
+        elif data["shard_count"] != bot.shard_count:
+            reason = f"it has {data['shard_count']} shards instead of {bot.shard_count}"
+        else:
+            self._sessions = {session["shard_id"]: session for session in data["sessions"]}
+            self._guilds = data["guilds"]
+            self._shard_count = data["shard_count"]
+            log.info("Loaded the warm restart state of %s shards, saved %.0fs ago", len(self._sessions), age)
+            return
+        log.info("Starting cold, ignoring the warm restart state because %s", reason)
+
+    async def session(self: Self, bot: TinyBot, shard_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Returns the saved session of a shard, after adding its guilds to the cache.
+        The first call reads the saved state.
+        """
+        if self._sessions is None:
+            await self._load(bot)
+        session = self._sessions.pop(shard_id, None)
+        if session is None:
+            return None
+        state = bot._connection
+        started = time.perf_counter()
+        restored: List[discord.Guild] = []
+        members = 0
+        remaining = []
+        for data in self._guilds:
+            if (int(data["id"]) >> 22) % self._shard_count == shard_id:
+                members += len(data["members"])
+                restored.append(restore_guild(state, data))
+            else:
+                remaining.append(data)
+        self._guilds = remaining
+        self._restored[shard_id] = restored
+        log.info(
+            "Shard %s: restored %s guilds and %s members in %.2fs",
+            shard_id, len(restored), members, time.perf_counter() - started,
+        )
+        self.pending.add(shard_id)
+        return session
+
+    def discard(self: Self, shard_id: int) -> None:
+        """
+        The shard could not resume and identifies instead. Its restored guilds that
+        READY did not replace are removed, the bot left them while it was down.
+        """
+        self.pending.discard(shard_id)
+        self.cold.add(shard_id)
+        ghosts = 0
+        for guild in self._restored.pop(shard_id, []):
+            state = guild._state
+            if state._get_guild(guild.id) is guild:
+                state._remove_guild(guild)
+                ghosts += 1
+        if ghosts:
+            log.info("Shard %s: removed %s restored guilds the new session does not have", shard_id, ghosts)
+
+    def on_shard_event(self: Self, bot: TinyBot, event: str, shard_id: int) -> None:
+        """
+        Follows the shards resuming a saved session, called for ``shard_resumed`` and ``shard_connect``.
+
+        A resumed session gets no READY, so the resumed shard is marked ready the
+        way discord.py marks an identified one, and ``on_ready`` is dispatched once
+        every shard is ready.
+        """
+        if shard_id not in self.pending:
+            return
+        if event == "shard_connect":
+            # READY: the resume was refused and discord.py takes over.
+            log.info("Shard %s could not resume its session, starting cold", shard_id)
+            self.discard(shard_id)
+            return
+        self.pending.discard(shard_id)
+        self.resumed.add(shard_id)
+        self._restored.pop(shard_id, None)
+        state = bot._connection
+        done = asyncio.get_running_loop().create_future()
+        done.set_result(None)
+        state._ready_tasks[shard_id] = done
+        bot.dispatch("shard_ready", shard_id)
+        if state._ready_task is None and len(state._ready_tasks) == len(state.shard_ids):
+            state._ready_task = asyncio.create_task(state._delay_ready())
+
+    async def save(self: Self, bot: TinyBot) -> None:
+        """Disconnects the shards keeping their sessions alive and saves them with the cache."""
+        sessions = []
+        for info in bot.shards.values():
+            shard = info._parent
+            shard._cancel_task()
+            ws = shard.ws
+            await ws.close(code=RESUMABLE_CLOSE_CODE)
+            if ws.session_id is not None and ws.sequence is not None:
+                sessions.append(
+                    {
+                        "shard_id": ws.shard_id,
+                        "session_id": ws.session_id,
+                        "sequence": ws.sequence,
+                        "resume_url": str(ws.gateway),
+                    }
+                )
+        if not sessions:
+            return
+        started = time.perf_counter()
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "saved_at": time.time(),
+            "user_id": bot.user.id,
+            "shard_count": bot.shard_count,
+            "sessions": sessions,
+            "guilds": [snapshot_guild(guild) for guild in bot.guilds if not guild.unavailable],
+        }
+        # Encoding and compressing a large cache takes a while, the loop keeps running meanwhile.
+        await asyncio.to_thread(self._write, data)
+        log.info(
+            "Saved the sessions of %s shards and %s guilds for a warm restart in %.2fs",
+            len(sessions), len(data["guilds"]), time.perf_counter() - started,
+        )
+
+    def stats(self: Self) -> Dict[str, Any]:
+        return {"resumed": sorted(self.resumed), "cold": sorted(self.cold), "pending": sorted(self.pending)}
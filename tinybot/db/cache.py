@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+from typing import Any, Callable, Dict, Hashable, List, Optional, Self, Type
+
+from piccolo.columns import Column
+from piccolo.table import Table
+
+from tinybot.db.engine import DBEngine, registry
+
+log = logging.getLogger("tinybot.db.cache")
+
+
+class SettingsCache:
+    """
+    Write-behind cache for a per-guild (or per-anything) settings table.
+
+    Reads are served from a bounded LRU cache and only hit the database on a miss.
+    Writes update the cache immediately and are buffered, then flushed in one
+    ``upsert_many`` every ``flush_interval`` seconds, when the buffer grows past
+    ``maxsize`` and when the bot closes.
+
+    Example:
+        db = DBEngine(path=os.getcwd(), cog_name='MyCog')
+
+        class GuildSettings(Table, db=db.connect()):
+            guild_id = BigInt(unique=True)
+            prefix = Varchar(default="!")
+
+        settings = SettingsCache(db, GuildSettings, GuildSettings.guild_id)
+        prefix = (await settings.get(guild.id))["prefix"]
+        await settings.set(guild.id, prefix="?")
+
+    The key column must be unique, since flushing relies on ``ON CONFLICT``.
+    """
+
+    def __init__(
+        self: Self,
+        db: DBEngine,
+        table: Type[Table],
+        key_column: Column,
+        maxsize: int = 10_000,
+        flush_interval: float = 5.0,
+    ) -> None:
+        self.db = db
+        self.table = table
+        self.key_column = key_column
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.flushes: int = 0
+
+        self._cache: collections.OrderedDict[Hashable, Dict[str, Any]] = collections.OrderedDict()
+        self._dirty: Dict[Hashable, Dict[str, Any]] = {}
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+        # Bumped by invalidate() for the keys being loaded, and for every key by
+        # invalidate(None), so a row read before the invalidation is not cached.
+        self._generations: Dict[Hashable, int] = {}
+        self._generation: int = 0
+        self._listeners: List[Callable[[Optional[Hashable]], Any]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        # Flush started when the buffer is full, referenced so it is not garbage collected.
+        self._early_flush: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def key_name(self: Self) -> str:
+        return self.key_column._meta.db_column_name
+
+    def defaults(self: Self, key: Hashable) -> Dict[str, Any]:
+        """Returns the row a key has before anything was written for it."""
+        row = {
+            column._meta.db_column_name: column.get_default_value()
+            for column in self.table._meta.non_default_columns
+        }
+        row[self.key_name] = key
+        return row
+
+    def _store(self: Self, key: Hashable, row: Dict[str, Any]) -> None:
+        self._cache[key] = row
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def _load(self: Self, key: Hashable) -> Dict[str, Any]:
+        row = await self.table.select(*self.table._meta.non_default_columns).where(
+            self.key_column == key
+        ).first()
+        return row if row is not None else self.defaults(key)
+
+    async def get(self: Self, key: Hashable) -> Dict[str, Any]:
+        """
+        Returns the settings row for ``key``.
+
+        Concurrent misses on the same key share a single query.
+
+        Parameters
+        ----------
+        key: Hashable
+            Value of the key column, usually a guild id.
+
+        Returns
+        -------
+            Dict[str, Any]
+        """
+        if key in self._dirty:
+            self.hits += 1
+            return dict(self._dirty[key])
+        row = self._cache.get(key)
+        if row is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return dict(row)
+
+        self.misses += 1
+        future = self._loading.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._loading[key] = future
+            generation = (self._generation, self._generations.get(key, 0))
+            try:
+                row = await self._load(key)
+            except Exception as e:
+                future.set_exception(e)
+                # Retrieved here so an unawaited future does not warn.
+                future.exception()
+                raise
+            else:
+                future.set_result(row)
+                if key not in self._dirty and generation == (self._generation, self._generations.get(key, 0)):
+                    self._store(key, row)
+            finally:
+                del self._loading[key]
+                self._generations.pop(key, None)
+        return dict(await future)
+
+    async def set(self: Self, key: Hashable, **values: Any) -> None:
+        """
+        Updates the settings of ``key`` in the cache and buffers the write.
+
+        Parameters
+        ----------
+        key: Hashable
+            Value of the key column, usually a guild id.
+        values: Any
+            Column names and their new values.
+
+        Returns
+        -------
+            None
+        """
+        row = await self.get(key)
+        row.update(values)
+        self._dirty[key] = row
+        self._store(key, row)
+        self._start()
+        if len(self._dirty) >= self.maxsize and (self._early_flush is None or self._early_flush.done()):
+            self._early_flush = asyncio.create_task(self.flush())
+
+    def invalidate(self: Self, key: Optional[Hashable] = None) -> None:
+        """
+        Drops the cached copy of ``key``, or of every key when ``key`` is None,
+        so the next read goes to the database. Buffered writes are kept.
+
+        Parameters
+        ----------
+        key: Optional[Hashable]
+            The key to drop.
+
+        Returns
+        -------
+            None
+        """
+        if key is None:
+            self._cache.clear()
+            self._generation += 1
+        else:
+            self._cache.pop(key, None)
+            if key in self._loading:
+                self._generations[key] = self._generations.get(key, 0) + 1
+        for listener in self._listeners:
+            listener(key)
+
+    def add_listener(self: Self, listener: Callable[[Optional[Hashable]], Any]) -> None:
+        """Registers a callback run with the key (or None) on every invalidation."""
+        self._listeners.append(listener)
+
+    def remove_listener(self: Self, listener: Callable[[Optional[Hashable]], Any]) -> None:
+        self._listeners.remove(listener)
+
+    def _start(self: Self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+            # Registered while it buffers writes, so closing the engines flushes it first.
+            if self not in registry.caches:
+                registry.caches.append(self)
+
+    async def _flush_loop(self: Self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self: Self) -> None:
+        """
+        Writes every buffered row in one batch.
+
+        Rows that fail to be written are put back in the buffer unless they were
+        changed again in the meantime.
+
+        Returns
+        -------
+            None
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            try:
+                await self.db.upsert_many(self.table, list(dirty.values()), [self.key_name])
+            except Exception:
+                log.exception("Failed to flush %s rows of %s", len(dirty), self.table._meta.tablename)
+                for key, row in dirty.items():
+                    self._dirty.setdefault(key, row)
+            else:
+                self.flushes += 1
+
+    async def close(self: Self) -> None:
+        """Stops the flush loop and writes the remaining buffered rows."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        if self in registry.caches:
+            registry.caches.remove(self)
+
+    def stats(self: Self) -> Dict[str, Any]:
+        return {
+            "size": len(self._cache),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+        }
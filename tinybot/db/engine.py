@@ -1,13 +1,245 @@
 from __future__ import annotations
 
+import asyncio
+import logging
 import os
-from typing import List, Self, Type
+import time
+from typing import Any, Dict, List, Optional, Self, Sequence, Tuple, Type
 
 import asyncpg
 from dotenv import load_dotenv
 from piccolo.engine import PostgresEngine
 from piccolo.engine.sqlite import SQLiteEngine
-from piccolo.table import Table, create_db_tables
+from piccolo.table import Table, create_db_tables, sort_table_classes
+
+from tinybot.db.sqlite import TunedSQLiteEngine
+
+log = logging.getLogger("tinybot.db")
+
+
+class PooledPostgresEngine(PostgresEngine):
+    """
+    PostgresEngine that keeps track of how its connection pool is used.
+
+    Every query that goes through the pool records how long it waited to
+    acquire a connection and how many connections are currently checked out.
+    """
+
+    def __init__(self: Self, config: Dict[str, Any], **kwargs: Any) -> None:
+        super().__init__(config=config, **kwargs)
+        self.acquisitions: int = 0
+        self.acquired: int = 0
+        self.wait_time_total: float = 0.0
+        self.wait_time_max: float = 0.0
+
+    async def _run_in_pool(self: Self, query: str, args: Sequence[Any] = None):
+        if args is None:
+            args = []
+        if not self.pool:
+            raise ValueError("A pool isn't currently running.")
+
+        started = time.perf_counter()
+        async with self.pool.acquire() as connection:
+            waited = time.perf_counter() - started
+            self.acquisitions += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+            self.acquired += 1
+            try:
+                return await connection.fetch(query, *args)
+            finally:
+                self.acquired -= 1
+
+    def stats(self: Self) -> Dict[str, Any]:
+        """
+        Returns a snapshot of the pool usage.
+
+        Returns
+        -------
+            Dict[str, Any]
+        """
+        pool = self.pool
+        return {
+            "size": pool.get_size() if pool else 0,
+            "min_size": pool.get_min_size() if pool else 0,
+            "max_size": pool.get_max_size() if pool else 0,
+            "idle": pool.get_idle_size() if pool else 0,
+            "acquired": self.acquired,
+            "acquisitions": self.acquisitions,
+            "wait_time_avg": self.wait_time_total / self.acquisitions if self.acquisitions else 0.0,
+            "wait_time_max": self.wait_time_max,
+        }
+
+
+class EngineRegistry:
+    """
+    Process-wide registry of database engines.
+
+    Postgres cogs all share one database and one sized connection pool, each cog's
+    tables being isolated by a ``<cog_name>_`` table prefix. SQLite cogs keep one
+    database file per cog, but the engine for each file is only built once.
+
+    Configuration is read from the environment:
+        DB_TYPE: ``sqlite`` or ``postgres``
+        DB_HOST, DB_USER, DB_PASSWORD: Postgres credentials
+        DB_NAME: Postgres database shared by all cogs, default ``tinybot``
+        DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE: Pool bounds, default 1 and 10
+        DB_STATEMENT_CACHE_SIZE: Prepared statements cached per connection, default 100
+        DB_SQLITE_MODE: ``wal`` to use TunedSQLiteEngine, anything else keeps Piccolo's defaults
+        DB_SQLITE_SYNCHRONOUS: ``synchronous`` pragma in WAL mode, default ``NORMAL``
+        DB_SQLITE_CACHE_SIZE: Page cache size in KiB in WAL mode, default 20000
+        DB_SQLITE_BATCH_SIZE: Max writes coalesced into one transaction, default 500
+        DB_SQLITE_READERS: Read connections kept open per file, default 4
+    """
+
+    def __init__(self: Self) -> None:
+        self._loaded_paths: set[str] = set()
+        self._sqlite: Dict[str, SQLiteEngine] = {}
+        self._postgres: Optional[PooledPostgresEngine] = None
+        self._pool_lock: Optional[asyncio.Lock] = None
+        # SettingsCache instances, flushed before the engines are closed.
+        self.caches: List[Any] = []
+
+    def load_env(self: Self, path: str) -> None:
+        """Loads the .env file at ``path`` once per process."""
+        if path not in self._loaded_paths:
+            load_dotenv(path)
+            self._loaded_paths.add(path)
+
+    @property
+    def db_type(self: Self) -> Optional[str]:
+        return os.getenv("DB_TYPE")
+
+    @property
+    def postgres_config(self: Self) -> Dict[str, Any]:
+        return {
+            "host": os.getenv("DB_HOST"),
+            "database": os.getenv("DB_NAME", "tinybot"),
+            "user": os.getenv("DB_USER"),
+            "password": os.getenv("DB_PASSWORD"),
+            "statement_cache_size": int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100)),
+        }
+
+    def get(self: Self, path: str, cog_name: str) -> SQLiteEngine | PostgresEngine | None:
+        """
+        Returns the engine a cog should bind its tables to.
+
+        Parameters
+        ----------
+        path: str
+            Directory holding the .env file and the SQLite databases.
+        cog_name: str
+            Name of the cog requesting the engine.
+
+        Returns
+        -------
+            SQLiteEngine or PostgresEngine
+        """
+        self.load_env(path)
+        if self.db_type == "sqlite":
+            db_path = f"{path}/{cog_name}.sqlite"
+            if db_path not in self._sqlite:
+                self._sqlite[db_path] = self.create_sqlite_engine(db_path)
+            return self._sqlite[db_path]
+        elif self.db_type == "postgres":
+            if self._postgres is None:
+                self._postgres = PooledPostgresEngine(config=self.postgres_config)
+            return self._postgres
+
+    def create_sqlite_engine(self: Self, db_path: str) -> SQLiteEngine:
+        if os.getenv("DB_SQLITE_MODE") == "wal":
+            return TunedSQLiteEngine(
+                path=db_path,
+                synchronous=os.getenv("DB_SQLITE_SYNCHRONOUS", "NORMAL"),
+                cache_size=int(os.getenv("DB_SQLITE_CACHE_SIZE", 20_000)),
+                batch_size=int(os.getenv("DB_SQLITE_BATCH_SIZE", 500)),
+                readers=int(os.getenv("DB_SQLITE_READERS", 4)),
+            )
+        return SQLiteEngine(path=db_path)
+
+    async def create_database(self: Self) -> None:
+        """
+        Creates the shared Postgres database through the default ``postgres`` database.
+
+        Returns
+        -------
+            None
+        """
+        config = self.postgres_config
+        conn = await asyncpg.connect(
+            host=config["host"],
+            user=config["user"],
+            password=config["password"],
+            database="postgres",
+        )
+        try:
+            await conn.execute(f'CREATE DATABASE "{config["database"]}" OWNER "{config["user"]}"')
+        finally:
+            await conn.close()
+
+    async def start(self: Self) -> None:
+        """
+        Starts the shared Postgres pool if it is not running yet.
+
+        The database is only created when the pool fails to connect because it is
+        missing, so a normal startup opens no connection outside the pool.
+
+        Returns
+        -------
+            None
+        """
+        if self._postgres is None:
+            return
+        if self._pool_lock is None:
+            self._pool_lock = asyncio.Lock()
+        async with self._pool_lock:
+            if self._postgres.pool is not None:
+                return
+            pool_kwargs = {
+                "min_size": int(os.getenv("DB_POOL_MIN_SIZE", 1)),
+                "max_size": int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+            }
+            try:
+                await self._postgres.start_connection_pool(**pool_kwargs)
+            except asyncpg.InvalidCatalogNameError:
+                log.info("Creating database %s", self.postgres_config["database"])
+                await self.create_database()
+                await self._postgres.start_connection_pool(**pool_kwargs)
+            log.info(
+                "Started Postgres pool (min_size=%s, max_size=%s)",
+                pool_kwargs["min_size"],
+                pool_kwargs["max_size"],
+            )
+
+    async def close(self: Self) -> None:
+        """Flushes the settings caches and SQLite writers and closes the shared Postgres pool."""
+        for cache in list(self.caches):
+            await cache.close()
+        if self._postgres is not None and self._postgres.pool is not None:
+            await self._postgres.close_connection_pool()
+        for engine in self._sqlite.values():
+            if isinstance(engine, TunedSQLiteEngine):
+                await engine.close()
+
+    def stats(self: Self) -> Dict[str, Any]:
+        """
+        Returns the shared pool stats, or the SQLite engine and writer stats when not using Postgres.
+
+        Returns
+        -------
+            Dict[str, Any]
+        """
+        if self._postgres is not None:
+            return {"type": "postgres", **self._postgres.stats()}
+        stats: Dict[str, Any] = {"type": self.db_type, "engines": len(self._sqlite)}
+        for engine in self._sqlite.values():
+            if isinstance(engine, TunedSQLiteEngine):
+                for key, value in engine.stats().items():
+                    stats[key] = stats.get(key, 0) + value
+        return stats
+
+
+registry: EngineRegistry = EngineRegistry()
 
 
 class DBEngine:
@@ -17,6 +249,9 @@ class DBEngine:
     Determines which driver to use (Postgres or SQLite)
     Handles cog table migrations, defaults, and creation as well
     as initial db creation.
+
+    Engines come from the process-wide ``registry`` so all cogs share
+    the same Postgres pool.
     """
 
     def __init__(self: Self, path: str, cog_name: str) -> None:
@@ -25,7 +260,7 @@ class DBEngine:
 
     def connect(self: Self) -> SQLiteEngine | PostgresEngine:
         """
-        Awaitable that returns the client's desired database engine.
+        Returns the client's desired database engine.
 
         Example:
             db = DBEngine(path=os.getcwd(), cog_name='MyCog').connect()
@@ -36,49 +271,249 @@ class DBEngine:
         -------
             SQLiteEngine or PostgresEngine
         """
-        load_dotenv(self.path)
-        if os.getenv("DB_TYPE") == 'sqlite':
-            return SQLiteEngine(path=f'{self.path}/{self.cog_name}.sqlite')
-        elif os.getenv("DB_TYPE") == 'postgres':
-            return PostgresEngine(
-                config={
-                    'host': os.getenv("DB_HOST"),
-                    'database': self.cog_name,
-                    'user': os.getenv("DB_USER"),
-                    'password': os.getenv("DB_PASSWORD")
-                })
+        return registry.get(self.path, self.cog_name)
 
-    async def postgres_create_db_and_connect(self: Self) -> None:
+    def prefix_tables(self: Self, tables: List[Type[Table]]) -> List[Tuple[Type[Table], str]]:
         """
-        Drops down to asyncpg to see if a postgres db matching the cog name exists.
-        If it does not, then it will connect to the default db (postgres) and
-        create the necessary database.
+        Isolates the cog's tables in the shared Postgres database by
+        prefixing their names with the cog name.
 
-        Afterward the connection is closed.
+        Parameters
+        ----------
+        tables: List[Type[Table]]
+            The table models of the cog.
+
+        Returns
+        -------
+            List[Tuple[Type[Table], str]]
+                The tables renamed, with their previous name.
+        """
+        prefix = f"{self.cog_name.lower()}_"
+        renamed = []
+        for table in tables:
+            if not table._meta.tablename.startswith(prefix):
+                renamed.append((table, table._meta.tablename))
+                table._meta.tablename = f"{prefix}{table._meta.tablename}"
+        return renamed
+
+    async def migrate_prefixed(self: Self, renamed: List[Tuple[Type[Table], str]]) -> None:
+        """
+        Copies the tables of the database the cog had before cogs shared one database,
+        so existing deployments keep their data.
+
+        The cog's previous database is named after the cog. Its tables are copied into
+        the new prefixed tables when these are empty, and the previous database is left
+        untouched, to be dropped once the copy is checked. When the cog's name is the
+        shared database, its tables are renamed instead.
+
+        Parameters
+        ----------
+        renamed: List[Tuple[Type[Table], str]]
+            What ``prefix_tables`` returned.
+
+        Raises
+        ------
+        RuntimeError
+            A table could not be copied, the cog would start without its data.
 
         Returns
         -------
             None
         """
+        if not renamed:
+            return
+        config = registry.postgres_config
+        if self.cog_name == config["database"]:
+            await self._rename_unprefixed(renamed)
+            return
+        engine = renamed[0][0]._meta.db
+        async with engine.pool.acquire() as connection:
+            if not await connection.fetchval("SELECT 1 FROM pg_database WHERE datname = $1", self.cog_name):
+                return
+        tables = dict(renamed)
+        await create_db_tables(*tables, if_not_exists=True)
         try:
-            conn = await asyncpg.connect(
-                host=os.getenv("DB_HOST"),
-                user=os.getenv("DB_USER"),
-                password=os.getenv("DB_PASSWORD"),
-                database=self.cog_name)
-        except asyncpg.InvalidCatalogNameError:
-            # Database for cog does not exist, create it.
-            conn = await asyncpg.connect(
-                host=os.getenv("DB_HOST"),
-                user=os.getenv("DB_USER"),
-                password=os.getenv("DB_PASSWORD"),
-                database='postgres')
-            await conn.execute(
-                f'CREATE DATABASE "{self.cog_name}" OWNER "{os.getenv("DB_USER")}"'
+            old = await asyncpg.connect(
+                host=config["host"],
+                user=config["user"],
+                password=config["password"],
+                database=self.cog_name,
+            )
+            try:
+                for table in sort_table_classes(list(tables)):
+                    await self._copy_table(old, table, tables[table])
+            finally:
+                await old.close()
+        except (asyncpg.PostgresError, OSError) as error:
+            raise RuntimeError(
+                f'Could not copy the tables of {self.cog_name} from its previous database "{self.cog_name}" '
+                f'into "{config["database"]}": {error}. Copy them by hand, for each table '
+                f'pg_dump --data-only --table <table> "{self.cog_name}", renamed to {self.cog_name.lower()}_<table>, '
+                f'then drop the database "{self.cog_name}".'
+            ) from error
+
+    async def _copy_table(self: Self, old: asyncpg.Connection, table: Type[Table], old_name: str) -> None:
+        new_name = table._meta.tablename
+        if not await old.fetchval("SELECT to_regclass($1) IS NOT NULL", f'"{old_name}"'):
+            return
+        copied = 0
+        async with table._meta.db.pool.acquire() as connection:
+            async with connection.transaction(), old.transaction():
+                # Other clusters starting at the same time wait, then find the rows.
+                await connection.execute("SELECT pg_advisory_xact_lock(hashtext($1))", new_name)
+                if await connection.fetchval(f'SELECT EXISTS (SELECT 1 FROM "{new_name}")'):
+                    log.info(
+                        "The table %s already has rows, not copying %s from the database %s, which can be dropped",
+                        new_name, old_name, self.cog_name,
+                    )
+                    return
+                columns: List[str] = []
+                batch = []
+                async for record in old.cursor(f'SELECT * FROM "{old_name}"', prefetch=1000):
+                    columns = list(record.keys())
+                    batch.append(tuple(record.values()))
+                    if len(batch) == 1000:
+                        await connection.copy_records_to_table(new_name, records=batch, columns=columns)
+                        copied += len(batch)
+                        batch = []
+                if batch:
+                    await connection.copy_records_to_table(new_name, records=batch, columns=columns)
+                    copied += len(batch)
+                # Serial columns continue after the copied ids.
+                for column in columns:
+                    sequence = await connection.fetchval(
+                        "SELECT pg_get_serial_sequence($1, $2)", f'"{new_name}"', column
+                    )
+                    if sequence is not None:
+                        await connection.execute(
+                            f'SELECT setval($1::text::regclass, (SELECT COALESCE(MAX("{column}"), 0) + 1 FROM "{new_name}"), false)',
+                            sequence,
+                        )
+        if copied:
+            log.warning(
+                "Copied %s rows of %s from the database %s into %s, the database %s can be dropped",
+                copied, old_name, self.cog_name, new_name, self.cog_name,
+            )
+
+    async def _rename_unprefixed(self: Self, renamed: List[Tuple[Type[Table], str]]) -> None:
+        for table, old_name in renamed:
+            new_name = table._meta.tablename
+            found = await table.raw(
+                "SELECT to_regclass({}) IS NOT NULL AS old, to_regclass({}) IS NOT NULL AS new",
+                f'"{old_name}"',
+                f'"{new_name}"',
             )
-            conn.close()
+            if not found[0]["old"]:
+                continue
+            if found[0]["new"]:
+                log.warning(
+                    "Found the tables %s and %s, %s uses %s, the data of %s has to be moved by hand",
+                    old_name, new_name, self.cog_name, new_name, old_name,
+                )
+                continue
+            try:
+                # IF EXISTS, another cluster may have renamed it since.
+                await table.raw(f'ALTER TABLE IF EXISTS "{old_name}" RENAME TO "{new_name}"')
+            except asyncpg.PostgresError:
+                log.exception("Could not rename the table %s to %s", old_name, new_name)
+            else:
+                log.warning("Renamed the table %s of %s to %s", old_name, self.cog_name, new_name)
+
+    async def insert_many(self: Self, table: Type[Table], rows: Sequence[Dict[str, Any] | Table]) -> None:
+        """
+        Inserts many rows with a single prepared statement in one transaction.
+
+        Parameters
+        ----------
+        table: Type[Table]
+            The table model to insert into.
+        rows: Sequence[Dict[str, Any] | Table]
+            Either dicts keyed by column name, which must all have the same keys,
+            or table instances, in which case every non primary key column is written.
+
+        Returns
+        -------
+            None
+        """
+        await self._write_many(table, rows)
+
+    async def upsert_many(
+        self: Self,
+        table: Type[Table],
+        rows: Sequence[Dict[str, Any] | Table],
+        conflict_columns: Sequence[str],
+    ) -> None:
+        """
+        Inserts many rows, updating the existing ones instead when ``conflict_columns`` clash.
+
+        Parameters
+        ----------
+        table: Type[Table]
+            The table model to upsert into.
+        rows: Sequence[Dict[str, Any] | Table]
+            Same as ``insert_many``.
+        conflict_columns: Sequence[str]
+            Columns of a unique constraint or primary key identifying existing rows.
+
+        Returns
+        -------
+            None
+        """
+        await self._write_many(table, rows, conflict_columns)
+
+    async def _write_many(
+        self: Self,
+        table: Type[Table],
+        rows: Sequence[Dict[str, Any] | Table],
+        conflict_columns: Optional[Sequence[str]] = None,
+    ) -> None:
+        if not rows:
+            return
+        rows = [
+            {
+                column._meta.db_column_name: getattr(row, column._meta.name)
+                for column in table._meta.non_default_columns
+            }
+            if isinstance(row, Table)
+            else row
+            for row in rows
+        ]
+        columns = list(rows[0])
+        engine = table._meta.db
+        postgres = isinstance(engine, PostgresEngine)
+
+        column_names = ", ".join(f'"{c}"' for c in columns)
+        placeholders = ", ".join(f"${i}" if postgres else "?" for i in range(1, len(columns) + 1))
+        query = f'INSERT INTO "{table._meta.tablename}" ({column_names}) VALUES ({placeholders})'
+        if conflict_columns:
+            updates = [c for c in columns if c not in conflict_columns]
+            conflict_names = ", ".join(f'"{c}"' for c in conflict_columns)
+            query += f" ON CONFLICT ({conflict_names}) "
+            query += (
+                "DO UPDATE SET " + ", ".join(f'"{c}" = excluded."{c}"' for c in updates)
+                if updates
+                else "DO NOTHING"
+            )
+        args = [tuple(row[c] for c in columns) for row in rows]
+
+        if isinstance(engine, TunedSQLiteEngine):
+            await engine.writer.submit(query, args, many=True)
+        elif postgres:
+            if engine.pool is None:
+                connection = await engine.get_new_connection()
+                try:
+                    async with connection.transaction():
+                        await connection.executemany(query, args)
+                finally:
+                    await connection.close()
+            else:
+                async with engine.pool.acquire() as connection:
+                    async with connection.transaction():
+                        await connection.executemany(query, args)
         else:
-            conn.close()
+            async with engine.transaction():
+                connection = engine.current_transaction.get().connection
+                await connection.executemany(query, args)
 
     async def setup(self: Self, tables: List[Type[Table]], add_defaults: bool = False) -> None:
         """
@@ -96,8 +531,11 @@ class DBEngine:
         -------
             None
         """
-        if os.getenv('DB_TYPE') == 'postgres':
-            await self.postgres_create_db_and_connect()
+        registry.load_env(self.path)
+        if registry.db_type == 'postgres':
+            renamed = self.prefix_tables(tables)
+            await registry.start()
+            await self.migrate_prefixed(renamed)
 
         await create_db_tables(*tables, if_not_exists=True)
         if add_defaults:
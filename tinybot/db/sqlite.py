@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Self, Sequence, Tuple, Type
+
+from piccolo.engine.sqlite import SQLiteEngine
+from piccolo.table import Table
+
+log = logging.getLogger("tinybot.db.sqlite")
+
+WRITE_KEYWORDS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+def is_write(query: str) -> bool:
+    return query.lstrip().upper().startswith(WRITE_KEYWORDS)
+
+
+class _Write:
+    __slots__ = ("query", "args", "query_type", "table", "many", "future")
+
+    def __init__(
+        self: Self,
+        query: str,
+        args: Sequence[Any],
+        query_type: str,
+        table: Optional[Type[Table]],
+        many: bool,
+        future: asyncio.Future,
+    ) -> None:
+        self.query = query
+        self.args = args
+        self.query_type = query_type
+        self.table = table
+        self.many = many
+        self.future = future
+
+
+class SQLiteWriter:
+    """
+    Serialized writer for a single SQLite file.
+
+    Writes are queued and a single task applies them over one long-lived connection,
+    coalescing everything that is queued at that moment into one transaction.
+    Each write runs in its own savepoint, so a failing write only fails its own caller.
+    """
+
+    def __init__(self: Self, engine: TunedSQLiteEngine, batch_size: int) -> None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.queue: Optional[asyncio.Queue[_Write]] = None
+        self.task: Optional[asyncio.Task] = None
+        self.batches: int = 0
+        self.writes: int = 0
+        self.closed: bool = False
+
+    def start(self: Self) -> None:
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run(), name=f"sqlite-writer:{self.engine.path}")
+
+    async def submit(
+        self: Self,
+        query: str,
+        args: Sequence[Any],
+        query_type: str = "generic",
+        table: Optional[Type[Table]] = None,
+        many: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        Queues a write and waits until its batch has been committed.
+
+        Parameters
+        ----------
+        query: str
+            SQL statement using ``?`` placeholders.
+        args: Sequence[Any]
+            Statement parameters, or a sequence of parameter rows when ``many`` is set.
+        query_type: str
+            Piccolo query type, used to return inserted primary keys on old SQLite versions.
+        table: Optional[Type[Table]]
+            The table the statement targets.
+        many: bool
+            Run the statement once per parameter row with ``executemany``.
+
+        Returns
+        -------
+            List[Dict[str, Any]]
+        """
+        if self.closed:
+            raise RuntimeError(f"The SQLite writer of {self.engine.path} is closed")
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(_Write(query, args, query_type, table, many, future))
+        return await future
+
+    async def close(self: Self) -> None:
+        """Waits for queued writes to be committed and stops the writer task."""
+        self.closed = True
+        if self.task is None:
+            return
+        if not self.task.done():
+            await self.queue.join()
+            self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self: Self) -> None:
+        try:
+            connection = await self.engine.get_connection()
+        except Exception as e:
+            log.exception("Could not open the SQLite writer connection to %s", self.engine.path)
+            while not self.queue.empty():
+                self.queue.get_nowait().future.set_exception(e)
+                self.queue.task_done()
+            return
+
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                while len(batch) < self.batch_size and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                try:
+                    await self._write_batch(connection, batch)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+        finally:
+            await connection.close()
+
+    async def _write_batch(self: Self, connection, batch: List[_Write]) -> None:
+        results: List[Tuple[_Write, Any, Optional[BaseException]]] = []
+        try:
+            await connection.execute("BEGIN IMMEDIATE")
+            for write in batch:
+                await connection.execute("SAVEPOINT tinybot_write")
+                try:
+                    response = await self._execute(connection, write)
+                except Exception as e:
+                    await connection.execute("ROLLBACK TO tinybot_write")
+                    results.append((write, None, e))
+                else:
+                    results.append((write, response, None))
+                await connection.execute("RELEASE tinybot_write")
+            await connection.execute("COMMIT")
+        except Exception as e:
+            log.exception("SQLite batch write to %s failed", self.engine.path)
+            if connection.in_transaction:
+                await connection.execute("ROLLBACK")
+            for write in batch:
+                if not write.future.done():
+                    write.future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.writes += len(batch)
+        for write, response, exception in results:
+            if write.future.done():
+                continue
+            if exception is not None:
+                write.future.set_exception(exception)
+            else:
+                write.future.set_result(response)
+
+    async def _execute(self: Self, connection, write: _Write) -> List[Dict[str, Any]]:
+        if write.many:
+            await connection.executemany(write.query, write.args)
+            return []
+        async with connection.execute(write.query, write.args) as cursor:
+            response = await cursor.fetchall()
+            if write.query_type == "insert" and self.engine.get_version_sync() < 3.35:
+                # We can't use the RETURNING clause on older versions of SQLite.
+                pk = await self.engine._get_inserted_pk(cursor, write.table)
+                return [{write.table._meta.primary_key._meta.db_column_name: pk}]
+            return response
+
+    def stats(self: Self) -> Dict[str, Any]:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "batches": self.batches,
+            "writes": self.writes,
+            "writes_per_batch": self.writes / self.batches if self.batches else 0.0,
+        }
+
+
+class TunedSQLiteEngine(SQLiteEngine):
+    """
+    SQLiteEngine tuned for write-heavy cogs.
+
+    The file runs in WAL mode so readers never block on the writer, every connection
+    gets the tuned pragmas, reads share a small pool of connections, and all writes
+    outside of explicit transactions go through the file's SQLiteWriter.
+    """
+
+    def __init__(
+        self: Self,
+        path: str,
+        synchronous: str = "NORMAL",
+        cache_size: int = 20_000,
+        busy_timeout: int = 5_000,
+        batch_size: int = 500,
+        readers: int = 4,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(path=path, timeout=busy_timeout / 1000, **kwargs)
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+        self.readers = readers
+        self.writer = SQLiteWriter(self, batch_size=batch_size)
+        self._wal_enabled: bool = False
+        self._reader_pool: Optional[asyncio.LifoQueue] = None
+        self._reader_count: int = 0
+        self._closed: bool = False
+
+    async def get_connection(self: Self):
+        connection = await super().get_connection()
+        if not self._wal_enabled:
+            await connection.execute("PRAGMA journal_mode = WAL")
+            self._wal_enabled = True
+        await connection.execute(f"PRAGMA synchronous = {self.synchronous}")
+        await connection.execute(f"PRAGMA cache_size = -{self.cache_size}")
+        await connection.execute(f"PRAGMA busy_timeout = {self.busy_timeout}")
+        await connection.execute("PRAGMA temp_store = MEMORY")
+        return connection
+
+    async def _acquire_reader(self: Self):
+        if self._closed:
+            raise RuntimeError(f"The SQLite engine of {self.path} is closed")
+        if self._reader_pool is None:
+            self._reader_pool = asyncio.LifoQueue()
+        if self._reader_pool.empty() and self._reader_count < self.readers:
+            self._reader_count += 1
+            try:
+                return await self.get_connection()
+            except Exception:
+                self._reader_count -= 1
+                raise
+        connection = await self._reader_pool.get()
+        if connection is None:
+            # Put by close(), wakes the next caller waiting for a reader too.
+            self._reader_pool.put_nowait(None)
+            raise RuntimeError(f"The SQLite engine of {self.path} is closed")
+        return connection
+
+    async def _release_reader(self: Self, connection) -> None:
+        if self._closed:
+            # Checked out while close() ran, nothing would close it later.
+            self._reader_count -= 1
+            await connection.close()
+        else:
+            self._reader_pool.put_nowait(connection)
+
+    async def _run_in_new_connection(
+        self: Self,
+        query: str,
+        args: List[Any] = None,
+        query_type: str = "generic",
+        table: Optional[Type[Table]] = None,
+    ):
+        if args is None:
+            args = []
+        if is_write(query):
+            return await self.writer.submit(query, args, query_type=query_type, table=table)
+
+        connection = await self._acquire_reader()
+        try:
+            async with connection.execute(query, args) as cursor:
+                return await cursor.fetchall()
+        finally:
+            await self._release_reader(connection)
+
+    async def close(self: Self) -> None:
+        """
+        Flushes pending writes and closes every connection. The readers still in use
+        are closed when they are returned, and no new connection is opened.
+        """
+        self._closed = True
+        await self.writer.close()
+        if self._reader_pool is not None:
+            while not self._reader_pool.empty():
+                connection = self._reader_pool.get_nowait()
+                if connection is not None:
+                    self._reader_count -= 1
+                    await connection.close()
+            self._reader_pool.put_nowait(None)
+
+    def stats(self: Self) -> Dict[str, Any]:
+        return {"readers": self._reader_count, **self.writer.stats()}
@@ -1,21 +1,150 @@
+import atexit
+import collections
+import json
 import logging
 import logging.handlers
 import os
+import queue
+import time
+from typing import Dict, Optional
 
 from colorlog import ColoredFormatter, StreamHandler as ColoredStreamHandler
 
 
-def init_logging() -> None:
-    file_formatter = logging.Formatter(
-        fmt="[{asctime}] [{levelname}] [{name}] {message}",
-        style="{",
-    )
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            payload["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class ThrottleFilter(logging.Filter):
+    """
+    Drops records of high-volume loggers below WARNING.
+
+    ``rate_limits`` caps the records per second of a logger (and its children)
+    with a token bucket, ``sample_rates`` keeps one record out of N.
+    """
+
+    def __init__(self, rate_limits: Dict[str, float], sample_rates: Dict[str, int]) -> None:
+        super().__init__()
+        self.rate_limits = rate_limits
+        self.sample_rates = sample_rates
+        self.dropped: collections.Counter = collections.Counter()
+        self._buckets: Dict[str, list] = {}
+        self._seen: collections.Counter = collections.Counter()
+        self._rules: Dict[str, Optional[str]] = {}
+
+    def _rule(self, name: str) -> Optional[str]:
+        """Returns the most specific configured logger name covering ``name``."""
+        if name not in self._rules:
+            configured = set(self.rate_limits) | set(self.sample_rates)
+            parts = name.split(".")
+            self._rules[name] = next(
+                (".".join(parts[:i]) for i in range(len(parts), 0, -1) if ".".join(parts[:i]) in configured),
+                None,
+            )
+        return self._rules[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rule = self._rule(record.name)
+        if rule is None:
+            return True
+
+        sample_rate = self.sample_rates.get(rule)
+        if sample_rate:
+            self._seen[rule] += 1
+            if self._seen[rule] % sample_rate:
+                self.dropped[rule] += 1
+                return False
+
+        rate = self.rate_limits.get(rule)
+        if rate:
+            now = time.monotonic()
+            bucket = self._buckets.setdefault(rule, [rate, now])
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.dropped[rule] += 1
+                return False
+            bucket[0] -= 1
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread and drops
+    records instead of blocking when the queue is full.
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped: int = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only merge the arguments, so later changes to them do not alter the message.
+        # Formatting, including tracebacks, happens in the listener thread.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _parse_limits(value: str) -> Dict[str, float]:
+    """Parses ``"discord.gateway=50,discord.client=10"``."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, limit = item.partition("=")
+        limits[name.strip()] = float(limit)
+    return limits
+
+
+def init_logging(cluster_id: Optional[int] = None) -> logging.handlers.QueueListener:
+    """
+    Sets up logging to stdout, ``info.log`` and ``debug.log``.
+
+    Records are put on a queue by the logging calls and formatted and written by a
+    background thread. Configured through the environment:
+        DEBUG_MODE: Also print DEBUG records to stdout.
+        LOG_FORMAT: ``json`` to write the log files as JSON lines.
+        LOG_BACKUP_COUNT: Rotated files kept per log file, default 5.
+        LOG_QUEUE_SIZE: Records buffered before new ones are dropped, default 10000.
+        LOG_RATE_LIMITS: Max records per second below WARNING per logger, default ``discord.gateway=50``.
+        LOG_SAMPLE_RATES: Keep one record out of N below WARNING per logger, e.g. ``discord.state=10``.
+    """
+    suffix = "" if cluster_id is None else f"-cluster{cluster_id}"
+    backup_count = int(os.getenv("LOG_BACKUP_COUNT", 5))
+
+    if os.getenv("LOG_FORMAT") == "json":
+        file_formatter = JsonFormatter(datefmt="%Y-%m-%dT%H:%M:%S%z")
+    else:
+        file_formatter = logging.Formatter(
+            fmt="[{asctime}] [{levelname}] [{name}] {message}",
+            style="{",
+        )
     info_file_handler = logging.handlers.RotatingFileHandler(
-        "info.log", maxBytes=5_242_880, encoding="utf-8"
+        f"info{suffix}.log", maxBytes=5_242_880, backupCount=backup_count, encoding="utf-8"
     )
     info_file_handler.setFormatter(file_formatter)
     debug_file_handler = logging.handlers.RotatingFileHandler(
-        "debug.log", maxBytes=5_242_880, encoding="utf-8"
+        f"debug{suffix}.log", maxBytes=5_242_880, backupCount=backup_count, encoding="utf-8"
     )
     debug_file_handler.setFormatter(file_formatter)
 
@@ -29,8 +158,29 @@ def init_logging() -> None:
     if os.getenv("DEBUG_MODE", False) is False:
         stdout_handler.setLevel(logging.INFO)
 
+    log_queue: queue.Queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", 10_000)))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(
+        ThrottleFilter(
+            rate_limits=_parse_limits(os.getenv("LOG_RATE_LIMITS", "discord.gateway=50")),
+            sample_rates={
+                name: int(rate) for name, rate in _parse_limits(os.getenv("LOG_SAMPLE_RATES", "")).items()
+            },
+        )
+    )
+    listener = logging.handlers.QueueListener(
+        log_queue,
+        stdout_handler,
+        info_file_handler,
+        debug_file_handler,
+        respect_handler_level=True,
+    )
+    listener.start()
+    atexit.register(listener.stop)
+
     logging.basicConfig(
         level=logging.DEBUG,
         datefmt="%Y-%m-%d %H:%M:%S",
-        handlers=[stdout_handler, info_file_handler, debug_file_handler],
+        handlers=[queue_handler],
     )
+    return listener
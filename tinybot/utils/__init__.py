@@ -0,0 +1,22 @@
+import os
+import sys
+from typing import Optional
+
+
+def get_rss() -> Optional[int]:
+    """
+    Returns the resident set size of the process in bytes, or None when it
+    cannot be read on this platform.
+    """
+    try:
+        with open("/proc/self/statm", "rb") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak usage, in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024